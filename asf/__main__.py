@@ -5,8 +5,6 @@ import morepath
 
 from redis import StrictRedis
 
-import transaction
-
 from waitress import serve
 
 import ZODB
@@ -14,6 +12,9 @@ import zodburi
 
 from .config import config, load_config
 from .app import App
+from .cache import RepresentationCache
+from .compress import CompressedStore
+from .events import EventStream
 from .model import RootDocument
 from .static import get_static
 
@@ -31,30 +32,53 @@ def run():
     storage_factory, dbkw = zodburi.resolve_uri(db_uri)
     storage = storage_factory()
 
-    # Create database and get root.
-    db = ZODB.DB(storage, **dbkw).open()
-    root = db.root()
-    if 'root' not in root:
-        root['root'] = RootDocument()
-        transaction.commit()
-    root = root['root']
-    log.debug('Root id %s', root.id)
+    # Create database and make sure it has a root. Every request opens
+    # its own connection from the database connection pool.
+    db = ZODB.DB(storage, **dbkw)
+    with db.transaction() as connection:
+        root = connection.root()
+        if 'root' not in root:
+            root['root'] = RootDocument()
+        log.debug('Root id %s', root['root'].id)
+        upgraded = root['root'].upgrade_collections()
+        if upgraded:
+            log.info('Upgraded %s collections.', upgraded)
+        if root['root'].salads.create_start_time_index():
+            log.info('Created the start time index of the salads.')
 
     # Redis connection
     r = StrictRedis.from_url(config['redis_uri'].get())
     # Test that we can connect tot the redis instance.
     r.ping()
 
-    app = App(root, r)
+    cache = RepresentationCache(
+        config['representation_cache']['max_bytes'].get(int))
+    max_len = config['event_stream']['max_len'].get(int)
+    event_stream = EventStream(max_len) if max_len else None
+    app = App(db, r, cache, event_stream)
+
+    # Relative to the directory of the config file.
+    mo_cache = config['locale']['mo_cache']
+    mo_cache = mo_cache.as_filename() if mo_cache.get(str) else None
 
     # Create temporary directory, and leaf it till app is closed.
     with TemporaryDirectory() as tempdir:
         log.debug('Created temporary directory %s.', tempdir)
-        app = get_static(app, tempdir)
+        static_config = config['static']
+        store = CompressedStore(
+            static_config['compressed_max_bytes'].get(int))
+        app = get_static(
+            app, tempdir, production=config['production'].get(bool),
+            watch_interval=static_config['watch_interval'].get(float),
+            store=store,
+            precompile=config['locale']['precompile'].get(bool),
+            processes=config['locale']['processes'].get(int) or None,
+            mo_cache=mo_cache)
 
         log.debug('Starting rest api.')
         serve(app, host=config['host'].get(), port=config['port'].get(int),
-              url_scheme=config['url_scheme'].get())
+              url_scheme=config['url_scheme'].get(),
+              threads=config['threads'].get(int))
 
 
 if __name__ == '__main__':  #pragma: no cover
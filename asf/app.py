@@ -1,7 +1,16 @@
+from functools import partial
 import logging
+import threading
+import time
 
 import morepath
+from morepath.core import body_model_predicate
 from more.transaction import TransactionApp
+from more.transaction.main import transaction_tween_factory
+import reg
+
+from .cache import RepresentationCache
+from .metrics import AppMetrics
 
 # Tweens only work on the root app. So set the root app as the TransactionApp,
 # to make sure the transaction tween is run.
@@ -15,11 +24,49 @@ class ResourceApp(TransactionApp):
 
 
 class RootApp(ResourceApp):
-
-    def __init__(self, root, redis):
-        self.db = root
-        self.id = root.id
+    """The root app.
+
+    The app is shared by all server threads, so it holds the ZODB
+    database and not a connection. Every request gets its own connection
+    from the database pool, see `connection_tween_factory`.
+    Events are published to redis, and appended to the streams of
+    event_stream if given.
+    """
+
+    def __init__(self, database, redis, representation_cache=None,
+                 event_stream=None):
+        self.database = database
         self.redis = redis
+        self.event_stream = event_stream
+        if representation_cache is None:
+            representation_cache = RepresentationCache()
+        self.representation_cache = representation_cache
+        self.metrics = AppMetrics()
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """The ZODB connection of the current request."""
+        return self._local.connection
+
+    def open_connection(self):
+        # Uses the thread local transaction manager, which is the one
+        # the transaction tween begins and commits.
+        self._local.connection = self.database.open()
+        return self._local.connection
+
+    def close_connection(self):
+        connection = self._local.__dict__.pop('connection', None)
+        if connection is not None:
+            connection.close()
+
+    @property
+    def db(self):
+        return self.connection.root()['root']
+
+    @property
+    def id(self):
+        return self.db.id
 
 
 class SaladsApp(ResourceApp):
@@ -42,4 +89,132 @@ class WebsocketApp(morepath.App):
     pass
 
 
+@RootApp.tween_factory(over=transaction_tween_factory)
+def connection_tween_factory(app, handler):
+    """Open a ZODB connection for every request.
+
+    The connection is returned to the pool once the transaction is
+    finished.
+    """
+    log = logging.getLogger(__name__)
+
+    def connection_tween(request):
+        connection = app.open_connection()
+        log.debug('Opened connection %r', connection)
+        try:
+            response = handler(request)
+        except BaseException:
+            app.close_connection()
+            raise
+        # A streaming response still reads from the database while it is
+        # send, close the connection once it is done.
+        return on_response_done(response, app.close_connection)
+
+    return connection_tween
+
+
+@RootApp.tween_factory(over=connection_tween_factory)
+def metrics_tween_factory(app, handler):
+    """Record the duration and status of every request.
+
+    The labels are taken from the request once it is handled, see
+    request_labels. Requests in progress are only counted by method, as
+    the model and view are not known before. A streaming response is in
+    progress until it is send.
+    """
+    metrics = app.metrics
+
+    def metrics_tween(request):
+        start = time.perf_counter()
+        method = request_method(request)
+        metrics.requests_in_progress.inc(method=method)
+
+        def done(status):
+            duration = time.perf_counter() - start
+            metrics.requests_in_progress.dec(method=method)
+            labels = request_labels(request, status)
+            metrics.request_seconds.observe(duration, **labels)
+            metrics.requests.inc(status=status, **labels)
+
+        try:
+            response = handler(request)
+        except BaseException:
+            done(500)
+            raise
+        return on_response_done(response,
+                                partial(done, response.status_code))
+
+    return metrics_tween
+
+
+def on_response_done(response, callback):
+    """Call callback once response is send, returns response.
+
+    The app_iter of a streaming response is wrapped in a
+    ClosingIterator, else callback is called right away.
+    """
+    if isinstance(response.app_iter, (list, tuple)):
+        callback()
+    else:
+        response.app_iter = ClosingIterator(response.app_iter, callback)
+    return response
+
+
+def request_method(request):
+    """The method label of request, one of the methods of http."""
+    if request.method in ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE',
+                          'OPTIONS'):
+        return request.method
+    return 'other'
+
+
+def request_labels(request, status):
+    """The metrics labels of a handled request.
+
+    The app and view the request resolved to, and the class of its
+    model. A request that was not found, has the view 'unmatched', so
+    the paths clients ask for do not add labels.
+    """
+    view = getattr(request, 'view_name', None)
+    if view is None or status == 404:
+        view = 'unmatched'
+    return {
+        'app': type(request.app).__name__,
+        'model': request.environ.get('asf.metrics_model', ''),
+        'view': view,
+        'method': request_method(request),
+    }
+
+
+@ResourceApp.predicate(morepath.App.get_view, name='metrics_model',
+                       default=None, index=reg.KeyIndex,
+                       after=body_model_predicate)
+def metrics_model_predicate(self, obj, request):
+    """Record the class of the model a view is looked up for.
+
+    Always matches, so it does not change which view is found.
+    """
+    request.environ['asf.metrics_model'] = \
+        '' if obj is None else type(obj).__name__
+    return None
+
+
+class ClosingIterator(object):
+    """Wrap an app_iter, calling callback when it is closed."""
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.callback()
+
+
 App = RootApp
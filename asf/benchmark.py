@@ -0,0 +1,370 @@
+"""Benchmark of the fan-out of events by the websocket server.
+
+The websocket server is started in a child process, with a local
+pub/sub broker or a locally started redis server. Clients connect to it
+and subscribe to the paths, while events are published at a fixed rate.
+The latency of the delivery of the events, the delivered events per
+second and the memory used per connection are reported.
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import time
+
+import aredis
+
+import websockets
+
+from . import websocket
+
+
+class LocalPubSub(object):
+    """An in-process stand-in for the pubsub of redis.
+
+    Patterns are matched with fnmatch, which is close to the globs of
+    redis.
+    """
+
+    def __init__(self, *, loop=None):
+        self.channels = set()
+        self.patterns = set()
+        self.queue = asyncio.Queue(loop=loop)
+
+    async def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+    async def psubscribe(self, *patterns):
+        self.patterns.update(patterns)
+
+    async def punsubscribe(self, *patterns):
+        self.patterns.difference_update(patterns)
+
+    async def listen(self):
+        return await self.queue.get()
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def publish(self, channel, data):
+        """Publish data on channel, returns the number of receivers."""
+        count = 0
+        if channel in self.channels:
+            self.queue.put_nowait(
+                {'type': 'message', 'channel': channel, 'data': data})
+            count += 1
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(channel, pattern):
+                self.queue.put_nowait(
+                    {'type': 'pmessage', 'pattern': pattern,
+                     'channel': channel, 'data': data})
+                count += 1
+        return count
+
+
+class AllPathsValid(object):
+    """Path validator accepting every path, there is no app server."""
+
+    async def is_valid(self, path):
+        return True
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def rss():
+    """The resident memory of this process in bytes, or None."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, percent):
+    """The nearest rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(int(math.ceil(percent / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+class RedisServer(object):
+    """A redis server, started on an unused port.
+
+    Only available if redis-server is installed.
+    """
+
+    def __init__(self):
+        self.port = unused_port()
+        self.uri = 'redis://localhost:{}'.format(self.port)
+        self.process = None
+
+    @staticmethod
+    def available():
+        return shutil.which('redis-server') is not None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            ['redis-server', '--port', str(self.port), '--save', '',
+             '--appendonly', 'no'],
+            stdout=subprocess.DEVNULL)
+        # Wait till it accepts connections.
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                return self
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.process.terminate()
+                    raise
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.terminate()
+        self.process.wait()
+
+
+def benchmark_paths(count):
+    return ['/api/benchmark/{}'.format(i) for i in range(count)]
+
+
+async def publish_events(publish, paths, rate, duration, *, loop):
+    """Publish rate events per second for duration seconds.
+
+    The events are published to paths in turn, their data is the time
+    they are published. Returns the number of published events.
+    """
+    count = int(rate * duration)
+    start = loop.time()
+    for i in range(count):
+        data = {'data': {'sent': time.monotonic(), 'seq': i},
+                'type': 'CREATE'}
+        await publish(paths[i % len(paths)], json.dumps(data))
+        delay = start + (i + 1) / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay, loop=loop)
+    return count
+
+
+def run_server(pipe, port, options):
+    """Run the websocket server in the child process.
+
+    The parent is told the memory use once the server is started, and
+    once the clients are connected. Then the events are published, and
+    the parent is told how many.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if options['redis_uri']:
+        redis = aredis.StrictRedis.from_url(options['redis_uri'])
+        pubsub, publish = redis.pubsub(), redis.publish
+    else:
+        pubsub = LocalPubSub(loop=loop)
+        publish = pubsub.publish
+    handler = websocket.handler_factory(
+        pubsub, validator=AllPathsValid(),
+        queue_size=options['queue_size'], policy=options['policy'],
+        loop=loop)
+    server = loop.run_until_complete(
+        websockets.serve(handler, 'localhost', port, loop=loop))
+
+    def receive():
+        return loop.run_until_complete(loop.run_in_executor(None, pipe.recv))
+
+    pipe.send(rss())
+    # Wait for the clients to connect.
+    receive()
+    pipe.send(rss())
+    pipe.send(loop.run_until_complete(publish_events(
+        publish, benchmark_paths(options['paths']), options['rate'],
+        options['duration'], loop=loop)))
+    # Keep sending till the clients have received the events.
+    receive()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+async def receive_events(client, latencies):
+    """Receive the events of client, adding their latencies."""
+    while True:
+        frame = await client.recv()
+        now = time.monotonic()
+        events = json.loads(frame)
+        if not isinstance(events, list):
+            events = [events]
+        for event in events:
+            if event.get('function') == 'message':
+                latencies.append(now - event['data']['sent'])
+
+
+async def connect(url, origin, path, batch, *, loop):
+    client = await websockets.connect(url, origin=origin, loop=loop)
+    message = {'function': 'subscribe', 'path': path}
+    if batch:
+        message['batch'] = True
+    await client.send(json.dumps(message))
+    response = json.loads(await client.recv())
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return client
+
+
+def benchmark(clients=100, paths=10, rate=100.0, duration=10.0,
+              batch=False, redis_uri=None, queue_size=100,
+              policy='drop-oldest', drain=5.0):
+    """Run the benchmark, returns the results as a dict."""
+    port = unused_port()
+    options = {'paths': paths, 'rate': rate, 'duration': duration,
+               'redis_uri': redis_uri, 'queue_size': queue_size,
+               'policy': policy}
+    pipe, child_pipe = multiprocessing.Pipe()
+    process = multiprocessing.get_context('fork').Process(
+        target=run_server, args=(child_pipe, port, options),
+        name='benchmark-server')
+    process.start()
+    loop = asyncio.new_event_loop()
+    connections = []
+    tasks = []
+    # Wait at most this long for the server.
+    timeout = duration + 30
+
+    def receive():
+        if not loop.run_until_complete(
+                loop.run_in_executor(None, pipe.poll, timeout)):
+            raise RuntimeError('The benchmark server did not respond.')
+        return pipe.recv()
+
+    try:
+        rss_started = receive()
+        origin = 'http://localhost:{}'.format(port)
+        url = 'ws://localhost:{}/api'.format(port)
+        all_paths = benchmark_paths(paths)
+        for i in range(clients):
+            connections.append(loop.run_until_complete(connect(
+                url, origin, all_paths[i % paths], batch, loop=loop)))
+        latencies = []
+        tasks = [asyncio.ensure_future(receive_events(c, latencies),
+                                       loop=loop)
+                 for c in connections]
+        pipe.send('connected')
+        rss_connected = receive()
+        start = time.monotonic()
+        published = receive()
+        # Every client receives the events of its path.
+        per_path = [len(range(i, published, paths)) for i in range(paths)]
+        expected = sum(per_path[i % paths] for i in range(clients))
+        deadline = time.monotonic() + drain
+        while len(latencies) < expected and time.monotonic() < deadline:
+            loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+        elapsed = time.monotonic() - start
+    finally:
+        for task in tasks:
+            task.cancel()
+        if connections:
+            loop.run_until_complete(asyncio.wait(
+                [connection.close() for connection in connections],
+                loop=loop))
+        loop.close()
+        if process.is_alive():
+            pipe.send('done')
+        process.join(5)
+        if process.exitcode is None:
+            process.terminate()
+            process.join()
+    latencies.sort()
+    memory = None
+    if rss_started is not None and rss_connected is not None and clients:
+        memory = (rss_connected - rss_started) / clients
+    return {
+        'clients': clients,
+        'paths': paths,
+        'published': published,
+        'expected': expected,
+        'delivered': len(latencies),
+        'seconds': elapsed,
+        'events_per_second': len(latencies) / elapsed if elapsed else 0,
+        'latency': {str(p): percentile(latencies, p)
+                    for p in (50, 90, 99, 100)},
+        'memory_per_connection': memory,
+    }
+
+
+def format_results(results):
+    def ms(value):
+        return 'n/a' if value is None else '{:.2f}'.format(value * 1000)
+
+    latency = results['latency']
+    memory = results['memory_per_connection']
+    lines = [
+        'clients: {clients}, paths: {paths}, published: {published} '
+        'events'.format(**results),
+        'delivered: {delivered} of {expected} events in {seconds:.2f} s, '
+        '{events_per_second:.0f} events/s'.format(**results),
+        'latency ms: p50 {} p90 {} p99 {} max {}'.format(
+            ms(latency['50']), ms(latency['90']), ms(latency['99']),
+            ms(latency['100'])),
+        'memory per connection: {}'.format(
+            'n/a' if memory is None else '{:.1f} KiB'.format(memory / 1024)),
+    ]
+    return '\n'.join(lines)
+
+
+def run():  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', '-n', type=int, default=100,
+                        help='Number of websocket clients.')
+    parser.add_argument('--paths', '-m', type=int, default=10,
+                        help='Number of paths the clients subscribe to.')
+    parser.add_argument('--rate', '-r', type=float, default=100.0,
+                        help='Events published per second.')
+    parser.add_argument('--duration', '-d', type=float, default=10.0,
+                        help='Seconds to publish events.')
+    parser.add_argument('--batch', action='store_true',
+                        help='Subscribe with batching.')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='Size of the send queue of the websockets.')
+    parser.add_argument('--policy', default='drop-oldest',
+                        choices=websocket.SendQueue.policies,
+                        help='Slow consumer policy of the send queue.')
+    parser.add_argument('--redis', action='store_true',
+                        help='Use a local redis server, if installed.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as json.')
+    args = parser.parse_args()
+    kwargs = dict(clients=args.clients, paths=args.paths, rate=args.rate,
+                  duration=args.duration, batch=args.batch,
+                  queue_size=args.queue_size, policy=args.policy)
+    if args.redis and not RedisServer.available():
+        print('redis-server is not installed, using a local broker.')
+    if args.redis and RedisServer.available():
+        with RedisServer() as server:
+            results = benchmark(redis_uri=server.uri, **kwargs)
+    else:
+        results = benchmark(**kwargs)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    run()
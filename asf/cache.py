@@ -0,0 +1,73 @@
+"""Cache of the encoded json of documents."""
+import collections
+import threading
+
+
+class RepresentationCache(object):
+    """A least recently used cache of encoded documents.
+
+    Every entry is stored with the serial of the document it was
+    created from. A committed change to the document gives it a new
+    serial, so the entry is not used anymore and is replaced on the
+    next set.
+    The size of the cache is bound by the total length of the cached
+    values.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Map of key to (serial, value).
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, serial):
+        """Get the value of key, or None if it was not for serial."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != serial:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, serial, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            self._data[key] = (serial, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+def document_key(document, *variant):
+    """The key and serial to cache the representation of document.
+
+    Returns None if the document has no committed state that can be
+    cached, like a new or changed document.
+    variant is added to the key, for values that change the
+    representation other than the document itself.
+    """
+    if document._p_oid is None:
+        return None
+    # Load a ghost, so its serial is known.
+    document._p_activate()
+    if document._p_changed:
+        return None
+    return (document._p_oid,) + variant, document._p_serial
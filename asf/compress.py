@@ -0,0 +1,220 @@
+"""Serve static files compressed, if the client accepts it."""
+import gzip
+import logging
+import mimetypes
+import os
+import time
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+import bowerstatic
+from bowerstatic.publisher import FOREVER
+
+import webob
+from webob.static import DirectoryApp, FileApp
+
+from .cache import RepresentationCache
+
+
+def log():  # pragma: no cover
+    """Logger, is loaded on first use.
+
+    Thus we make sure it is loaded after our config is loaded.
+    """
+    return logging.getLogger(__name__)
+
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/x-font-ttf',
+    'application/vnd.ms-fontobject',
+    'font/otf',
+    'font/ttf',
+    'image/svg+xml',
+    'image/x-icon',
+}
+
+
+def is_compressible(content_type):
+    if content_type is None:
+        return False
+    return content_type.startswith('text/') or \
+        content_type in COMPRESSIBLE_TYPES
+
+
+def compress_gzip(data):
+    return gzip.compress(data, compresslevel=9)
+
+
+def compress_brotli(data):
+    return brotli.compress(data)
+
+
+# Supported encodings, in order of preference.
+COMPRESSORS = [('gzip', compress_gzip)]
+if brotli is not None:
+    COMPRESSORS.insert(0, ('br', compress_brotli))
+COMPRESSORS = dict(COMPRESSORS)
+ENCODINGS = tuple(COMPRESSORS)
+
+
+def get_encoding(request, encodings=ENCODINGS):
+    """The encoding to use for the response, or None for no encoding."""
+    # Without an Accept-Encoding header webob accepts any encoding, but
+    # then the client may not support any.
+    if 'Accept-Encoding' not in request.headers:
+        return None
+    return request.accept_encoding.best_match(encodings)
+
+
+class CompressedStore(object):
+    """Compressed variants of files.
+
+    A variant is created on first use and cached in memory until the
+    file is changed or it is evicted, as the cache is bound by the
+    total size of the variants.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, min_size=256):
+        self.cache = RepresentationCache(max_bytes)
+        self.min_size = min_size
+
+    def get(self, filename, encoding, stat=None):
+        """The content of filename compressed with encoding.
+
+        Returns None if the file is too small or does not get smaller
+        when compressed.
+        """
+        if stat is None:
+            stat = os.stat(filename)
+        if stat.st_size < self.min_size:
+            return None
+        key = (filename, encoding)
+        serial = (stat.st_mtime_ns, stat.st_size)
+        value = self.cache.get(key, serial)
+        if value is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            value = COMPRESSORS[encoding](data)
+            if len(value) >= len(data):
+                # Remember that compressing does not help.
+                value = b''
+            self.cache.set(key, serial, value)
+        return value or None
+
+    def precompress(self, *directories):
+        """Create the variants of all compressible files in directories."""
+        count = 0
+        for directory in directories:
+            for dirpath, _, filenames in os.walk(directory):
+                for name in filenames:
+                    filename = os.path.join(dirpath, name)
+                    content_type, content_encoding = \
+                        mimetypes.guess_type(filename)
+                    if content_encoding or not is_compressible(content_type):
+                        continue
+                    for encoding in ENCODINGS:
+                        self.get(filename, encoding)
+                    count += 1
+        log().debug('Precompressed %s files.', count)
+
+
+class CompressedFileApp(FileApp):
+    """Send the file, compressed if accepted by the client."""
+
+    def __init__(self, filename, store, **kw):
+        super().__init__(filename, **kw)
+        self.store = store
+
+    @property
+    def compressible(self):
+        return self.kw.get('content_encoding') is None and \
+            is_compressible(self.kw.get('content_type'))
+
+    @webob.dec.wsgify
+    def __call__(self, request):
+        if not self.compressible:
+            return request.get_response(super().__call__)
+        response = self.get_compressed_response(request)
+        if response is None:
+            response = request.get_response(super().__call__)
+        response.vary = ('Accept-Encoding',)
+        return response
+
+    def get_compressed_response(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        encoding = get_encoding(request)
+        if encoding is None:
+            return None
+        try:
+            stat = os.stat(self.filename)
+            body = self.store.get(self.filename, encoding, stat)
+        except OSError:
+            # Let FileApp return the error.
+            return None
+        if body is None:
+            return None
+        kw = dict(self.kw, content_encoding=encoding)
+        response = webob.Response(
+            body=body,
+            last_modified=stat.st_mtime,
+            **kw)
+        # Strong etag of the variant, so ranges can be requested.
+        response.etag = '{}-{}-{}'.format(stat.st_mtime_ns, stat.st_size,
+                                          encoding)
+        return request.get_response(response.conditional_response_app)
+
+
+class CompressedDirectoryApp(DirectoryApp):
+    """Serve the files of a directory, compressed if accepted."""
+
+    def __init__(self, path, store, **kw):
+        super().__init__(path, **kw)
+        self.store = store
+
+    def make_fileapp(self, path):
+        return CompressedFileApp(path, self.store, **self.fileapp_kw)
+
+
+class CompressedPublisherTween(bowerstatic.PublisherTween):
+    """Publish the bower components, compressed if accepted.
+
+    The urls are versioned, so the files never change and the response
+    is cached forever.
+    """
+
+    def __init__(self, bower, handler, store):
+        super().__init__(bower, handler)
+        self.store = store
+
+    def __call__(self, request):
+        if request.path_info_peek() != self.bower.publisher_signature:
+            return self.handler(request)
+        # Same as bowerstatic's publisher, but using CompressedFileApp.
+        request.path_info_pop()
+        segments = [request.path_info_pop() for _ in range(3)]
+        if None in segments:
+            return webob.exc.HTTPNotFound()
+        bower_components_name, component_name, component_version = segments
+        file_path = request.path_info.lstrip('/')
+        if file_path.strip() == '':
+            return webob.exc.HTTPNotFound()
+        filename = self.bower.get_filename(bower_components_name,
+                                           component_name,
+                                           component_version,
+                                           file_path)
+        if filename is None:
+            return webob.exc.HTTPNotFound()
+        response = request.get_response(
+            CompressedFileApp(filename, self.store))
+        if response.status_code == 200:
+            response.headers['Cache-Control'] = \
+                'public, max-age={}, immutable'.format(FOREVER)
+            response.expires = time.time() + FOREVER
+        return response
@@ -5,20 +5,51 @@ import logging
 import confuse
 
 template = {
+    'production': bool,
     'port': int,
     'host': str,
+    'threads': int,
     'db_uri': str,
     'redis_uri': str,
+    'representation_cache': {'max_bytes': int},
+    'event_stream': {'max_len': int},
+    'locale': {'precompile': bool,
+               'processes': int,
+               'mo_cache': str},
+    'static': {'watch_interval': float,
+               'compressed_max_bytes': int},
     'websocket': {'port': int,
-                  'host': str},
+                  'host': str,
+                  'workers': int,
+                  'metrics_port': int,
+                  'send_queue': {'size': int,
+                                 'policy': confuse.Choice(
+                                     ['drop-oldest', 'coalesce',
+                                      'disconnect']),
+                                 'max_lag': float},
+                  'batch': {'window': float,
+                            'size': int},
+                  'compression': {'enabled': bool,
+                                  'window_bits': int,
+                                  'mem_level': int,
+                                  'min_size': int},
+                  'path_cache': {'size': int,
+                                 'ttl': float,
+                                 'timeout': float}},
     'log': {'version': int}
 }
 
 config = confuse.LazyConfig('ASF', __name__)
 
 
-def load_config():
-    parser = argparse.ArgumentParser()
+def load_config(parser=None):
+    """Load the config file given on the command line and set up logging.
+
+    parser is the argument parser to add the --config argument to, for
+    commands with more arguments. Returns the parsed arguments.
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c', help='App config.')
 
     args = parser.parse_args()
@@ -30,6 +61,7 @@ def load_config():
     dictConfig(config['log'].get())
     log = logging.getLogger(__name__)
     log.debug('Loaded config')
+    return args
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -0,0 +1,46 @@
+"""Events of created documents, kept in a redis stream per channel."""
+
+# Prefix of the key of the stream of a channel.
+STREAM_PREFIX = 'asf:events:'
+
+# Append the event to the stream of the channel, and publish it with the
+# id of the stream entry, so a client can ask for the events after it.
+# The event is a json object, the id is added as its first member.
+PUBLISH_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*',
+                      'event', ARGV[2])
+redis.call('PUBLISH', ARGV[1], '{"id":"' .. id .. '",' .. ARGV[2]:sub(2))
+return id
+"""
+
+
+def stream_key(channel):
+    """The key of the stream of the events of channel."""
+    return STREAM_PREFIX + channel
+
+
+def parse_id(event_id):
+    """The stream entry id event_id as a tuple, for comparing ids.
+
+    Raises a ValueError if event_id is not a valid id.
+    """
+    milliseconds, _, sequence = event_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+class EventStream(object):
+    """Publish events, and keep them in a capped stream per channel.
+
+    The streams keep about the latest max_len events of their channel,
+    which can be replayed by clients that missed them.
+    """
+
+    def __init__(self, max_len=1000):
+        self.max_len = max_len
+
+    def publish(self, pipeline, channel, message):
+        """Publish message, a json object, on channel using pipeline."""
+        # Send the script itself, as loading it would need a round trip
+        # for every pipeline. Redis caches the compiled script.
+        pipeline.eval(PUBLISH_SCRIPT, 1, stream_key(channel),
+                      channel, message, self.max_len)
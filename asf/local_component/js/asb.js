@@ -132,10 +132,19 @@ function loadApp() {
     var currentState = history.state;
     window.onpopstate = showPage;
     locale = document.documentElement.lang;
-    // Save the locale for next reload.
-    if (storageAvailable("localStorage")) {
-        window.localStorage.setItem("locale", locale);
+    var atIndex = ["", "index.html"].indexOf(
+        window.location.pathname.split("/")[1]) > -1;
+    if (atIndex && !hasLocaleCookie() && storageAvailable("localStorage")) {
+        var stored = window.localStorage.getItem("locale");
+        if (stored && stored != locale) {
+            // Chosen before the locale was kept in a cookie, so the
+            // server did not know it. Go to the page of that locale.
+            saveLocale(stored);
+            loadIndex();
+            return;
+        }
     }
+    saveLocale(locale);
     moment.locale(locale);
     timezone = moment.tz.guess();
     // timezone = "Europe/Amsterdam";
@@ -153,6 +162,22 @@ function loadApp() {
     loadVegetables();
 }
 
+function saveLocale(locale) {
+    // Save the locale for next reload. The cookie tells the server to
+    // serve the index page in this locale.
+    if (storageAvailable("localStorage")) {
+        window.localStorage.setItem("locale", locale);
+    }
+    document.cookie = "locale=" + encodeURIComponent(locale) +
+        "; path=/; max-age=31536000; samesite=lax";
+}
+
+function hasLocaleCookie() {
+    return document.cookie.split(/;\s*/).some(function(cookie) {
+        return cookie.indexOf("locale=") == 0;
+    });
+}
+
 function setNav() {
     $("#toCreate").click(navAttachClick(loadCreate, resetCreateSaladForm));
     $("#changeLanguage ul a").click(navAttachClick(loadLanguage));
@@ -1,4 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
 import gettext
+import gzip
+import hashlib
 from io import BytesIO
 import itertools
 import json
@@ -20,8 +23,12 @@ import chameleon
 
 from lingua import extract
 
+import webob
 from webob.static import DirectoryApp
 
+from .compress import get_encoding
+from .watch import Watcher
+
 
 NAME_RE = r"[a-zA-Z][-a-zA-Z0-9_]*"
 
@@ -55,23 +62,71 @@ def get_languages_from_locale(locale):
     return tuple(languages)
 
 
+def parse_accept_language(header):
+    """The languages of an Accept-Language header, most preferred first.
+
+    Languages with a quality of 0 and the wildcard are left out.
+    """
+    languages = []
+    for index, item in enumerate(header.split(',')):
+        tag, _, params = item.partition(';')
+        tag = tag.strip()
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if tag and tag != '*' and quality > 0:
+            languages.append((-quality, index, tag))
+    return [tag for _, _, tag in sorted(languages)]
+
+
 # TODO allow for static localized files.
 class LocaleApp(DirectoryApp):
 
     _initialized = False
+    # Rendered pages are not checked for changes when frozen.
+    frozen = False
+    _watcher = None
+    # Incremented by the watcher on every change.
+    _generation = 0
     locales = {}
     known_locales = {babel.Locale.parse('en_US'):
                      get_languages_from_locale('en_US')}
+    # Known languages by their lowercase name, with a '-' separator.
+    language_table = {}
+    # Negotiated language by Accept-Language header.
+    _negotiated = {}
+    negotiated_cache_size = 1024
 
     @classmethod
     def initialize(cls, templatedir, localedir, tempdir,
-                   use_fuzzy=False, **kw):
+                   use_fuzzy=False, precompile=False, processes=None,
+                   frozen=False, watch_interval=1.0, mo_cache=None, **kw):
+        """Initialize the locale apps.
+
+        If precompile is set all templates are rendered for all known
+        languages, in processes worker processes, before returning.
+        If frozen is set, rendered pages are never rendered again. Else
+        a watcher checks the templates and translations for changes,
+        every watch_interval seconds if inotify is not available.
+        The compiled translations are cached in the mo_cache directory,
+        by default in tempdir, the ones of old po files are removed.
+        """
         if not cls._initialized:
             cls.log = logging.getLogger(__name__)
             cls.templatedir = os.path.abspath(templatedir)
             cls.localedir = os.path.abspath(localedir)
             cls._tempdir = os.path.abspath(tempdir)
+            if mo_cache is None:
+                mo_cache = os.path.join(cls._tempdir, 'mo')
+            cls.mo_cache = os.path.abspath(mo_cache)
+            os.makedirs(cls.mo_cache, mode=0o700, exist_ok=True)
             cls.use_fuzzy = use_fuzzy
+            cls.frozen = frozen
             cls._kw = kw
             cls._initialized = True
             for entry in scandir(cls.localedir):
@@ -95,6 +150,100 @@ class LocaleApp(DirectoryApp):
                                         itertools.chain.from_iterable(
                                             cls.known_locales.values()
                                         ))
+            cls.language_table = {
+                lang.lower(): lang for lang in itertools.chain.from_iterable(
+                    cls.known_locales.values())}
+            cls._negotiated = {}
+            if precompile:
+                cls.precompile(processes)
+            cls.prune_mo_cache()
+            if not frozen:
+                cls._watcher = Watcher([cls.templatedir, cls.localedir],
+                                       cls.changed, watch_interval)
+                cls._watcher.start()
+
+    @classmethod
+    def find_language(cls, language):
+        """The known language matching language, or None if unknown."""
+        return cls.language_table.get(language.replace('_', '-').lower())
+
+    @classmethod
+    def negotiate(cls, accept_language):
+        """The known language best matching the Accept-Language header.
+
+        A language is matched by its tag or, if it is not known, by the
+        tag with its last subtags removed. Returns None if no language
+        matches.
+        """
+        if not accept_language:
+            return None
+        try:
+            return cls._negotiated[accept_language]
+        except KeyError:
+            pass
+        language = None
+        for tag in parse_accept_language(accept_language):
+            subtags = tag.split('-')
+            while subtags and language is None:
+                language = cls.find_language('-'.join(subtags))
+                subtags.pop()
+            if language is not None:
+                break
+        if len(cls._negotiated) >= cls.negotiated_cache_size:
+            cls._negotiated.clear()
+        cls._negotiated[accept_language] = language
+        return language
+
+    @classmethod
+    def changed(cls):
+        """Called on a change, the pages are checked on the next use."""
+        cls.log.debug('Templates or translations changed.')
+        cls._generation += 1
+
+    @classmethod
+    def precompile(cls, processes=None):
+        """Render all templates of all known languages.
+
+        The templates are rendered in parallel in processes worker
+        processes, by default one per cpu.
+        """
+        apps = [cls.get_app(None)]
+        apps.extend(cls.get_app(lang) for lang in cls.known_languages)
+        with ProcessPoolExecutor(processes) as executor:
+            futures = []
+            for app in apps:
+                for path in app.get_templates():
+                    # Mark it as rendered, so it is not rendered again on
+                    # the first request.
+                    app.is_dirty(path)
+                    futures.append((app, path, executor.submit(
+                        render_template, path, **app.get_render_kw(path))))
+            for app, path, future in futures:
+                app.set_page(path, future.result())
+        cls.log.debug('Precompiled %s templates.', len(futures))
+
+    @classmethod
+    def prune_mo_cache(cls):
+        """Remove the mo files of old content of the po files.
+
+        Returns the number of removed mo files.
+        """
+        current = set()
+        for dirpath, dirnames, filenames in os.walk(cls.localedir):
+            for name in filenames:
+                if name.endswith('.po'):
+                    with open(os.path.join(dirpath, name), 'rb') as f:
+                        current.add(get_mofile_name(f.read(), cls.use_fuzzy))
+        removed = 0
+        for entry in scandir(cls.mo_cache):
+            if entry.name.endswith('.mo') and entry.name not in current:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:  # pragma: no cover
+                    pass
+        cls.log.debug('Removed %s old mo files.', removed)
+        return removed
 
     @classmethod
     def get_app(cls, locale):
@@ -113,19 +262,51 @@ class LocaleApp(DirectoryApp):
         if not self._initialized:
             raise RuntimeError('Must Initialize LocaleApp before '
                                'creating an intance.')
-        self.outdir = os.path.join(self._tempdir, locale)
         self._mtime = {}
+        self._checked = {}
         self._pofiles = {}
+        self._pages = {}
         self.languages = get_languages_from_locale(locale)
         if locale:
             self.locale = babel.Locale.parse(locale)
-            os.mkdir(self.outdir, mode=0o700)
             self.templatedir = os.path.join(self.templatedir, '_locale')
         else:
             self.locale = None
         super().__init__(self.templatedir, **self._kw)
 
+    @webob.dec.wsgify
+    def __call__(self, request):
+        if self.frozen:
+            page = self.get_rendered_page(request)
+            if page is not None:
+                return page
+        return super().__call__(request)
+
+    def get_rendered_page(self, request):
+        """The rendered page of the request, or None if not rendered.
+
+        Looks the page up without checking the file system.
+        """
+        path = os.path.abspath(os.path.join(self.path,
+                                            request.path_info.lstrip('/')))
+        page = self._pages.get(path)
+        if page is None and self.index_page and \
+                request.path_info.endswith('/'):
+            page = self._pages.get(os.path.join(path, self.index_page))
+        return page
+
     def is_dirty(self, path):
+        """Check if the page of path has to be rendered.
+
+        The modification times of the files of a rendered page are only
+        checked after the watcher saw a change, and never when frozen.
+        """
+        if path in self._mtime:
+            if self.frozen:
+                return False
+            if self._checked.get(path) == self._generation:
+                return False
+        self._checked[path] = self._generation
         current_mtime = self.get_real_mtime(path)
         mtime = self._mtime.get(path, 0)
         self.log.debug('Current mtime %s, original mtime %s.', current_mtime,
@@ -142,21 +323,21 @@ class LocaleApp(DirectoryApp):
             mtime = max(mtime, os.path.getmtime(pofile))
         return mtime
 
-    def bust_cache(self, bust_time=None):
-        if bust_time is None:
-            bust_time = time.time()
-        utime = (bust_time, bust_time)
-        self.log.debug('Busting cache, bust time: %s', bust_time)
-        for path in self._mtime:
-            if os.path.getmtime(path) < bust_time:
-                os.utime(path, utime)
+    def get_templates(self):
+        """The paths of all templates of this app."""
+        for dirpath, dirnames, filenames in os.walk(self.templatedir):
+            if self.locale is None and dirpath == self.templatedir:
+                # The templates of the locale apps.
+                dirnames[:] = [d for d in dirnames if d != '_locale']
+            for name in filenames:
+                yield os.path.join(dirpath, name)
 
     def make_fileapp(self, path):
         self.log.debug('Getting path: %s for locale %s', path, self.locale)
         if self.is_dirty(path):
             self.log.debug('File is dirty, reloading translation.')
             self.reload_translations(path)
-        return super().make_fileapp(self.get_outpath(path))
+        return self._pages[path]
 
     def get_pofiles(self, path):
         """Get pofiles for this path.
@@ -189,44 +370,150 @@ class LocaleApp(DirectoryApp):
     def _get_relpath(self, path):
         return os.path.relpath(path, self.templatedir)
 
-    def get_outpath(self, path):
-        return os.path.join(self.outdir, self._get_relpath(path))
+    def get_render_kw(self, path):
+        """The arguments of render_template for the template path."""
+        return {
+            'pofiles': self.get_pofiles(path),
+            'use_fuzzy': self.use_fuzzy,
+            'mo_cache': self.mo_cache,
+            'locale': self.locale,
+            'known_locales': self.known_locales,
+        }
+
+    def set_page(self, path, text):
+        self._pages[path] = Page(text)
 
     def reload_translations(self, path):
-        translations = gettext.NullTranslations()
-        for pofile in self.get_pofiles(path):
-            # Mo file is in memory.
-            with BytesIO() as mofile, open(pofile) as pofile:
-                # Generate mofile.
-                write_mo(mofile, read_po(pofile), use_fuzzy=self.use_fuzzy)
-                # Return to beginning of mofile.
-                mofile.seek(0)
-                tl = gettext.GNUTranslations(mofile)
-            tl.add_fallback(translations)
-            translations = tl
-
-        def translate(msgid, mapping=None, default=None, **kw):
-            # If no default is given this is not a msgid to translate.
-            if default is None:
-                return msgid
-            translation = translations.gettext(msgid)
-            if translation == msgid:
-                translation = default
-            if '$' in translation and mapping:
-
-                def replace(match):
-                    whole, param1, param2 = match.groups()
-                    return mapping.get(param1 or param2, whole)
-                translation = _interp_regex.sub(replace, translation)
-            return translation
-
-        with open(self.get_outpath(path), 'w') as outpath:
-                template = chameleon.PageTemplateFile(path,
-                                                      translate=translate)
-                outpath.write(template.render(
-                    locale=self.locale,
-                    known_locales=self.known_locales,
-                    json_known_locales=json.dumps(
-                        {str(k).replace('_', '-'): v for k, v in
-                         self.known_locales.items()})
-                ))
+        self.set_page(path, render_template(path, **self.get_render_kw(path)))
+
+
+class Page(object):
+    """A rendered page, served from memory.
+
+    The bowerstatic inclusions of the request are injected in the head
+    of the page. The body, its gzip compressed variant and etag are
+    kept for the last inclusions, as these only change when the
+    versions of the components change.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._variant = None
+
+    def get_variant(self, head=''):
+        """Get the (head, body, gzip body, etag, last modified)."""
+        variant = self._variant
+        if variant is None or variant[0] != head:
+            body = self.text.replace('</head>', head + '</head>')
+            body = body.encode('utf-8')
+            variant = (head, body, gzip.compress(body),
+                       hashlib.sha1(body).hexdigest(), time.time())
+            self._variant = variant
+        return variant
+
+    @webob.dec.wsgify
+    def __call__(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return webob.exc.HTTPMethodNotAllowed(
+                'You cannot {} a page'.format(request.method))
+        inclusions = request.environ.get('bowerstatic.inclusions')
+        head = inclusions.render() if inclusions is not None else ''
+        _, body, gzip_body, etag, last_modified = self.get_variant(head)
+        response = webob.Response(content_type='text/html', charset='utf-8',
+                                  last_modified=last_modified)
+        response.vary = ('Accept-Encoding',)
+        if get_encoding(request, ('gzip',)) == 'gzip':
+            response.body = gzip_body
+            response.content_encoding = 'gzip'
+            response.etag = '{}-gzip'.format(etag)
+        else:
+            response.body = body
+            response.etag = etag
+        return response.conditional_response_app
+
+
+# The translations of a list of po files, by the list and use_fuzzy, with
+# the mo files they are loaded from. Only the translations of the latest
+# content of the po files are kept.
+_translations = {}
+
+
+def get_mofile_name(content, use_fuzzy):
+    """The name of the mo file compiled from the content of a po file."""
+    key = hashlib.sha256(content)
+    key.update(b'fuzzy' if use_fuzzy else b'')
+    return '{}.mo'.format(key.hexdigest())
+
+
+def get_mofile(pofile, use_fuzzy, mo_cache):
+    """The path of the mo file compiled from pofile.
+
+    The mo file is named after the hash of the content of the pofile
+    and use_fuzzy, it is only compiled if it is not in mo_cache yet.
+    """
+    with open(pofile, 'rb') as f:
+        content = f.read()
+    mofile = os.path.join(mo_cache, get_mofile_name(content, use_fuzzy))
+    if not os.path.exists(mofile):
+        with BytesIO() as mo, BytesIO(content) as po:
+            write_mo(mo, read_po(po), use_fuzzy=use_fuzzy)
+            # Write to a temporary file first, so other processes never
+            # read a partial mo file.
+            tmpfile = '{}.{}'.format(mofile, os.getpid())
+            with open(tmpfile, 'wb') as f:
+                f.write(mo.getvalue())
+            os.replace(tmpfile, mofile)
+    return mofile
+
+
+def load_translations(pofiles, use_fuzzy, mo_cache):
+    """The translations of pofiles, falling back from last to first."""
+    mofiles = tuple(get_mofile(pofile, use_fuzzy, mo_cache)
+                    for pofile in pofiles)
+    key = (tuple(pofiles), use_fuzzy)
+    cached = _translations.get(key)
+    if cached is not None and cached[0] == mofiles:
+        return cached[1]
+    translations = gettext.NullTranslations()
+    for mofile in mofiles:
+        with open(mofile, 'rb') as f:
+            tl = gettext.GNUTranslations(f)
+        tl.add_fallback(translations)
+        translations = tl
+    # Replaces the translations of a changed po file.
+    _translations[key] = (mofiles, translations)
+    return translations
+
+
+def render_template(path, pofiles, use_fuzzy, mo_cache, locale,
+                    known_locales):
+    """Render the template path, translated with the pofiles.
+
+    The pofiles are given in order of least to most specific.
+    This is a function, so it can be run in another process.
+    """
+    translations = load_translations(pofiles, use_fuzzy, mo_cache)
+
+    def translate(msgid, mapping=None, default=None, **kw):
+        # If no default is given this is not a msgid to translate.
+        if default is None:
+            return msgid
+        translation = translations.gettext(msgid)
+        if translation == msgid:
+            translation = default
+        if '$' in translation and mapping:
+
+            def replace(match):
+                whole, param1, param2 = match.groups()
+                return mapping.get(param1 or param2, whole)
+            translation = _interp_regex.sub(replace, translation)
+        return translation
+
+    template = chameleon.PageTemplateFile(path, translate=translate)
+    return template.render(
+        locale=locale,
+        known_locales=known_locales,
+        json_known_locales=json.dumps(
+            {str(k).replace('_', '-'): v for k, v in
+             known_locales.items()})
+    )
@@ -0,0 +1,260 @@
+"""Metrics, exposed in the prometheus text format."""
+import asyncio
+import bisect
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+
+def escape(value, quote=True):
+    value = str(value).replace('\\', r'\\').replace('\n', r'\n')
+    if quote:
+        value = value.replace('"', r'\"')
+    return value
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, escape(value))
+                                    for name, value in labels))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """A metric with a value for every combination of label values."""
+
+    type_ = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Expected labels {}, got {}.'.format(
+                self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def samples(self):
+        """Yield the (name, labels, value) of all values."""
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, escape(self.help, False)),
+                 '# TYPE {} {}'.format(self.name, self.type_)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(labels),
+                                          format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+
+    type_ = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+
+    type_ = 'histogram'
+
+    buckets = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1., 2.5, 5.,
+               7.5, 10., float('inf'))
+
+    def __init__(self, name, help, labelnames=(), buckets=None):
+        super().__init__(name, help, labelnames)
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                # Bucket counts, sum and count.
+                self._values[key] = [[0] * len(self.buckets), 0, 0]
+            counts, _, _ = entry = self._values[key]
+            counts[index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """Get the count and sum of the observed values."""
+        _, sum_, count = self._values.get(self._key(labels), (None, 0, 0))
+        return count, sum_
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), sum_, count))
+                            for key, (counts, sum_, count)
+                            in self._values.items())
+        for key, (counts, sum_, count) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield ('{}_bucket'.format(self.name),
+                       labels + [('le', format_value(bound))], cumulative)
+            yield '{}_sum'.format(self.name), labels, sum_
+            yield '{}_count'.format(self.name), labels, count
+
+
+class Registry(object):
+    """A collection of metrics."""
+
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.add(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.add(Histogram(*args, **kwargs))
+
+    def render(self):
+        return ''.join('{}\n'.format(metric.render())
+                       for metric in self.metrics)
+
+
+class AppMetrics(Registry):
+    """The metrics of the rest api."""
+
+    request_labels = ('app', 'model', 'view', 'method')
+
+    def __init__(self):
+        super().__init__()
+        self.requests = self.counter(
+            'asf_requests_total', 'Number of finished requests.',
+            self.request_labels + ('status',))
+        self.request_seconds = self.histogram(
+            'asf_request_duration_seconds', 'Duration of the requests.',
+            self.request_labels)
+        self.requests_in_progress = self.gauge(
+            'asf_requests_in_progress', 'Number of requests in progress.',
+            ('method',))
+        self.commit_seconds = self.histogram(
+            'asf_zodb_commit_duration_seconds',
+            'Duration of the commit of created documents.')
+        self.publish_seconds = self.histogram(
+            'asf_redis_publish_duration_seconds',
+            'Duration of publishing created documents to redis.')
+
+
+class WebsocketMetrics(Registry):
+    """The metrics of the websocket server."""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = self.gauge(
+            'asf_websocket_connections', 'Number of open websockets.')
+        self.queued_events = self.gauge(
+            'asf_websocket_queued_events',
+            'Number of events waiting to be send to the websockets.')
+        self.sent_events = self.counter(
+            'asf_websocket_sent_events_total',
+            'Number of events send to the websockets.')
+        self.dropped_events = self.counter(
+            'asf_websocket_dropped_events_total',
+            'Number of events dropped as the send queue was full.',
+            ('policy',))
+        self.disconnects = self.counter(
+            'asf_websocket_slow_disconnects_total',
+            'Number of websockets closed for not keeping up with events.')
+        self.payload_bytes = self.counter(
+            'asf_websocket_payload_bytes_total',
+            'Bytes of the messages send to compressed websockets.')
+        self.compressed_bytes = self.counter(
+            'asf_websocket_compressed_bytes_total',
+            'Bytes of the messages send to compressed websockets, '
+            'after compression.')
+        self.compression_ratio = self.histogram(
+            'asf_websocket_compression_ratio',
+            'Compressed size of the messages send to a websocket, as '
+            'fraction of their size.',
+            buckets=(.05, .1, .2, .3, .4, .5, .6, .7, .8, .9, 1.))
+
+
+async def handle_metrics_request(registry, reader, writer):
+    """Respond to a http request with the metrics of registry.
+
+    Any request gets the metrics, the request itself is ignored.
+    """
+    try:
+        # Read till the end of the headers.
+        while (await reader.readline()).strip():
+            pass
+        body = registry.render().encode('utf-8')
+        writer.write(
+            'HTTP/1.0 200 OK\r\nContent-Type: {}\r\n'
+            'Content-Length: {}\r\n\r\n'.format(
+                registry.content_type, len(body)).encode('ascii'))
+        writer.write(body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def serve_metrics(registry, host, port, *, loop=None):
+    """Start a http server for the metrics of registry.
+
+    Returns the coroutine starting the asyncio server.
+    """
+    return asyncio.start_server(
+        functools.partial(handle_metrics_request, registry),
+        host=host, port=port, loop=loop)
@@ -1,7 +1,9 @@
 """The abstract salad bar model."""
+import itertools
 import logging
+from urllib.parse import urlencode
 
-from BTrees.OOBTree import BTree
+from BTrees.OOBTree import OOBTree
 
 from dateutil import tz
 
@@ -42,12 +44,68 @@ class Resource(object):
         return json
 
 
-class DocumentCollection(BTree, Resource):
+class DocumentCollection(persistent.Persistent, Resource):
+    """A collection of documents, by their id.
+
+    The documents are kept in a BTree of their own, not in the state of
+    the collection. The collection itself does not change when a
+    document is added, so concurrent adds are resolved by the conflict
+    resolution of the BTree.
+    """
 
     # schema itemList
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
+        self.documents = OOBTree()
+
+    def __setstate__(self, state):
+        if isinstance(state, dict) and 'documents' in state:
+            super().__setstate__(state)
+            return
+        # The state of a collection stored when it was a BTree itself,
+        # the documents are moved into a BTree of their own.
+        attributes = {'parent': None}
+        if isinstance(state, dict) and 'btree' in state:
+            attributes.update(state['attributes'])
+            state = state['btree']
+        documents = OOBTree()
+        if state is not None:
+            documents.__setstate__(state)
+        attributes['documents'] = documents
+        super().__setstate__(attributes)
+        # Stored by upgrade_collections.
+        self._v_upgraded = True
+
+    def __getitem__(self, key):
+        return self.documents[key]
+
+    def __setitem__(self, key, value):
+        self.documents[key] = value
+
+    def __delitem__(self, key):
+        del self.documents[key]
+
+    def __contains__(self, key):
+        return key in self.documents
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def get(self, key, default=None):
+        return self.documents.get(key, default)
+
+    def keys(self, *args, **kwargs):
+        return self.documents.keys(*args, **kwargs)
+
+    def values(self, *args, **kwargs):
+        return self.documents.values(*args, **kwargs)
+
+    def items(self, *args, **kwargs):
+        return self.documents.items(*args, **kwargs)
 
     def add(self, obj):
         self[obj.id] = obj
@@ -61,20 +119,31 @@ class DocumentCollection(BTree, Resource):
         root indicates if this is the root object to be json dumped,
         children objects should have root set to false.
         """
+        if root:
+            documents, next_key = self.get_page(request)
+        else:
+            documents, next_key = self.values(), None
+        json = {
+            'itemListElement': [self.dump_json_item(v, request, root)
+                                for v in documents],
+        }
+        json.update(self.dump_json_list(request, root, next_key))
+        return json
+
+    def dump_json_item(self, document, request, root=True):
+        """Dump the json of a document in the itemListElement."""
         # Do not try and show the whole tree, as this gives problems with
         # linking to the correct children objects.
         if root and request.params.get('children'):
-            def item_function(document):
-                return document.dump_json(request, False)
-        else:
-            def item_function(document):
-                return {
-                    '@id': request.link(document),
-                    '@type': document.schema_type,
-                }
-        json = {
-            'itemListElement': [item_function(v) for v in self.values()],
+            return document.dump_json(request, False)
+        return {
+            '@id': request.link(document),
+            '@type': document.schema_type,
         }
+
+    def dump_json_list(self, request, root=True, next_key=None):
+        """Dump the json of the list, without the itemListElement."""
+        json = {}
         if root:
             json.update({
                 'websocket': {
@@ -84,12 +153,133 @@ class DocumentCollection(BTree, Resource):
                     .replace('http', 'ws').replace('5000', '8080')
                 },
             })
+        if next_key is not None:
+            json.update({
+                'next': {
+                    '@type': 'url',
+                    '@value': self.link_page(request, next_key),
+                },
+            })
         json.update(super().dump_json(request, root))
         return json
 
+    def get_page(self, request):
+        """Get the documents of the page requested.
+
+        The page starts after the key given by the "after" parameter and
+        contains at most "limit" documents. Only the documents of the
+        page are loaded from the BTree.
+        Returns an iterable of the documents and the key to get the next
+        page, which is None if this is the last page.
+        """
+        items = self.iter_items(request, request.params.get('after'))
+        limit = get_limit(request)
+        if limit is None:
+            return (v for k, v in items), None
+        # Get one extra item, to know if there is a next page.
+        items = list(itertools.islice(items, limit + 1))
+        next_key = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_key = items[-1][0]
+        return [v for k, v in items], next_key
+
+    def iter_items(self, request, after=None):
+        """Iterate over the (key, document) pairs to list.
+
+        Starts after the document with key after, if given.
+        """
+        if after:
+            return self.items(min=after, excludemin=True)
+        return self.items()
+
+    def link_page(self, request, after):
+        """Link to the page after the key "after"."""
+        params = [(k, v) for k, v in request.params.items() if k != 'after']
+        params.append(('after', after))
+        return '{}?{}'.format(request.link(self), urlencode(params))
+
+
+def get_limit(request):
+    """Get the page size of the request, or None if not given."""
+    try:
+        limit = int(request.params.get('limit', ''))
+    except ValueError:
+        return None
+    if limit < 1:
+        log().debug('Ignoring invalid limit %s.', limit)
+        return None
+    return limit
+
+
+def get_datetime(request, name):
+    """Get the datetime parameter name of the request in UTC.
+
+    Returns None if the parameter is not given or invalid. A datetime
+    without timezone is taken to be in UTC.
+    """
+    value = request.params.get(name)
+    if not value:
+        return None
+    try:
+        date = iso8601.parse_date(value)
+    except iso8601.ParseError as e:
+        log().debug('Ignoring invalid %s date: %s.', name, e)
+        return None
+    return date.astimezone(tz.tzutc())
+
 
 class SaladCollection(DocumentCollection):
-    pass
+
+    @property
+    def start_time_index(self):
+        """Index of the salads, keyed by (start_time, id)."""
+        return self._start_time_index
+
+    def create_start_time_index(self):
+        """Create the start_time_index, if the collection has none.
+
+        Called when the root is created and once at startup for a
+        collection stored without one, so requests only read the index.
+        Returns True if the index was created.
+        """
+        if getattr(self, '_start_time_index', None) is not None:
+            return False
+        index = OOBTree()
+        for salad in self.values():
+            index[(salad.start_time, salad.id)] = salad
+        self._start_time_index = index
+        return True
+
+    def add(self, obj):
+        obj = super().add(obj)
+        self.start_time_index[(obj.start_time, obj.id)] = obj
+        return obj
+
+    def iter_items(self, request, after=None):
+        """Iterate over the salads between the from and to parameters.
+
+        If any of them is given, the salads starting at or after
+        "from" and before "to" are read from the start_time index, in
+        order of start time.
+        """
+        start = get_datetime(request, 'from')
+        end = get_datetime(request, 'to')
+        if start is None and end is None:
+            return super().iter_items(request, after)
+        # Keys are (start_time, id) tuples, a tuple with only a
+        # start_time sorts before all keys with that start_time.
+        min_key = None if start is None else (start,)
+        max_key = None if end is None else (end,)
+        excludemin = False
+        if after:
+            salad = self.get(after)
+            if salad is not None:
+                min_key = max((salad.start_time, salad.id), min_key or ())
+                excludemin = True
+        items = self.start_time_index.items(min=min_key, max=max_key,
+                                            excludemin=excludemin)
+        return ((key[1], salad) for key, salad in items)
 
 
 class IngredientCollection(DocumentCollection):
@@ -244,11 +434,51 @@ class CommentDocument(Document):
     pass
 
 
+class DocumentBatch(list):
+    """A list of new documents, created in one request."""
+
+    @classmethod
+    def load_json(cls, document_class, json, request=None):
+        """Load every object in the json list as a document_class.
+
+        If the list is empty or any of the objects is not valid, the
+        json is returned.
+        """
+        if not json or not all(hasattr(item, 'get') for item in json):
+            return json
+        documents = [document_class.load_json(item, request)
+                     for item in json]
+        if all(isinstance(document, document_class)
+               for document in documents):
+            return cls(documents)
+        return json
+
+
 class RootDocument(Document):
 
     def __init__(self):
         super().__init__()
         self.salads = SaladCollection(self)
+        self.salads.create_start_time_index()
+
+    def upgrade_collections(self):
+        """Store the collections that were stored as a BTree again.
+
+        Their parent, which was not stored with the BTree, is set again.
+        Run once at startup. Returns the number of upgraded collections.
+        """
+        collections = [(self, self.salads)]
+        for salad in self.salads.values():
+            collections.extend((salad, collection) for collection in
+                               (salad.ingredients, salad.comments))
+        count = 0
+        for parent, collection in collections:
+            collection._p_activate()
+            if getattr(collection, '_v_upgraded', False):
+                collection.parent = parent
+                collection._p_changed = True
+                count += 1
+        return count
 
     def dump_json(self, request, root=True):
         json = {
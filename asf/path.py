@@ -2,6 +2,7 @@ import logging
 
 from . import app
 from .config import config
+from . import metrics
 from . import model
 
 import webob
@@ -12,6 +13,11 @@ def get_root_path(request):
     return request.app.db
 
 
+@app.RootApp.path(model=metrics.AppMetrics, path='_metrics')
+def get_metrics_path(request):
+    return request.app.metrics
+
+
 @app.ResourceApp.path(model=model.DocumentCollection, path='')
 def get_collection_path(request):
     return request.app.db
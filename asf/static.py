@@ -1,15 +1,53 @@
+from datetime import datetime
 import logging
 
 import bowerstatic
-from bowerstatic.autoversion import get_latest_filesystem_datetime
+from bowerstatic import renderer
+from bowerstatic.autoversion import filesystem_second_autoversion
 
 import webob
-from webob.static import DirectoryApp
 
+from .compress import (CompressedDirectoryApp, CompressedPublisherTween,
+                       CompressedStore)
 from . import locale
+from .watch import LatestModified
 
 
-bower = bowerstatic.Bower()
+# The LatestModified of the local components, by path.
+latest_modified = {}
+
+
+def autoversion(path):
+    """The version of a local component.
+
+    Uses the cached latest modification time of the component, so the
+    files are not walked for every url of the component.
+    """
+    if path not in latest_modified:
+        return filesystem_second_autoversion(path)
+    return datetime.fromtimestamp(latest_modified[path].value).replace(
+        microsecond=0).isoformat()
+
+
+def url_renderer(template):
+    """Render the inclusion of a resource with only its url.
+
+    The renderers of bowerstatic read the content of the resource, even
+    if it is not used.
+    """
+    def render(resource):
+        return template.format(url=resource.url())
+    return render
+
+
+bower = bowerstatic.Bower(autoversion=autoversion)
+for ext, template in (('.js', renderer.render_js),
+                      ('.css', renderer.render_css),
+                      ('.ico', renderer.render_favicon),
+                      ('.gif', renderer.render_favicon),
+                      ('.png', renderer.render_favicon),
+                      ('.jpg', renderer.render_favicon)):
+    bower.register_renderer(ext, url_renderer(template))
 
 components = bower.components(
     'components',
@@ -24,16 +62,54 @@ asb_component = local.component(
     bowerstatic.module_relative_path('local_component'),
     version=None)
 
-static = DirectoryApp(bowerstatic.module_relative_path('static'))
+static_path = bowerstatic.module_relative_path('static')
+
+
+def vary_tween(handler, *headers):
+    """Add headers to the Vary header of the responses of handler."""
+    def tween(request):
+        response = handler(request)
+        response.vary = tuple(response.vary or ()) + headers
+        return response
+    return tween
 
 
-def get_static(app, tempdir):
+def get_static(app, tempdir, production=False, watch_interval=1.0,
+               store=None, precompile=False, processes=None,
+               mo_cache=None):
+    """Wrap app, serving the static files and the localized pages.
+
+    In production the local component and the templates are not
+    expected to change, so they are only read at startup. Else they
+    are watched for changes by background watchers, checking every
+    watch_interval seconds.
+    The static files and components are served compressed, using the
+    compressed variants of store. In production these are created at
+    startup.
+    If precompile is set, all localized pages are rendered at startup
+    in processes worker processes. The compiled translations are
+    cached in the mo_cache directory, by default in tempdir.
+    """
 
     log = logging.getLogger(__name__)
 
+    if store is None:
+        store = CompressedStore()
+    if production:
+        store.precompress(components.path, asb_component.path, static_path)
+    static = CompressedDirectoryApp(static_path, store)
+
     locale.LocaleApp.initialize(bowerstatic.module_relative_path('template'),
                                 bowerstatic.module_relative_path('locale'),
-                                tempdir)
+                                tempdir, precompile=precompile,
+                                processes=processes, frozen=production,
+                                watch_interval=watch_interval,
+                                mo_cache=mo_cache)
+
+    if asb_component.path not in latest_modified:
+        latest_modified[asb_component.path] = LatestModified(
+            asb_component.path, frozen=production, interval=watch_interval)
+        latest_modified[asb_component.path].start()
 
     @webob.dec.wsgify
     def app_with_static(request):
@@ -44,32 +120,8 @@ def get_static(app, tempdir):
                 return request.get_response(app)
             return handler
 
-        log.debug('Request Environ: %s', request.environ)
-        include = local.includer(request.environ)
-        include('normalize-css')
-        include('uikit')
-        include('font-awesome/css/font-awesome.css')
-        include('asb/js/asb.js')
-        include('asb/js/index.js')
-        include('asb/js/util.js')
-        include('asb/css/asb.css')
-        if asb_component.autoversion:
-            bower_timestamp = get_latest_filesystem_datetime(
-                asb_component.path
-            ).timestamp()
-        else:
-            bower_timestamp = None
-        peek = request.path_info_peek()
-        log.debug('First part of path_info: %s', peek)
-        if peek == 'api':
-            log.debug('Going into api')
-            request.path_info_pop()
-            log.debug('Path in api: %r', request.path_info)
-            handler = create_handler(app)
-        elif peek.replace('_', '-').lower() in \
-                locale.LocaleApp.known_languages:
-            locale_app = locale.LocaleApp.get_app(peek)
-            request.path_info_pop()
+        def create_locale_handler(language):
+            locale_app = locale.LocaleApp.get_app(language)
             # Include dependencies.
             include('jquery')
             include('jquery-serialize-object')
@@ -87,27 +139,48 @@ def get_static(app, tempdir):
                     pass
             else:
                 log.debug('Failed to load "moment" locale file for "%s".',
-                          peek)
-            # Load locale app.
-            if bower_timestamp:
-                locale_app.bust_cache(bower_timestamp)
-            handler = create_handler(locale_app)
-            # Add injector tween.
-            handler = bowerstatic.InjectorTween(bower, handler)
+                          language)
+            # Load locale app, its pages inject the inclusions.
+            return create_handler(locale_app)
+
+        log.debug('Request Environ: %s', request.environ)
+        include = local.includer(request.environ)
+        include('normalize-css')
+        include('uikit')
+        include('font-awesome/css/font-awesome.css')
+        include('asb/js/asb.js')
+        include('asb/js/index.js')
+        include('asb/js/util.js')
+        include('asb/css/asb.css')
+        peek = request.path_info_peek()
+        log.debug('First part of path_info: %s', peek)
+        if peek == 'api':
+            log.debug('Going into api')
+            request.path_info_pop()
+            log.debug('Path in api: %r', request.path_info)
+            handler = create_handler(app)
+        elif locale.LocaleApp.find_language(peek):
+            request.path_info_pop()
+            handler = create_locale_handler(peek)
         elif not peek or peek == 'index.html':
-            # Index file, load index template.
-            locale_app = locale.LocaleApp.get_app(None)
-            # Bust cache if local component is newer.
-            if bower_timestamp:
-                locale_app.bust_cache(bower_timestamp)
-            handler = create_handler(locale_app)
-            # Add injector tween.
-            handler = bowerstatic.InjectorTween(bower, handler)
+            # Index file, serve the page of the language the user chose,
+            # kept in the locale cookie, or else of the Accept-Language
+            # header, or else the index template.
+            language = locale.LocaleApp.find_language(
+                request.cookies.get('locale', ''))
+            if language is None:
+                language = locale.LocaleApp.negotiate(
+                    request.headers.get('Accept-Language'))
+            if language is not None:
+                handler = create_locale_handler(language)
+            else:
+                handler = create_handler(locale.LocaleApp.get_app(None))
+            handler = vary_tween(handler, 'Accept-Language', 'Cookie')
         else:
             # Return static files.
             handler = create_handler(static)
             # Add publisher tween.
-            handler = bowerstatic.PublisherTween(bower, handler)
+            handler = CompressedPublisherTween(bower, handler, store)
         return handler(request)
 
     return app_with_static
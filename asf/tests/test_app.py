@@ -1,15 +1,222 @@
+import json
+from unittest import mock
+
 import morepath
+
+import pytest
+
+from webob import Request
+
+import ZODB
+
 import asf
+from asf.model import RootDocument
+
+
+@pytest.fixture(scope='module')
+def committed():
+    morepath.scan(asf)
+    asf.App.commit()
+
+
+@pytest.fixture()
+def database():
+    db = ZODB.DB(None)
+    with db.transaction() as connection:
+        connection.root()['root'] = RootDocument()
+    yield db
+    db.close()
+
+
+@pytest.fixture()
+def app(committed, database):
+    return asf.App(database, mock.Mock())
+
+
+def post_json(app, path, data):
+    request = Request.blank(path, method='POST',
+                            body=json.dumps(data).encode('utf-8'),
+                            content_type='application/json')
+    return request.get_response(app)
+
+
+def test_get_root(app):
+    response = Request.blank('/').get_response(app)
+    assert response.status_code == 200
+    assert response.json['@type'] == 'Thing'
+
+
+def test_connection_per_request(app, database):
+    response = post_json(app, '/salads',
+                         {'@type': 'FoodEvent',
+                          'startDate': '2017-03-04T17:26-05:00'})
+    assert response.status_code == 200
+    # The connection is returned to the pool after the request.
+    assert not hasattr(app._local, 'connection')
+    assert all(c.opened is None for c in database.pool.all)
+    with database.transaction() as connection:
+        salads = connection.root()['root'].salads
+        assert len(salads) == 1
+        assert salads.parent is connection.root()['root']
+    response = Request.blank('/salads').get_response(app)
+    assert len(response.json['itemListElement']) == 1
+
+
+def test_salads_from_to(app):
+    for date in ('2017-03-04T17:26-05:00', '2017-03-01T17:26-05:00',
+                 '2017-03-08T17:26-05:00'):
+        post_json(app, '/salads', {'@type': 'FoodEvent', 'startDate': date})
+    response = Request.blank(
+        '/salads?from=2017-03-01&to=2017-03-07&children=1'
+    ).get_response(app)
+    dates = [item['startDate'] for item in response.json['itemListElement']]
+    assert dates == ['2017-03-01T22:26:00+00:00',
+                     '2017-03-04T22:26:00+00:00']
+
+
+def test_salads_from_to_read_only(app, database):
+    post_json(app, '/salads', {'@type': 'FoodEvent',
+                               'startDate': '2017-03-04T17:26-05:00'})
+    last = database.lastTransaction()
+    response = Request.blank('/salads?from=2017-03-01').get_response(app)
+    assert len(response.json['itemListElement']) == 1
+    # Reading the start time index does not write.
+    assert database.lastTransaction() == last
+
+
+@pytest.mark.parametrize('query', [
+    '', 'children=1', 'limit=2', 'limit=2&children=1'
+])
+def test_salads_stream(app, query):
+    for date in ('2017-03-04T17:26-05:00', '2017-03-01T17:26-05:00',
+                 '2017-03-08T17:26-05:00'):
+        post_json(app, '/salads', {'@type': 'FoodEvent', 'startDate': date})
+    expected = Request.blank(
+        '/salads?{}'.format(query)
+    ).get_response(app).json
+    response = Request.blank(
+        '/salads?stream=1&{}'.format(query)
+    ).get_response(app)
+    # The connection is kept open till the response is send.
+    assert app._local.connection.opened
+    result = response.json
+    assert not hasattr(app._local, 'connection')
+    if 'next' in result:
+        next_ = result.pop('next')['@value']
+        assert next_.replace('stream=1&', '') == \
+            expected.pop('next')['@value']
+    assert result == expected
+
+
+def test_document_cache(app):
+    salad = post_json(app, '/salads',
+                      {'@type': 'FoodEvent',
+                       'startDate': '2017-03-04T17:26-05:00'}).json
+    path = salad['@id'].replace('http://localhost', '')
+    cache = app.representation_cache
+    responses = [Request.blank(path).get_response(app) for i in range(3)]
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert all(r.json == salad for r in responses)
+    assert all(r.content_type == 'application/json' for r in responses)
+    # Documents with children are not cached.
+    Request.blank(path + '?children=1').get_response(app)
+    assert (cache.hits, cache.misses) == (2, 1)
+    # A different host gives a new representation.
+    response = Request.blank(path, host='example.com').get_response(app)
+    assert response.json['@id'].startswith('http://example.com/')
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_create_documents(app, database):
+    salad = post_json(app, '/salads',
+                      {'@type': 'FoodEvent',
+                       'startDate': '2017-03-04T17:26-05:00'}).json
+    path = salad['@id'].replace('http://localhost', '') + '/ingredients'
+    app.redis.reset_mock()
+    names = ['lettuce', 'tomato', 'olive']
+    response = post_json(app, path, [
+        {'@type': 'Offer', 'name': name, 'seller': 'me'} for name in names
+    ])
+    assert response.status_code == 200
+    assert [item['itemOffered']['name'] for item in response.json] == names
+    pipeline = app.redis.pipeline.return_value
+    assert pipeline.execute.call_count == 1
+    assert pipeline.publish.call_count == 3
+    published = [json.loads(c[0][1]) for c in pipeline.publish.call_args_list]
+    assert [event['data']['itemOffered']['name'] for event in published] == \
+        names
+    with database.transaction() as connection:
+        salads = connection.root()['root'].salads
+        ingredients = salads[salad['@id'].rpartition('/')[2]].ingredients
+        assert sorted(i.name for i in ingredients.values()) == sorted(names)
+
+
+def test_publish_event_stream(committed, database):
+    app = asf.App(database, mock.Mock(), event_stream=mock.Mock())
+    post_json(app, '/salads', {'@type': 'FoodEvent',
+                               'startDate': '2017-03-04T17:26-05:00'})
+    pipeline = app.redis.pipeline.return_value
+    assert not pipeline.publish.called
+    assert pipeline.execute.call_count == 1
+    (client, channel, message), _ = app.event_stream.publish.call_args
+    assert client is pipeline
+    assert channel == '/salads'
+    assert json.loads(message)['type'] == 'CREATE'
+
+
+def test_create_documents_invalid(app, database):
+    response = post_json(app, '/salads', [
+        {'@type': 'FoodEvent', 'startDate': '2017-03-04T17:26-05:00'},
+        {'@type': 'FoodEvent'},
+    ])
+    assert response.status_code == 422
+    assert not app.redis.pipeline.called
+    with database.transaction() as connection:
+        assert len(connection.root()['root'].salads) == 0
+
 
-# from webtest import TestApp as Client
+def test_metrics(app):
+    Request.blank('/').get_response(app)
+    Request.blank('/salads').get_response(app)
+    post_json(app, '/salads', {'@type': 'FoodEvent',
+                               'startDate': '2017-01-01T12:00:00+00:00'})
+    response = Request.blank('/_metrics').get_response(app)
+    assert response.status_code == 200
+    assert response.content_type == 'text/plain'
+    requests = app.metrics.requests
+    assert requests.get(app='RootApp', model='RootDocument', view='',
+                        method='GET', status=200) == 1
+    assert requests.get(app='SaladsApp', model='SaladCollection', view='',
+                        method='POST', status=200) == 1
+    assert app.metrics.commit_seconds.get()[0] == 1
+    assert app.metrics.publish_seconds.get()[0] == 1
+    assert app.metrics.requests_in_progress.get(method='POST') == 0
+    assert ('asf_requests_total{app="SaladsApp",model="SaladCollection",'
+            'view="",method="GET",status="200"} 1.0') in response.text
 
 
-# def test_root():
-#     morepath.scan(asf)
-#     morepath.commit(asf.App)
+def test_metrics_stream(app):
+    response = Request.blank('/salads?stream=1').get_response(app)
+    # A streaming response is in progress till it is send.
+    assert app.metrics.requests_in_progress.get(method='GET') == 1
+    assert not list(app.metrics.requests.samples())
+    response.json
+    assert app.metrics.requests_in_progress.get(method='GET') == 0
+    assert app.metrics.requests.get(app='SaladsApp', model='SaladCollection',
+                                    view='', method='GET', status=200) == 1
 
-#     client = Client(asf.App())
-#     root = client.get('/')
 
-#     assert root.status_code == 200
-#     assert len(root.json['greetings']) == 2
+def test_metrics_not_found(app):
+    for path in ('/salads/a', '/salads/b', '/salads/+c'):
+        assert Request.blank(path).get_response(app).status_code == 404
+    Request.blank('/salads/d', method='BREW').get_response(app)
+    # Unknown paths and methods do not add labels.
+    samples = list(app.metrics.requests.samples())
+    assert len(samples) == 3
+    requests = app.metrics.requests
+    assert requests.get(app='SaladsApp', model='', view='unmatched',
+                        method='GET', status=404) == 2
+    assert requests.get(app='SaladsApp', model='SaladCollection',
+                        view='unmatched', method='GET', status=404) == 1
+    assert requests.get(app='SaladsApp', model='', view='unmatched',
+                        method='other', status=404) == 1
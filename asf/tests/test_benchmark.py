@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from asf import benchmark
+
+
+def test_local_pubsub(event_loop):
+    pubsub = benchmark.LocalPubSub(loop=event_loop)
+
+    async def run():
+        await pubsub.subscribe('/api/a', '/api/b')
+        await pubsub.unsubscribe('/api/b')
+        await pubsub.psubscribe('/api/*')
+        counts = [await pubsub.publish(path, 'data')
+                  for path in ('/api/a', '/api/b', '/other')]
+        messages = []
+        while not pubsub.queue.empty():
+            messages.append(await pubsub.listen())
+        return counts, messages
+
+    counts, messages = event_loop.run_until_complete(run())
+    assert counts == [2, 1, 0]
+    assert messages == [
+        {'type': 'message', 'channel': '/api/a', 'data': 'data'},
+        {'type': 'pmessage', 'pattern': '/api/*', 'channel': '/api/a',
+         'data': 'data'},
+        {'type': 'pmessage', 'pattern': '/api/*', 'channel': '/api/b',
+         'data': 'data'},
+    ]
+
+
+@pytest.mark.parametrize('percent, expected', [
+    (0, 1), (50, 5), (90, 9), (99, 10), (100, 10),
+])
+def test_percentile(percent, expected):
+    assert benchmark.percentile(list(range(1, 11)), percent) == expected
+
+
+def test_percentile_empty():
+    assert benchmark.percentile([], 50) is None
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_benchmark(batch):
+    results = benchmark.benchmark(clients=4, paths=2, rate=100,
+                                  duration=0.1, batch=batch)
+    assert results['published'] == 10
+    assert results['expected'] == results['delivered'] == 20
+    assert results['latency']['50'] <= results['latency']['100']
+    json.dumps(results)
+    text = benchmark.format_results(results)
+    assert 'delivered: 20 of 20 events' in text
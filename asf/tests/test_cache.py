@@ -0,0 +1,91 @@
+import persistent
+
+import pytest
+
+import transaction
+
+import ZODB
+
+from asf import cache
+
+
+class TestRepresentationCache:
+
+    def test_get_set(self):
+        c = cache.RepresentationCache()
+        assert c.get('key', 1) is None
+        c.set('key', 1, b'value')
+        assert c.get('key', 1) == b'value'
+        assert (c.hits, c.misses) == (1, 1)
+
+    def test_serial_changed(self):
+        c = cache.RepresentationCache()
+        c.set('key', 1, b'value')
+        assert c.get('key', 2) is None
+        c.set('key', 2, b'new value')
+        assert c.get('key', 2) == b'new value'
+        assert len(c) == 1
+        assert c.size == len(b'new value')
+
+    def test_max_bytes(self):
+        c = cache.RepresentationCache(max_bytes=10)
+        c.set('a', 1, b'12345')
+        c.set('b', 1, b'12345')
+        # Use a, so b is the least recently used.
+        c.get('a', 1)
+        c.set('c', 1, b'12345')
+        assert c.get('a', 1) == b'12345'
+        assert c.get('b', 1) is None
+        assert c.get('c', 1) == b'12345'
+        assert c.size == 10
+
+    def test_too_large(self):
+        c = cache.RepresentationCache(max_bytes=4)
+        c.set('a', 1, b'12345')
+        assert len(c) == 0
+
+    def test_clear(self):
+        c = cache.RepresentationCache()
+        c.set('a', 1, b'12345')
+        c.clear()
+        assert len(c) == 0
+        assert c.size == 0
+
+
+class TestDocumentKey:
+
+    @pytest.fixture
+    def connection(self):
+        db = ZODB.DB(None)
+        connection = db.open()
+        yield connection
+        transaction.abort()
+        connection.close()
+        db.close()
+
+    def test_new_document(self):
+        assert cache.document_key(persistent.Persistent()) is None
+
+    def test_committed_document(self, connection):
+        document = connection.root()['document'] = persistent.Persistent()
+        transaction.commit()
+        key, serial = cache.document_key(document, 'variant')
+        assert key == (document._p_oid, 'variant')
+        assert serial == document._p_serial
+
+    def test_changed_document(self, connection):
+        document = connection.root()['document'] = persistent.Persistent()
+        transaction.commit()
+        _, serial = cache.document_key(document)
+        document._p_changed = True
+        assert cache.document_key(document) is None
+        transaction.commit()
+        assert cache.document_key(document)[1] != serial
+
+    def test_ghost(self, connection):
+        connection.root()['document'] = persistent.Persistent()
+        transaction.commit()
+        document = connection.root()['document']
+        serial = document._p_serial
+        document._p_invalidate()
+        assert cache.document_key(document)[1] == serial
@@ -0,0 +1,116 @@
+import gzip
+from unittest import mock
+
+import pytest
+
+from webob import Request, Response
+
+from asf import compress
+
+
+CONTENT = b'var salad = "abstract";\n' * 100
+
+
+@pytest.fixture()
+def store():
+    return compress.CompressedStore()
+
+
+@pytest.fixture()
+def directory(tmpdir):
+    tmpdir.join('app.js').write_binary(CONTENT)
+    tmpdir.join('small.js').write_binary(b'var a;')
+    tmpdir.join('image.png').write_binary(CONTENT)
+    return tmpdir
+
+
+@pytest.mark.parametrize('header,encoding', [
+    (None, None),
+    ('gzip, deflate', 'gzip'),
+    ('gzip;q=0', None),
+    ('identity', None),
+    ('deflate', None),
+])
+def test_get_encoding(header, encoding):
+    headers = {} if header is None else {'Accept-Encoding': header}
+    request = Request.blank('/', headers=headers)
+    assert compress.get_encoding(request, ('gzip',)) == encoding
+
+
+def test_store_get(store, directory):
+    filename = str(directory.join('app.js'))
+    value = store.get(filename, 'gzip')
+    assert gzip.decompress(value) == CONTENT
+    with mock.patch.object(compress, 'COMPRESSORS', {}):
+        # Cached, so not compressed again.
+        assert store.get(filename, 'gzip') == value
+
+
+def test_store_changed(store, directory):
+    filename = str(directory.join('app.js'))
+    store.get(filename, 'gzip')
+    directory.join('app.js').write_binary(CONTENT * 2)
+    assert gzip.decompress(store.get(filename, 'gzip')) == CONTENT * 2
+
+
+def test_store_small(store, directory):
+    assert store.get(str(directory.join('small.js')), 'gzip') is None
+
+
+def test_store_incompressible(store, tmpdir):
+    tmpdir.join('random.js').write_binary(bytes(range(256)))
+    assert store.get(str(tmpdir.join('random.js')), 'gzip') is None
+
+
+def test_precompress(store, directory):
+    store.precompress(str(directory))
+    # Only app.js, small.js is too small and image.png not compressible.
+    assert len(store.cache) == len(compress.ENCODINGS)
+
+
+def test_directory_app(store, directory):
+    app = compress.CompressedDirectoryApp(str(directory), store)
+    request = Request.blank('/app.js', headers={'Accept-Encoding': 'gzip'})
+    response = request.get_response(app)
+    assert response.status_code == 200
+    assert response.content_encoding == 'gzip'
+    assert response.vary == ('Accept-Encoding',)
+    assert gzip.decompress(response.body) == CONTENT
+    request = Request.blank('/app.js', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': response.etag})
+    assert request.get_response(app).status_code == 304
+
+
+def test_directory_app_identity(store, directory):
+    app = compress.CompressedDirectoryApp(str(directory), store)
+    response = Request.blank('/app.js').get_response(app)
+    assert response.content_encoding is None
+    assert response.vary == ('Accept-Encoding',)
+    assert response.body == CONTENT
+
+
+def test_directory_app_not_compressible(store, directory):
+    app = compress.CompressedDirectoryApp(str(directory), store)
+    request = Request.blank('/image.png', headers={'Accept-Encoding': 'gzip'})
+    response = request.get_response(app)
+    assert response.content_encoding is None
+    assert response.vary is None
+    assert response.body == CONTENT
+
+
+def test_publisher_tween(store):
+    from asf.static import bower, components
+    version = components.get_component('jquery').version
+    handler = mock.Mock(return_value=Response('handler'))
+    tween = compress.CompressedPublisherTween(bower, handler, store)
+    request = Request.blank(
+        '/bowerstatic/components/jquery/{}/dist/jquery.js'.format(version),
+        headers={'Accept-Encoding': 'gzip'})
+    response = tween(request)
+    assert response.content_encoding == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert not handler.called
+    assert tween(Request.blank('/other')).text == 'handler'
+    request = Request.blank('/bowerstatic/components/jquery/{}/missing.js'
+                            .format(version))
+    assert tween(request).status_code == 404
@@ -0,0 +1,33 @@
+from unittest import mock
+
+import pytest
+
+from asf import events
+
+
+def test_stream_key():
+    assert events.stream_key('/api/salads') == 'asf:events:/api/salads'
+
+
+@pytest.mark.parametrize('event_id, expected', [
+    ('1518951480106-0', (1518951480106, 0)),
+    ('1518951480106-12', (1518951480106, 12)),
+    ('1518951480106', (1518951480106, 0)),
+])
+def test_parse_id(event_id, expected):
+    assert events.parse_id(event_id) == expected
+
+
+@pytest.mark.parametrize('event_id', ['', '-1', 'a-0', '1-b', '1-2-3'])
+def test_parse_id_invalid(event_id):
+    with pytest.raises(ValueError):
+        events.parse_id(event_id)
+
+
+def test_event_stream_publish():
+    stream = events.EventStream(max_len=10)
+    pipeline = mock.Mock()
+    stream.publish(pipeline, '/api/salads', '{"type":"CREATE"}')
+    pipeline.eval.assert_called_once_with(
+        events.PUBLISH_SCRIPT, 1, 'asf:events:/api/salads',
+        '/api/salads', '{"type":"CREATE"}', 10)
@@ -0,0 +1,290 @@
+import gzip
+import os
+import shutil
+import time
+from unittest import mock
+
+import pytest
+
+from webob import Request
+
+from asf import locale
+
+
+@pytest.fixture()
+def locale_app(tmpdir, monkeypatch):
+    """LocaleApp, using a copy of the templates and locales."""
+    package = os.path.dirname(locale.__file__)
+    templatedir = str(tmpdir.join('template'))
+    localedir = str(tmpdir.join('locale'))
+    shutil.copytree(os.path.join(package, 'template'), templatedir)
+    shutil.copytree(os.path.join(package, 'locale'), localedir)
+    tmpdir.mkdir('out')
+    # Reset the class state, as it is initialized once.
+    monkeypatch.setattr(locale.LocaleApp, '_initialized', False)
+    monkeypatch.setattr(locale.LocaleApp, 'locales', {})
+    monkeypatch.setattr(locale.LocaleApp, 'known_locales',
+                        dict(locale.LocaleApp.known_locales))
+    monkeypatch.setattr(locale.LocaleApp, 'frozen', False)
+    monkeypatch.setattr(locale.LocaleApp, '_watcher', None)
+    monkeypatch.setattr(locale.LocaleApp, '_generation', 0)
+    monkeypatch.setattr(locale.LocaleApp, 'language_table', {})
+    monkeypatch.setattr(locale.LocaleApp, '_negotiated', {})
+    yield locale.LocaleApp, templatedir, localedir, str(tmpdir.join('out'))
+    if locale.LocaleApp._watcher is not None:
+        locale.LocaleApp._watcher.stop()
+
+
+@pytest.mark.parametrize('header,languages', [
+    ('', []),
+    ('nl', ['nl']),
+    ('nl-NL, en;q=0.5, de;q=0.8', ['nl-NL', 'de', 'en']),
+    ('en;q=0.5, nl;q=0.5', ['en', 'nl']),
+    ('*, nl;q=0, en;q=invalid, fr;level=1;q=0.3', ['fr']),
+])
+def test_parse_accept_language(header, languages):
+    assert locale.parse_accept_language(header) == languages
+
+
+@pytest.mark.parametrize('header,language', [
+    (None, None),
+    ('fr', None),
+    ('nl', 'nl'),
+    ('NL_nl', 'nl-NL'),
+    ('nl-BE', 'nl'),
+    ('fr, en-GB;q=0.9, nl;q=0.8', 'en'),
+    ('de-CH, nl-NL;q=0.5', 'nl-NL'),
+])
+def test_negotiate(locale_app, header, language):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir, frozen=True)
+    assert cls.negotiate(header) == language
+    # Cached.
+    with mock.patch.object(locale, 'parse_accept_language'):
+        assert cls.negotiate(header) == language
+
+
+def test_find_language(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir, frozen=True)
+    assert cls.find_language('nl_nl') == 'nl-NL'
+    assert cls.find_language('EN') == 'en'
+    assert cls.find_language('api') is None
+
+
+def test_get_templates(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir)
+    assert list(cls.get_app(None).get_templates()) == \
+        [os.path.join(templatedir, 'index.html')]
+    assert list(cls.get_app('nl').get_templates()) == \
+        [os.path.join(templatedir, '_locale', 'index.html')]
+
+
+def test_render_template(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir)
+    app = cls.get_app('nl_NL')
+    path = os.path.join(templatedir, '_locale', 'index.html')
+    output = locale.render_template(path, **app.get_render_kw(path))
+    assert 'Nieuw' in output
+
+
+def test_mofile_cache(locale_app, tmpdir):
+    cls, templatedir, localedir, tempdir = locale_app
+    mo_cache = str(tmpdir.mkdir('mo'))
+    pofile = os.path.join(localedir, 'nl_NL', 'LC_MESSAGES', 'index.po')
+    mofile = locale.get_mofile(pofile, False, mo_cache)
+    assert os.listdir(mo_cache) == [os.path.basename(mofile)]
+    with mock.patch.object(locale, 'read_po') as read_po:
+        assert locale.get_mofile(pofile, False, mo_cache) == mofile
+        assert not read_po.called
+    assert locale.get_mofile(pofile, True, mo_cache) != mofile
+    with open(pofile, 'a') as f:
+        f.write('\nmsgid "Salad"\nmsgstr "Salade"\n')
+    changed = locale.get_mofile(pofile, False, mo_cache)
+    assert changed != mofile
+    translations = locale.load_translations([pofile], False, mo_cache)
+    assert translations.gettext('Salad') == 'Salade'
+    assert translations.gettext('New') == 'Nieuw'
+
+
+def test_prune_mo_cache(locale_app, tmpdir):
+    cls, templatedir, localedir, tempdir = locale_app
+    mo_cache = str(tmpdir.mkdir('mo'))
+    pofile = os.path.join(localedir, 'nl_NL', 'LC_MESSAGES', 'index.po')
+    old = locale.get_mofile(pofile, False, mo_cache)
+    with open(pofile, 'a') as f:
+        f.write('\nmsgid "Salad"\nmsgstr "Salade"\n')
+    mofile = locale.get_mofile(pofile, False, mo_cache)
+    cls.initialize(templatedir, localedir, tempdir, frozen=True,
+                   mo_cache=mo_cache)
+    assert not os.path.exists(old)
+    assert os.path.exists(mofile)
+    assert cls.prune_mo_cache() == 0
+
+
+def test_translations_replaced(locale_app, tmpdir):
+    cls, templatedir, localedir, tempdir = locale_app
+    mo_cache = str(tmpdir.mkdir('mo'))
+    pofile = os.path.join(localedir, 'nl_NL', 'LC_MESSAGES', 'index.po')
+    translations = locale.load_translations([pofile], False, mo_cache)
+    assert locale.load_translations([pofile], False, mo_cache) is \
+        translations
+    count = len(locale._translations)
+    for i in range(3):
+        with open(pofile, 'a') as f:
+            f.write('\nmsgid "Salad{0}"\nmsgstr "Salade{0}"\n'.format(i))
+        changed = locale.load_translations([pofile], False, mo_cache)
+        assert changed.gettext('Salad{}'.format(i)) == 'Salade{}'.format(i)
+    # The translations of the old content are not kept.
+    assert len(locale._translations) == count
+
+
+def test_precompile(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir, precompile=True,
+                   processes=2)
+    assert set(cls.locales) == {'', 'en', 'en_US', 'nl', 'nl_NL'}
+    for app in cls.locales.values():
+        for path in app.get_templates():
+            assert path in app._pages
+            assert not app.is_dirty(path)
+    path = os.path.join(templatedir, '_locale', 'index.html')
+    assert 'Nieuw' in cls.get_app('nl_NL')._pages[path].text
+
+
+def test_is_dirty(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir, watch_interval=60)
+    app = cls.get_app('nl_NL')
+    path = os.path.join(templatedir, '_locale', 'index.html')
+    assert app.is_dirty(path)
+    with mock.patch('os.path.getmtime', side_effect=AssertionError):
+        # Not checked till the watcher sees a change.
+        assert not app.is_dirty(path)
+    cls.changed()
+    assert not app.is_dirty(path)
+    pofile = os.path.join(localedir, 'nl_NL', 'LC_MESSAGES', 'index.po')
+    os.utime(pofile, (2000000000, 2000000000))
+    cls.changed()
+    assert app.is_dirty(path)
+
+
+def test_watcher(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir, watch_interval=0.01)
+    pofile = os.path.join(localedir, 'nl_NL', 'LC_MESSAGES', 'index.po')
+    os.utime(pofile, (2000000000, 2000000000))
+    for _ in range(100):
+        if cls._generation:
+            break
+        time.sleep(0.01)
+    assert cls._generation
+
+
+def test_frozen(locale_app):
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir, frozen=True)
+    assert cls._watcher is None
+    app = cls.get_app('nl_NL')
+    response = Request.blank('/').get_response(app)
+    assert 'Nieuw' in response.text
+    with mock.patch('os.stat', side_effect=AssertionError):
+        assert Request.blank('/').get_response(app).text == response.text
+        assert Request.blank('/index.html').get_response(app).text == \
+            response.text
+
+
+def test_page():
+    page = locale.Page('<html><head></head><body>Salad</body></html>')
+    response = Request.blank('/').get_response(page)
+    assert response.status_code == 200
+    assert response.content_type == 'text/html'
+    assert response.content_encoding is None
+    assert response.text == page.text
+    etag = response.etag
+    request = Request.blank('/', headers={'If-None-Match': etag})
+    assert request.get_response(page).status_code == 304
+
+
+def test_page_gzip():
+    page = locale.Page('<html><head></head><body>Salad</body></html>')
+    request = Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+    response = request.get_response(page)
+    assert response.content_encoding == 'gzip'
+    assert response.vary == ('Accept-Encoding',)
+    assert gzip.decompress(response.body).decode('utf-8') == page.text
+    request = Request.blank('/', headers={'Accept-Encoding': 'gzip',
+                                          'If-None-Match': response.etag})
+    assert request.get_response(page).status_code == 304
+
+
+def test_page_inclusions():
+    page = locale.Page('<html><head></head><body>Salad</body></html>')
+    inclusions = mock.Mock()
+    inclusions.render.return_value = '<script src="a.js"></script>'
+    request = Request.blank('/', environ={
+        'bowerstatic.inclusions': inclusions})
+    response = request.get_response(page)
+    assert response.text == ('<html><head><script src="a.js"></script>'
+                             '</head><body>Salad</body></html>')
+    etag = response.etag
+    inclusions.render.return_value = '<script src="b.js"></script>'
+    response = request.get_response(page)
+    assert 'b.js' in response.text
+    assert response.etag != etag
+
+
+def test_page_method():
+    page = locale.Page('<html></html>')
+    request = Request.blank('/', method='POST')
+    assert request.get_response(page).status_code == 405
+
+
+def test_static_index(locale_app):
+    from asf.static import get_static
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir)
+    app = get_static(mock.Mock(), tempdir)
+    request = Request.blank('/nl/', headers={'Accept-Encoding': 'gzip'})
+    response = request.get_response(app)
+    assert response.status_code == 200
+    assert response.content_encoding == 'gzip'
+    assert b'/bowerstatic/components/uikit' in gzip.decompress(response.body)
+    request = Request.blank('/nl/', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': response.etag})
+    assert request.get_response(app).status_code == 304
+
+
+def test_static_index_accept_language(locale_app):
+    from asf.static import get_static
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir)
+    app = get_static(mock.Mock(), tempdir)
+    request = Request.blank('/', headers={'Accept-Language': 'nl-BE, en'})
+    response = request.get_response(app)
+    assert response.status_code == 200
+    assert 'Nieuw' in response.text
+    assert '/locale/nl.js' in response.text
+    assert 'Accept-Language' in response.vary
+    response = Request.blank('/', headers={
+        'Accept-Language': 'fr'}).get_response(app)
+    assert 'ASF Landing Page' in response.text
+    assert 'Accept-Language' in response.vary
+
+
+def test_static_index_locale_cookie(locale_app):
+    from asf.static import get_static
+    cls, templatedir, localedir, tempdir = locale_app
+    cls.initialize(templatedir, localedir, tempdir)
+    app = get_static(mock.Mock(), tempdir)
+    # The language chosen by the user wins over Accept-Language.
+    request = Request.blank('/', headers={'Accept-Language': 'fr',
+                                          'Cookie': 'locale=nl'})
+    response = request.get_response(app)
+    assert 'Nieuw' in response.text
+    assert 'Cookie' in response.vary
+    request = Request.blank('/', headers={'Accept-Language': 'nl',
+                                          'Cookie': 'locale=xx'})
+    assert 'Nieuw' in request.get_response(app).text
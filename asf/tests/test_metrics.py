@@ -0,0 +1,63 @@
+import pytest
+
+from asf import metrics
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'A counter.', ('method',))
+    counter.inc(method='GET')
+    counter.inc(2, method='GET')
+    assert counter.get(method='GET') == 3
+    assert counter.get(method='POST') == 0
+
+
+def test_invalid_labels():
+    counter = metrics.Counter('test_total', 'A counter.', ('method',))
+    with pytest.raises(ValueError):
+        counter.inc(path='/')
+
+
+def test_gauge():
+    gauge = metrics.Gauge('test', 'A gauge.')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.get() == 1
+    gauge.set(5)
+    assert gauge.get() == 5
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'A histogram.',
+                                  buckets=(1, 0.1))
+    assert histogram.buckets == (0.1, 1, float('inf'))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(2)
+    assert histogram.get() == (4, 2.65)
+    samples = list(histogram.samples())
+    assert samples == [
+        ('test_seconds_bucket', [('le', '0.1')], 2),
+        ('test_seconds_bucket', [('le', '1.0')], 3),
+        ('test_seconds_bucket', [('le', '+Inf')], 4),
+        ('test_seconds_sum', [], 2.65),
+        ('test_seconds_count', [], 4),
+    ]
+
+
+def test_histogram_time():
+    histogram = metrics.Histogram('test_seconds', 'A histogram.')
+    with histogram.time():
+        pass
+    assert histogram.get()[0] == 1
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'A "counter".', ('path',))
+    counter.inc(path='/a"b\\')
+    assert registry.render() == (
+        '# HELP test_total A "counter".\n'
+        '# TYPE test_total counter\n'
+        'test_total{path="/a\\"b\\\\"} 1.0\n')
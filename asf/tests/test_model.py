@@ -2,12 +2,19 @@ import datetime
 from functools import partial
 from unittest import mock
 
+from BTrees.OOBTree import OOBTree
+
 from dateutil import tz
 
 import iso8601
 
 import pytest
 
+import transaction
+
+import ZODB
+from ZODB.FileStorage import FileStorage
+
 from asf import model
 
 
@@ -70,6 +77,23 @@ class TestDocumentCollection(TestResource):
         json = resource.dump_json(MockRequest(), root=False)
         assert 'websocket' not in json
 
+    def test_persistent_attributes(self):
+        resource = self.resource_class('parent')
+        document = self.document()
+        resource[document.id] = 'document'
+        state = resource.__getstate__()
+        loaded = self.resource_class.__new__(self.resource_class)
+        loaded.__setstate__(state)
+        assert loaded.parent == 'parent'
+        assert dict(loaded.items()) == {document.id: 'document'}
+
+    def test_persistent_attributes_empty(self):
+        resource = self.resource_class('parent')
+        loaded = self.resource_class.__new__(self.resource_class)
+        loaded.__setstate__(resource.__getstate__())
+        assert loaded.parent == 'parent'
+        assert len(loaded) == 0
+
     def test_dump_json(self):
         resource = self.resource()
         document = self.document()
@@ -96,11 +120,141 @@ class TestDocumentCollection(TestResource):
         item = json['itemListElement'][0]
         assert '@context' not in item
 
+    def _paged(self, **params):
+        resource = self.resource()
+        for key in 'abcde':
+            document = self.document()
+            resource[key] = document
+        request = MockRequest(params=params)
+        request.link.return_value = 'http://localhost/collection'
+        return resource.dump_json(request), request
+
+    def test_dump_json_limit(self):
+        json, request = self._paged(limit='2')
+        assert len(json['itemListElement']) == 2
+        next_ = json['next']
+        assert next_['@type'] == 'url'
+        assert next_['@value'] == \
+            'http://localhost/collection?limit=2&after=b'
+
+    def test_dump_json_after(self):
+        json, request = self._paged(limit='2', after='b', children='1')
+        assert len(json['itemListElement']) == 2
+        assert json['next']['@value'] == \
+            'http://localhost/collection?limit=2&children=1&after=d'
+
+    def test_dump_json_last_page(self):
+        json, request = self._paged(limit='2', after='c')
+        assert len(json['itemListElement']) == 2
+        assert 'next' not in json
+
+    @pytest.mark.parametrize('limit', ['', '0', '-1', 'all'])
+    def test_dump_json_invalid_limit(self, limit):
+        json, request = self._paged(limit=limit)
+        assert len(json['itemListElement']) == 5
+        assert 'next' not in json
+
+    def test_add_many(self):
+        resource = self.resource()
+        for i in range(10000):
+            resource['{:05}'.format(i)] = i
+        assert len(resource) == 10000
+        assert type(resource.documents) is OOBTree
+
+    def test_load_btree_state(self):
+        # The state of a collection that was a BTree itself.
+        documents = OOBTree({'a': 'document'})
+        loaded = self.resource_class.__new__(self.resource_class)
+        loaded.__setstate__(documents.__getstate__())
+        assert loaded.parent is None
+        assert dict(loaded.items()) == {'a': 'document'}
+        assert loaded._v_upgraded
+
 
 class TestSaladCollection(TestDocumentCollection):
     resource_class = model.SaladCollection
     _document = model.SaladDocument
 
+    @property
+    def resource(self):
+        def resource():
+            salads = self.resource_class(self.parent)
+            salads.create_start_time_index()
+            return salads
+        return resource
+
+    @property
+    def document(self):
+        def document():
+            doc = mock.MagicMock(self._document)()
+            doc.start_time = datetime.datetime.now(tz.tzutc())
+            return doc
+        return document
+
+    def _salads(self):
+        resource = self.resource()
+        salads = []
+        # Add out of order.
+        for day in (3, 1, 4, 2, 5):
+            salads.append(resource.add(model.SaladDocument(
+                datetime.datetime(2017, 3, day, 12, tzinfo=tz.tzutc()))))
+        return resource, salads
+
+    def _days(self, json, salads):
+        by_link = {'/salads/{}'.format(s.id): s for s in salads}
+        return [by_link[item['@id']].start_time.day
+                for item in json['itemListElement']]
+
+    def _request(self, **params):
+        request = MockRequest(params=params)
+        request.link.side_effect = \
+            lambda obj, *args: '/salads/{}'.format(getattr(obj, 'id', ''))
+        return request
+
+    def test_add_index(self):
+        resource, salads = self._salads()
+        assert list(resource.start_time_index.values()) == \
+            sorted(salads, key=lambda s: s.start_time)
+
+    def test_create_start_time_index(self):
+        assert not hasattr(self.resource_class(None), '_start_time_index')
+        assert model.RootDocument().salads.start_time_index is not None
+        resource, salads = self._salads()
+        assert not resource.create_start_time_index()
+        del resource._start_time_index
+        assert resource.create_start_time_index()
+        assert list(resource.start_time_index.values()) == \
+            sorted(salads, key=lambda s: s.start_time)
+
+    @pytest.mark.parametrize('params, days', [
+        ({}, None),
+        ({'from': '2017-03-02T12:00Z'}, [2, 3, 4, 5]),
+        ({'to': '2017-03-03T12:00Z'}, [1, 2]),
+        ({'from': '2017-03-02', 'to': '2017-03-04'}, [2, 3]),
+        ({'from': '2017-03-02T13:00+01:00', 'to': '2017-03-04'}, [2, 3]),
+        ({'from': '2017-03-02', 'limit': '2'}, [2, 3]),
+        ({'from': '2017-03-02', 'invalid': 'hello'}, [2, 3, 4, 5]),
+        ({'from': 'hello', 'to': '2017-03-02'}, [1]),
+    ])
+    def test_dump_json_from_to(self, params, days):
+        resource, salads = self._salads()
+        json = resource.dump_json(self._request(**params))
+        if days is None:
+            assert len(json['itemListElement']) == len(salads)
+        else:
+            assert self._days(json, salads) == days
+
+    def test_dump_json_from_to_after(self):
+        resource, salads = self._salads()
+        request = self._request(**{'from': '2017-03-02', 'limit': '2'})
+        json = resource.dump_json(request)
+        after = json['next']['@value'].rpartition('after=')[2]
+        request = self._request(**{'from': '2017-03-02', 'limit': '2',
+                                   'after': after})
+        json = resource.dump_json(request)
+        assert self._days(json, salads) == [4, 5]
+        assert 'next' not in json
+
 
 class TestIngredientCollection(TestDocumentCollection):
     resource_class = model.IngredientCollection
@@ -297,6 +451,26 @@ class TestCommentDocument(TestDocument):
     resource_class = model.CommentDocument
 
 
+class TestDocumentBatch:
+
+    @pytest.mark.parametrize('json', [
+        [],
+        [{}],
+        ['lettuce'],
+        [{'type': 'Offer', 'name': 'lettuce', 'seller': 'me'}, {}],
+    ])
+    def test_load_json_fail(self, json):
+        obj = model.DocumentBatch.load_json(model.IngredientDocument, json)
+        assert obj is json
+
+    def test_load_json(self):
+        json = [{'type': 'Offer', 'name': 'lettuce', 'seller': 'me'},
+                {'type': 'Offer', 'name': 'tomato', 'seller': 'you'}]
+        obj = model.DocumentBatch.load_json(model.IngredientDocument, json)
+        assert isinstance(obj, model.DocumentBatch)
+        assert [document.name for document in obj] == ['lettuce', 'tomato']
+
+
 class TestRootDocument(TestDocument):
     resource_class = model.RootDocument
 
@@ -318,3 +492,33 @@ class TestRootDocument(TestDocument):
         salads = json['salads']
         assert isinstance(salads['itemListElement'], list)
         assert '@context' not in salads
+
+    def test_upgrade_collections(self):
+        resource = self.resource()
+        assert resource.upgrade_collections() == 0
+        salads = model.SaladCollection.__new__(model.SaladCollection)
+        salads.__setstate__(None)
+        resource.salads = salads
+        assert resource.upgrade_collections() == 1
+        assert salads.parent is resource
+
+
+def test_concurrent_adds(tmpdir):
+    db = ZODB.DB(FileStorage(str(tmpdir.join('Data.fs'))))
+    start_time = datetime.datetime(2017, 3, 1, 12, tzinfo=tz.tzutc())
+    with db.transaction() as connection:
+        root = connection.root()['root'] = model.RootDocument()
+        root.salads.add(model.SaladDocument(start_time))
+    managers = [transaction.TransactionManager() for i in range(2)]
+    connections = [db.open(manager) for manager in managers]
+    for connection in connections:
+        connection.root()['root'].salads.add(
+            model.SaladDocument(start_time))
+    # The second commit conflicts, the adds are resolved by the BTrees.
+    for manager in managers:
+        manager.commit()
+    with db.transaction() as connection:
+        salads = connection.root()['root'].salads
+        assert len(salads) == 3
+        assert salads.parent is connection.root()['root']
+    db.close()
@@ -0,0 +1,50 @@
+import os
+import threading
+
+from asf import watch
+
+
+def touch(path, mtime):
+    with open(path, 'a'):
+        pass
+    os.utime(path, (mtime, mtime))
+
+
+def test_latest_mtime(tmpdir):
+    touch(str(tmpdir.mkdir('sub').join('a')), 2000000000)
+    touch(str(tmpdir.join('b')), 1000000000)
+    assert watch.latest_mtime(str(tmpdir)) == 2000000000
+
+
+def test_poll_watcher(tmpdir):
+    touch(str(tmpdir.join('a')), 1000000000)
+    os.utime(str(tmpdir), (1000000000, 1000000000))
+    changed = threading.Event()
+    watcher = watch.Watcher([str(tmpdir)], changed.set, interval=0.01,
+                            use_inotify=False)
+    watcher.start()
+    try:
+        assert not changed.wait(0.05)
+        touch(str(tmpdir.join('a')), 2000000000)
+        assert changed.wait(1)
+    finally:
+        watcher.stop()
+    assert not watcher.running
+
+
+def test_latest_modified(tmpdir):
+    touch(str(tmpdir.join('a')), 2000000000)
+    latest = watch.LatestModified(str(tmpdir), interval=0.01)
+    assert latest.value == 2000000000
+    touch(str(tmpdir.join('a')), 2100000000)
+    latest.refresh()
+    assert latest.value == 2100000000
+
+
+def test_latest_modified_frozen(tmpdir):
+    touch(str(tmpdir.join('a')), 2000000000)
+    latest = watch.LatestModified(str(tmpdir), frozen=True)
+    latest.start()
+    assert latest.watcher is None
+    touch(str(tmpdir.join('a')), 2100000000)
+    assert latest.value == 2000000000
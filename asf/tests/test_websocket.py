@@ -3,14 +3,17 @@ import json
 import logging
 import re
 from unittest import mock
+import zlib
 
 import aredis
 
 import pytest
 
 import websockets
+from websockets.framing import Frame, OP_PING, OP_TEXT
 
 from asf import websocket
+from asf.events import parse_id, stream_key
 
 
 @pytest.mark.parametrize('path, status_code, result', [
@@ -38,6 +41,100 @@ def test_is_valid_app_path(config, requests_mocker,
     assert(websocket.is_valid_app_path(path) is result)
 
 
+class TestPathValidator:
+
+    host = '127.0.0.1'
+    port = 5002
+
+    @pytest.fixture(autouse=True)
+    def app_server(self, config):
+        config['host'] = self.host
+        config['port'] = self.port
+
+    def url(self, path):
+        return 'http://{}:{}/{}'.format(self.host, self.port,
+                                        path.lstrip('/'))
+
+    def is_valid(self, validator, *paths, loop):
+        return loop.run_until_complete(asyncio.gather(
+            *[validator.is_valid(path) for path in paths], loop=loop))
+
+    def test_is_valid(self, event_loop, requests_mocker):
+        mock = requests_mocker.get(self.url('/api/hello'))
+        requests_mocker.get(self.url('/api/bye'), status_code=404)
+        validator = websocket.PathValidator(loop=event_loop)
+        assert self.is_valid(validator, '/api/hello', '/api/bye', '/hello',
+                             loop=event_loop) == [True, False, False]
+        assert mock.call_count == 1
+
+    def test_cached(self, event_loop, requests_mocker):
+        mock = requests_mocker.get(self.url('/api/hello'))
+        validator = websocket.PathValidator(loop=event_loop)
+        self.is_valid(validator, '/api/hello', loop=event_loop)
+        self.is_valid(validator, '/api/hello', loop=event_loop)
+        assert mock.call_count == 1
+
+    def test_concurrent_share_request(self, event_loop, requests_mocker):
+        mock = requests_mocker.get(self.url('/api/hello'))
+        validator = websocket.PathValidator(loop=event_loop)
+        assert self.is_valid(validator, *['/api/hello'] * 5,
+                             loop=event_loop) == [True] * 5
+        assert mock.call_count == 1
+
+    def test_invalid_not_cached(self, event_loop, requests_mocker):
+        mock = requests_mocker.get(self.url('/api/hello'), [
+            {'status_code': 404}, {'status_code': 200}])
+        validator = websocket.PathValidator(loop=event_loop)
+        assert self.is_valid(validator, '/api/hello',
+                             loop=event_loop) == [False]
+        # The document is created.
+        assert self.is_valid(validator, '/api/hello',
+                             loop=event_loop) == [True]
+        assert mock.call_count == 2
+
+    def test_ttl(self, event_loop, requests_mocker):
+        mock = requests_mocker.get(self.url('/api/hello'))
+        validator = websocket.PathValidator(ttl=0, loop=event_loop)
+        self.is_valid(validator, '/api/hello', loop=event_loop)
+        self.is_valid(validator, '/api/hello', loop=event_loop)
+        assert mock.call_count == 2
+
+    def test_size(self, event_loop, requests_mocker):
+        mock = requests_mocker.get(self.url('/api/hello'))
+        requests_mocker.get(self.url('/api/bye'))
+        validator = websocket.PathValidator(size=1, loop=event_loop)
+        for path in ('/api/hello', '/api/bye', '/api/hello'):
+            self.is_valid(validator, path, loop=event_loop)
+        assert mock.call_count == 2
+
+    def test_timeout(self, event_loop, requests_mocker):
+        import requests
+        mock = requests_mocker.get(self.url('/api/hello'),
+                                   exc=requests.Timeout)
+        validator = websocket.PathValidator(timeout=0.5, loop=event_loop)
+        assert self.is_valid(validator, '/api/hello',
+                             loop=event_loop) == [False]
+        assert mock.last_request.timeout == 0.5
+        # Timeouts are not cached.
+        self.is_valid(validator, '/api/hello', loop=event_loop)
+        assert mock.call_count == 2
+
+    def test_default_loop(self, event_loop):
+        with mock.patch.object(asyncio, 'get_event_loop',
+                               return_value=event_loop):
+            assert websocket.PathValidator()._loop is event_loop
+
+    def test_error_not_cached(self, event_loop, requests_mocker):
+        import requests
+        mock = requests_mocker.get(self.url('/api/hello'),
+                                   exc=requests.ConnectionError)
+        validator = websocket.PathValidator(loop=event_loop)
+        assert self.is_valid(validator, '/api/hello',
+                             loop=event_loop) == [False]
+        self.is_valid(validator, '/api/hello', loop=event_loop)
+        assert mock.call_count == 2
+
+
 @pytest.mark.parametrize('in_path, origin, out_path', [
     ('path', 'http://localhost:5000', '/path'),
     ('/path', 'http://localhost:5000', '/path'),
@@ -60,6 +157,563 @@ def test_parse_path(in_path, origin, out_path):
     assert(websocket.parse_path(in_path, origin=origin) == out_path)
 
 
+def test_encode_message():
+    data = json.dumps({'data': {'name': 'hello'}, 'type': 'CREATE'})
+    event = websocket.encode_message({'type': b'message',
+                                      'channel': b'/api/path',
+                                      'data': data.encode('utf-8')})
+    assert event.path == '/api/path'
+    assert json.loads(event.frame) == {'function': 'message',
+                                       'path': '/api/path',
+                                       'type': 'CREATE',
+                                       'data': {'name': 'hello'}}
+
+
+def test_encode_message_id():
+    data = json.dumps({'id': '2-0', 'data': 'hello', 'type': 'CREATE'})
+    message = {'type': 'message', 'channel': '/api/path', 'data': data}
+    event = websocket.encode_message(message)
+    assert event.id == '2-0'
+    assert json.loads(event.frame)['id'] == '2-0'
+    # The id published with the message is used.
+    assert websocket.encode_message(message, '1-0').id == '2-0'
+    data = json.dumps({'data': 'hello', 'type': 'CREATE'})
+    event = websocket.encode_message(dict(message, data=data), '1-0')
+    assert json.loads(event.frame)['id'] == event.id == '1-0'
+    assert websocket.encode_message(dict(message, data=data)).id is None
+
+
+@pytest.mark.parametrize('data', ['1', '"x"', '[]', 'null'])
+def test_encode_message_not_an_object(data):
+    message = {'type': 'message', 'channel': '/api/path', 'data': data}
+    with pytest.raises(ValueError):
+        websocket.encode_message(message)
+
+
+def test_listen_after_failed_route(event_loop):
+    pubsub = MockAsyncPubSub(loop=event_loop)
+    router = websocket.SubscriptionRouter(pubsub, timeout=0.05,
+                                          loop=event_loop)
+    handler = mock.Mock()
+    handler.deliver.side_effect = [RuntimeError('failed'), None]
+    data = json.dumps({'data': 'hello', 'type': 'CREATE'})
+
+    async def run():
+        await router.subscribe('/api/path', handler)
+        for value in ('1', '"x"', data, data):
+            pubsub.send_message({'type': 'message', 'channel': b'/api/path',
+                                 'data': value})
+        await asyncio.sleep(0.01, loop=event_loop)
+        assert not router._listener.done()
+        await router.unsubscribe('/api/path', handler)
+        await asyncio.wait_for(router._listener, 1, loop=event_loop)
+
+    event_loop.run_until_complete(run())
+    assert handler.deliver.call_count == 2
+
+
+def test_route_encodes_once():
+    router = websocket.SubscriptionRouter(None)
+    handlers = [mock.Mock() for i in range(3)]
+    router.channels['/api/path'] = set(handlers)
+    message = {'type': 'message', 'channel': b'/api/path',
+               'data': json.dumps({'data': 'hello', 'type': 'CREATE'})}
+    with mock.patch.object(websocket, 'encode_message',
+                           wraps=websocket.encode_message) as encode:
+        router.route(message)
+        router.route(dict(message, channel=b'/api/other'))
+        router.route(dict(message, data='invalid'))
+    assert encode.call_count == 2
+    events = [handler.deliver.call_args[0][0] for handler in handlers]
+    assert all(handler.deliver.call_count == 1 for handler in handlers)
+    assert all(event is events[0] for event in events)
+
+
+@pytest.mark.parametrize('text, glob, prefix, matches, mismatches', [
+    ('/api/salads/*/ingredients', '/api/salads/*/ingredients', '/api/salads',
+     ['/api/salads/a/ingredients'],
+     ['/api/salads/a/b/ingredients', '/api/salads/a/ingredients/b',
+      '/api/salads//ingredients', '/api/salads/a']),
+    ('/api/salads/**', '/api/salads/*', '/api/salads',
+     ['/api/salads/a', '/api/salads/a/ingredients'],
+     ['/api/salads', '/api/saladsa/b']),
+    ('/api/*/a?[b]', '/api/*/a\\?\\[b\\]', '/api',
+     ['/api/x/a?[b]'], ['/api/x/ab']),
+])
+def test_pattern(text, glob, prefix, matches, mismatches):
+    pattern = websocket.Pattern(text)
+    assert pattern.glob == glob
+    assert pattern.prefix == prefix
+    assert all(pattern.match(path) for path in matches)
+    assert not any(pattern.match(path) for path in mismatches)
+    assert pattern == websocket.Pattern(text)
+    assert len({pattern, websocket.Pattern(text)}) == 1
+
+
+@pytest.mark.parametrize('text', [
+    '/api/salads', '/api/sal*', '/api/**/ingredients', '/api/***'])
+def test_pattern_invalid(text):
+    with pytest.raises(ValueError):
+        websocket.Pattern(text)
+
+
+def test_route_pattern():
+    router = websocket.SubscriptionRouter(None)
+    one, other = [mock.Mock(), mock.Mock()]
+    for text, handler in (('/api/salads/*/ingredients', one),
+                          ('/api/salads/**', other)):
+        pattern = websocket.Pattern(text)
+        router.patterns[pattern] = {handler}
+        router.globs.setdefault(pattern.glob, set()).add(pattern)
+    data = json.dumps({'data': 'hello', 'type': 'CREATE'})
+    router.route({'type': 'pmessage', 'pattern': b'/api/salads/*',
+                  'channel': b'/api/salads/a/ingredients', 'data': data})
+    assert not one.deliver.called
+    event = other.deliver.call_args[0][0]
+    assert event.subscription == '/api/salads/**'
+    assert json.loads(event.frame) == {
+        'function': 'message', 'path': '/api/salads/a/ingredients',
+        'pattern': '/api/salads/**', 'data': 'hello', 'type': 'CREATE'}
+    router.route({'type': 'pmessage', 'pattern': b'/api/salads/*/ingredients',
+                  'channel': b'/api/salads/a/ingredients', 'data': data})
+    assert json.loads(one.deliver.call_args[0][0].frame)['pattern'] == \
+        '/api/salads/*/ingredients'
+    router.route({'type': 'pmessage', 'pattern': b'/api/salads/*/ingredients',
+                  'channel': b'/api/salads/a/b/ingredients', 'data': data})
+    assert one.deliver.call_count == 1
+
+
+def test_psubscribe_once_per_glob(event_loop):
+    pubsub = MockAsyncPubSub(loop=event_loop)
+    router = websocket.SubscriptionRouter(pubsub, loop=event_loop)
+    one, other = [mock.Mock(), mock.Mock()]
+    prefix = websocket.Pattern('/api/salads/**')
+    salads = websocket.Pattern('/api/salads/*')
+
+    async def run():
+        await router.psubscribe(prefix, one)
+        await router.psubscribe(prefix, other)
+        await router.psubscribe(salads, one)
+        await router.punsubscribe(prefix, one)
+        await router.punsubscribe(prefix, other)
+        await router.remove(one)
+
+    event_loop.run_until_complete(run())
+    messages = []
+    while not pubsub.queue.empty():
+        messages.append(pubsub.queue.get_nowait())
+    assert messages == [
+        {'type': 'psubscribe', 'channel': b'/api/salads/*'},
+        {'type': 'punsubscribe', 'channel': b'/api/salads/*'}]
+    assert router.patterns == router.globs == {}
+
+
+def test_resubscribe(event_loop):
+    pubsub = MockAsyncPubSub(loop=event_loop)
+    router = websocket.SubscriptionRouter(pubsub, timeout=0.05,
+                                          loop=event_loop)
+    one, other = [mock.Mock(), mock.Mock()]
+    data = json.dumps({'data': 'hello', 'type': 'CREATE'})
+
+    async def run():
+        await router.subscribe('/api/path', one)
+        # Reloading a page removes the handler, and subscribes again
+        # before the unsubscribe is confirmed.
+        removed = router.remove(one)
+        await router.subscribe('/api/path', other)
+        await removed
+        assert not router.unsubscribing
+        assert '/api/path' in pubsub.channels
+        pubsub.send_message({'type': 'message', 'channel': b'/api/path',
+                             'data': data})
+        await asyncio.sleep(0.01, loop=event_loop)
+        assert other.deliver.call_count == 1
+        await router.unsubscribe('/api/path', other)
+        # The listener stops once the unsubscribe is confirmed.
+        await asyncio.wait_for(router._listener, 1, loop=event_loop)
+
+    event_loop.run_until_complete(run())
+    assert not one.deliver.called
+    assert pubsub.channels == {}
+    assert not router.tasks
+
+
+def event(path, data=''):
+    return websocket.Event(path, data)
+
+
+class TestSendQueue:
+
+    @pytest.fixture()
+    def metrics(self):
+        return websocket.WebsocketMetrics()
+
+    def test_get(self, event_loop, metrics):
+        queue = websocket.SendQueue(metrics=metrics, loop=event_loop)
+        getter = asyncio.ensure_future(queue.get(), loop=event_loop)
+        event_loop.run_until_complete(asyncio.sleep(0, loop=event_loop))
+        assert not getter.done()
+        assert queue.put(event('/api/a'))
+        assert metrics.queued_events.get() == 1
+        result = event_loop.run_until_complete(getter)
+        assert result == event('/api/a')
+        assert metrics.queued_events.get() == 0
+
+    def test_drop_oldest(self, event_loop, metrics):
+        queue = websocket.SendQueue(2, metrics=metrics, loop=event_loop)
+        for data in range(3):
+            assert queue.put(event('/api/a', data))
+        assert len(queue) == 2
+        assert metrics.dropped_events.get(policy='drop-oldest') == 1
+        assert metrics.queued_events.get() == 2
+        assert event_loop.run_until_complete(queue.get()).frame == 1
+
+    def test_coalesce(self, event_loop, metrics):
+        queue = websocket.SendQueue(3, 'coalesce', metrics=metrics,
+                                    loop=event_loop)
+        for path in ('/api/a', '/api/b', '/api/a', '/api/b', '/api/c'):
+            assert queue.put(event(path))
+        # The oldest of the same path is dropped, else the oldest.
+        paths = [event_loop.run_until_complete(queue.get()).path
+                 for _ in range(3)]
+        assert paths == ['/api/a', '/api/b', '/api/c']
+        assert metrics.dropped_events.get(policy='coalesce') == 2
+
+    def test_disconnect_full(self, event_loop, metrics):
+        queue = websocket.SendQueue(1, 'disconnect', metrics=metrics,
+                                    loop=event_loop)
+        assert queue.put(event('/api/a'))
+        assert not queue.put(event('/api/a'))
+        assert len(queue) == 1
+
+    def test_disconnect_lag(self, event_loop, metrics):
+        queue = websocket.SendQueue(10, 'disconnect', max_lag=5,
+                                    metrics=metrics, loop=event_loop)
+        with mock.patch.object(event_loop, 'time', return_value=100):
+            assert queue.put(event('/api/a'))
+        with mock.patch.object(event_loop, 'time', return_value=104):
+            assert queue.lag() == 4
+            assert queue.put(event('/api/a'))
+        with mock.patch.object(event_loop, 'time', return_value=106):
+            assert not queue.put(event('/api/a'))
+
+    def test_invalid_policy(self, event_loop):
+        with pytest.raises(ValueError):
+            websocket.SendQueue(policy='wait', loop=event_loop)
+
+    def test_clear(self, event_loop, metrics):
+        queue = websocket.SendQueue(metrics=metrics, loop=event_loop)
+        queue.put(event('/api/a'))
+        queue.put(event('/api/b'))
+        queue.clear()
+        assert len(queue) == 0
+        assert metrics.queued_events.get() == 0
+
+    def test_wait_timeout(self, event_loop, metrics):
+        queue = websocket.SendQueue(metrics=metrics, loop=event_loop)
+        event_loop.run_until_complete(queue.wait(0.01))
+        assert len(queue) == 0
+        event_loop.call_soon(queue.put, event('/api/a'))
+        event_loop.run_until_complete(queue.wait(1))
+        assert queue.peek() == event('/api/a')
+        assert queue.get_nowait() == event('/api/a')
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    (False, None),
+    (True, websocket.Batch(0.05, 50)),
+    ({}, websocket.Batch(0.05, 50)),
+    ({'window': 0.01}, websocket.Batch(0.01, 50)),
+    ({'window': 1, 'size': 100}, websocket.Batch(0.05, 50)),
+    ({'size': '10'}, websocket.Batch(0.05, 10)),
+])
+def test_batch_parse(value, expected):
+    assert websocket.Batch().parse(value) == expected
+
+
+@pytest.mark.parametrize('value', [
+    {'size': 0}, {'window': -1}, {'size': 'many'}, {'window': None},
+])
+def test_batch_parse_invalid(value):
+    with pytest.raises((TypeError, ValueError)):
+        websocket.Batch().parse(value)
+
+
+def test_deliver_disconnect_slow(event_loop):
+    ws = mock.Mock(request_headers={'origin': 'http://localhost'})
+    closed = asyncio.Future(loop=event_loop)
+    closed.set_result(None)
+    ws.close.return_value = closed
+    metrics = websocket.WebsocketMetrics()
+    queue = websocket.SendQueue(1, 'disconnect', metrics=metrics,
+                                loop=event_loop)
+    handler = websocket.WebSocketHandler(ws, '/api', mock.Mock(),
+                                         mock.Mock(), queue=queue,
+                                         metrics=metrics, loop=event_loop)
+    handler.deliver(event('/api/a'))
+    handler.deliver(event('/api/a'))
+    event_loop.run_until_complete(handler._closing)
+    ws.close.assert_called_once_with(4008, 'Too slow')
+    assert len(queue) == 0
+    assert metrics.disconnects.get() == 1
+    # Events are ignored once closing.
+    handler.deliver(event('/api/a'))
+    assert len(queue) == 0
+
+
+def test_serve_metrics(event_loop, unused_tcp_port):
+    metrics = websocket.WebsocketMetrics()
+    metrics.connections.inc()
+    server = event_loop.run_until_complete(websocket.serve_metrics(
+        metrics, 'localhost', unused_tcp_port, loop=event_loop))
+
+    async def get():
+        reader, writer = await asyncio.open_connection(
+            'localhost', unused_tcp_port, loop=event_loop)
+        writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+        return await reader.read()
+
+    try:
+        response = event_loop.run_until_complete(get()).decode('utf-8')
+    finally:
+        server.close()
+        event_loop.run_until_complete(server.wait_closed())
+    assert response.startswith('HTTP/1.0 200 OK\r\n')
+    assert 'asf_websocket_connections 1.0\n' in response
+
+
+class MockStreamRedis(object):
+    """The streams of a redis server."""
+
+    def __init__(self, streams=None):
+        self.streams = streams or {}
+
+    def add(self, path, *data):
+        entries = self.streams.setdefault(stream_key(path), [])
+        for value in data:
+            entry_id = '{}-0'.format(len(entries) + 1).encode()
+            event = json.dumps({'data': value, 'type': 'CREATE'})
+            entries.append((entry_id, {b'event': event.encode()}))
+
+    async def xrange(self, name, start='-', end='+', count=None):
+        entries = [(entry_id, fields)
+                   for entry_id, fields in self.streams.get(name, [])
+                   if parse_id(entry_id.decode()) >= parse_id(start)]
+        return entries[:count]
+
+
+@pytest.mark.parametrize('last_id, count, expected, complete', [
+    ('2-0', 10, ['3-0', '4-0'], True),
+    ('2', 10, ['3-0', '4-0'], True),
+    ('4-0', 10, [], True),
+    ('0-0', 10, ['1-0', '2-0', '3-0', '4-0'], False),
+    ('5-0', 10, [], False),
+    ('1-0', 2, ['2-0', '3-0'], False),
+])
+def test_event_replay(event_loop, last_id, count, expected, complete):
+    redis = MockStreamRedis()
+    redis.add('/api/path', 'a', 'b', 'c', 'd')
+    # The first entry has been removed from the stream.
+    if last_id == '0-0':
+        redis.streams[stream_key('/api/path')].insert(0, (b'0-1', {}))
+    replay = websocket.EventReplay(redis, count=count)
+    events, result = event_loop.run_until_complete(
+        replay.events('/api/path', last_id))
+    assert [event.id for event in events] == expected
+    assert result is complete
+    if events:
+        assert json.loads(events[0].frame) == {
+            'function': 'message', 'path': '/api/path', 'id': expected[0],
+            'data': 'abcd'[int(expected[0][0]) - 1], 'type': 'CREATE'}
+
+
+def test_event_replay_error(event_loop):
+    redis = mock.Mock()
+    redis.xrange.side_effect = aredis.RedisError('Unknown command')
+    replay = websocket.EventReplay(redis)
+    assert event_loop.run_until_complete(
+        replay.events('/api/path', '1-0')) == ([], False)
+
+
+def test_replay_holds_live_events(event_loop):
+    sent = []
+
+    async def send(frame):
+        sent.append(json.loads(frame))
+
+    async def coroutine(*args):
+        return True
+
+    ws = mock.Mock(request_headers={'origin': 'http://localhost'}, send=send)
+    router = mock.Mock(subscribe=coroutine)
+    replay = websocket.EventReplay(MockStreamRedis())
+    handler = websocket.WebSocketHandler(
+        ws, '/api', router, mock.Mock(is_valid=coroutine), replay=replay,
+        loop=event_loop)
+
+    async def events(path, last_id):
+        # Live events delivered while the stream is read.
+        handler.deliver(websocket.Event(path, 'live', '2-0'))
+        handler.deliver(websocket.Event(path, 'live', '3-0'))
+        return [websocket.Event(path, '{"id":"2-0"}', '2-0')], True
+
+    replay.events = events
+    event_loop.run_until_complete(handler.subscribe(
+        {'path': '/api/path', 'lastEventId': '1-0'}))
+    assert sent == [{'function': 'subscribe', 'path': '/api/path',
+                     'replay': {'events': 1, 'complete': True}},
+                    {'id': '2-0'}]
+    # Only the live event that was not replayed is send.
+    assert len(handler.queue) == 1
+    assert handler.queue.peek().id == '3-0'
+    assert handler.replaying == {}
+
+
+class MockDeflate(object):
+    name = 'permessage-deflate'
+
+    def encode(self, frame):
+        return frame._replace(data=zlib.compress(frame.data))
+
+    def decode(self, frame, *, max_size=None):
+        return frame
+
+
+def test_compression_stats():
+    metrics = websocket.WebsocketMetrics()
+    stats = websocket.CompressionStats(MockDeflate(), 100, metrics)
+    assert stats.name == 'permessage-deflate'
+    assert stats.ratio == 1.0
+    data = json.dumps([{'@id': 'http://localhost/api/salads'}] * 10)
+    frame = Frame(True, OP_TEXT, data.encode('utf-8'))
+    encoded = stats.encode(frame)
+    assert encoded.data == zlib.compress(frame.data)
+    assert stats.payload_bytes == len(frame.data)
+    assert stats.compressed_bytes == len(encoded.data)
+    assert stats.ratio < 0.5
+    assert metrics.payload_bytes.get() == stats.payload_bytes
+    assert metrics.compressed_bytes.get() == stats.compressed_bytes
+
+
+def test_compression_stats_small():
+    stats = websocket.CompressionStats(MockDeflate(), 100)
+    frame = Frame(True, OP_TEXT, b'{}')
+    assert stats.encode(frame) is frame
+    assert stats.payload_bytes == stats.compressed_bytes == 2
+    # The first frame of a fragmented message is always compressed.
+    frame = Frame(False, OP_TEXT, b'{}')
+    assert stats.encode(frame) != frame
+
+
+def test_compression_stats_control_frames():
+    stats = websocket.CompressionStats(MockDeflate())
+    stats.encode(Frame(True, OP_PING, b'ping'))
+    assert stats.payload_bytes == 0
+
+
+class ZlibDeflate(MockDeflate):
+    """Deflate of messages as permessage-deflate (RFC 7692) does it."""
+
+    def __init__(self):
+        self.encoder = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.decoder = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+    def encode(self, frame):
+        data = self.encoder.compress(frame.data)
+        data += self.encoder.flush(zlib.Z_SYNC_FLUSH)
+        # The empty block ending the flush is left out.
+        return frame._replace(data=data[:-4])
+
+    def decode(self, frame, *, max_size=None):
+        data = self.decoder.decompress(frame.data + b'\x00\x00\xff\xff')
+        return frame._replace(data=data)
+
+
+def test_compression_round_trip():
+    stats = websocket.CompressionStats(ZlibDeflate(), 100)
+    receiver = ZlibDeflate()
+    messages = [json.dumps({'function': 'message', 'path': '/api/salads',
+                            'data': {'name': 'salad {}'.format(i)}}) * 5
+                for i in range(3)] + ['{}']
+    for message in messages:
+        frame = Frame(True, OP_TEXT, message.encode('utf-8'))
+        encoded = stats.encode(frame)
+        if message == '{}':
+            # Too small to compress.
+            assert encoded is frame
+            continue
+        assert receiver.decode(encoded).data.decode('utf-8') == message
+    # The later messages use the context of the earlier ones.
+    assert stats.ratio < 0.5
+
+
+def test_compression_negotiated(event_loop, unused_tcp_port):
+    permessage_deflate = pytest.importorskip(
+        'websockets.extensions.permessage_deflate')
+    metrics = websocket.WebsocketMetrics()
+    factory = websocket.deflate_factory(min_size=0, metrics=metrics)
+    message = json.dumps([{'@id': 'http://localhost/api/salads'}] * 10)
+    connections = []
+
+    async def handler(ws, path):
+        connections.append(ws)
+        await ws.send(message)
+        await ws.recv()
+
+    async def run():
+        server = await websockets.serve(
+            handler, 'localhost', unused_tcp_port, extensions=[factory],
+            compression=None, loop=event_loop)
+        client = await websockets.connect(
+            'ws://localhost:{}/api'.format(unused_tcp_port),
+            extensions=[
+                permessage_deflate.ClientPerMessageDeflateFactory()],
+            compression=None, loop=event_loop)
+        try:
+            assert [e.name for e in client.extensions] == \
+                ['permessage-deflate']
+            assert await client.recv() == message
+            await client.send('bye')
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    event_loop.run_until_complete(run())
+    stats, = connections[0].extensions
+    assert isinstance(stats, websocket.CompressionStats)
+    assert stats.payload_bytes == len(message)
+    assert stats.compressed_bytes < stats.payload_bytes
+    assert metrics.compressed_bytes.get() == stats.compressed_bytes
+
+
+def test_deflate_factory():
+    factory = mock.Mock()
+    factory.name = 'permessage-deflate'
+    factory.process_request_params.return_value = ([], MockDeflate())
+    metrics = websocket.WebsocketMetrics()
+    deflate = websocket.DeflateFactory(factory, 100, metrics)
+    assert deflate.name == 'permessage-deflate'
+    params, extension = deflate.process_request_params([], [])
+    factory.process_request_params.assert_called_once_with([], [])
+    assert isinstance(extension, websocket.CompressionStats)
+    assert extension.min_size == 100
+    assert extension.metrics is metrics
+
+
+def test_observe_compression():
+    metrics = websocket.WebsocketMetrics()
+    stats = websocket.CompressionStats(MockDeflate())
+    stats.payload_bytes, stats.compressed_bytes = 1000, 200
+    ws = mock.Mock(request_headers={'origin': 'http://localhost'},
+                   extensions=[stats])
+    with websocket.WebSocketHandler(ws, '/api', mock.Mock(), mock.Mock(),
+                                    metrics=metrics, loop=mock.Mock()):
+        pass
+    assert metrics.compression_ratio.get() == (1, 0.2)
+
+
 class Client:
     def __init__(self, *, loop=None):
         self._loop = loop
@@ -115,10 +769,10 @@ class Client:
     def stop(self):
         if not self._running:  # pragma: no cover
             return
-        self._loop.run_until_complete(self.client.close())
         try:
+            # Closing waits for the connection to be closed.
             self._loop.run_until_complete(
-                asyncio.wait_for(self.client.worker_task, timeout=1,
+                asyncio.wait_for(self.client.close(), timeout=1,
                                  loop=self._loop)
             )
         except asyncio.TimeoutError:  # pragma: no cover
@@ -151,10 +805,11 @@ class Server:
             self._loop = asyncio.get_event_loop()
         self._running = False
 
-    def start(self, host, port, pubsub):
+    def start(self, host, port, pubsub, **kwargs):
         self._running = True
         self.pubsub = pubsub
-        handler = websocket.handler_factory(pubsub, loop=self._loop)
+        handler = websocket.handler_factory(pubsub, loop=self._loop,
+                                            **kwargs)
         server = websockets.serve(handler, host=host, port=port,
                                   loop=self._loop)
         self.server = self._loop.run_until_complete(server)
@@ -183,18 +838,31 @@ class Server:
 def server(event_loop, unused_tcp_port):
     server = Server(loop=event_loop)
 
-    def get_server(*, pubsub=MockAsyncPubSub(loop=event_loop)):
-        return server.start('localhost', unused_tcp_port, pubsub)
+    def get_server(*, pubsub=MockAsyncPubSub(loop=event_loop), **kwargs):
+        return server.start('localhost', unused_tcp_port, pubsub, **kwargs)
     yield get_server
     server.stop()
 
 
 class MockAsyncPubSub(object):
+    """Mock of the pubsub of aredis.
+
+    Like aredis, the channels and patterns are only removed once the
+    unsubscribe confirmation is received, and listen returns None
+    immediately if there are no subscriptions.
+    """
+
     def __init__(self, *, loop=None, **kwargs):
         self._loop = loop
         self._internal_queue = asyncio.Queue(loop=self._loop)
         # This queue is can be used to get values by external programs.
         self.queue = asyncio.Queue(loop=self._loop)
+        self.channels = {}
+        self.patterns = {}
+
+    @property
+    def subscribed(self):
+        return bool(self.channels or self.patterns)
 
     async def subscribe(self, path):
         print('Mock subscribing to :', path)
@@ -202,24 +870,55 @@ class MockAsyncPubSub(object):
                    'channel': path.encode('utf-8')}
         await self.queue.put(message)
         await self._internal_queue.put(message)
+        self.channels[path] = None
 
-    async def unsubscribe(self, path=None):
-        if not path:
-            path = 'ALL'
-        print('Mock unsubscribing to :', path)
-        message = {'type': 'unsubscribe',
-                   'channel': path.encode('utf-8')}
+    async def unsubscribe(self, *paths):
+        for path in paths:
+            print('Mock unsubscribing to :', path)
+            message = {'type': 'unsubscribe',
+                       'channel': path.encode('utf-8')}
+            await self.queue.put(message)
+            await self._internal_queue.put(message)
+
+    async def psubscribe(self, pattern):
+        message = {'type': 'psubscribe',
+                   'channel': pattern.encode('utf-8')}
         await self.queue.put(message)
         await self._internal_queue.put(message)
+        self.patterns[pattern] = None
+
+    async def punsubscribe(self, *patterns):
+        for pattern in patterns:
+            message = {'type': 'punsubscribe',
+                       'channel': pattern.encode('utf-8')}
+            await self.queue.put(message)
+            await self._internal_queue.put(message)
 
     def send_message(self, message):
         self._internal_queue.put_nowait(message)
 
-    async def listen(self):
-        message = await self._internal_queue.get()
+    def handle_message(self, message):
+        if message['type'] in ('unsubscribe', 'punsubscribe'):
+            subscriptions = (self.channels
+                             if message['type'] == 'unsubscribe'
+                             else self.patterns)
+            subscriptions.pop(message['channel'].decode('utf-8'), None)
         print('Mock listener got message:', message)
         return message
 
+    async def listen(self):
+        if not self.subscribed:
+            return None
+        return self.handle_message(await self._internal_queue.get())
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            message = await asyncio.wait_for(self._internal_queue.get(),
+                                             timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            return None
+        return self.handle_message(message)
+
 
 class TestWebSocketHandler:
 
@@ -271,9 +970,9 @@ class TestWebSocketHandler:
             ('subscribe', {'path': expected}),
             ('subscribe', {'error':
                            'Already subscribed to path: {}'.format(expected)}),
-            ('ls', {'paths': [expected]}),
+            ('ls', {'paths': [expected], 'patterns': []}),
             ('unsubscribe', {'path': expected}),
-            ('ls', {'paths': []}),
+            ('ls', {'paths': [], 'patterns': []}),
             ('unsubscribe', {'error':
                              'Not subscribed to path: {}'.format(expected)}),
             ('subscribe', {'path': expected}),
@@ -294,13 +993,16 @@ class TestWebSocketHandler:
     def test_listen_for_message(self, client, server, data):
         function = 'message'
         type_ = 'CREATE'
-        path = '/a/path/s'
+        path = '/api/a/path/s'
         dt = json.dumps({'data': data, 'type': type_}).\
             encode('utf-8')
         m = {'channel': path.encode('utf-8'), 'type': function,
              'data': dt}
         server = server()
-        client = client('api', origin=self.origin)
+        client = client(path, origin=self.origin)
+        # Wait till the subscription is done.
+        result = json.loads(client.sync_recv())
+        assert result == {'function': 'subscribe', 'path': path}
         server.pubsub.send_message(m)
         result = client.sync_recv()
         result = json.loads(result)
@@ -344,19 +1046,225 @@ class TestWebSocketHandler:
         path = '/invalid/path'
         server = server()
         client = client(path, origin=self.origin)
-        assert not client.open
         with pytest.raises(websockets.ConnectionClosed) as excinfo:
-            client.sync_ping()
+            client.sync_recv()
+        assert not client.open
         exc = excinfo.value
         assert exc.code == 4004
         assert exc.reason == 'Invalid path'
 
     def test_unsubscribe_on_close(self, client, server):
+        path = '/api/path'
         server = server()
-        client = client(origin=self.origin)
+        client = client(path, origin=self.origin)
+        client.sync_recv()
+        message = server.pubsub.queue.get_nowait()
+        assert message == {'type': 'subscribe', 'channel': path.encode()}
         server.stop()
         message = server.pubsub.queue.get_nowait()
-        assert message == {'type': 'unsubscribe', 'channel': b'ALL'}
+        assert message == {'type': 'unsubscribe', 'channel': path.encode()}
+
+    def test_subscribe_once_per_channel(self, server, event_loop,
+                                        unused_tcp_port):
+        path = '/api/path'
+        url = 'ws://{}:{}{}'.format(self.host, unused_tcp_port, path)
+        server = server()
+        clients = [Client(loop=event_loop) for i in range(3)]
+        for other in clients:
+            other.start(url, self.origin)
+        try:
+            for other in clients:
+                other.sync_recv()
+            message = server.pubsub.queue.get_nowait()
+            assert message == {'type': 'subscribe',
+                               'channel': path.encode()}
+            assert server.pubsub.queue.empty()
+            server.pubsub.send_message({
+                'type': 'message', 'channel': path.encode(),
+                'data': json.dumps({'data': 'hello', 'type': 'CREATE'})})
+            for other in clients:
+                result = json.loads(other.sync_recv())
+                assert result['data'] == 'hello'
+            clients.pop().stop()
+            assert server.pubsub.queue.empty()
+        finally:
+            for other in clients:
+                other.stop()
+        server.stop()
+        message = server.pubsub.queue.get_nowait()
+        assert message == {'type': 'unsubscribe', 'channel': path.encode()}
+
+    def test_messages_while_consuming(self, client, server):
+        path = '/api/a/path'
+        server = server()
+        client = client(path, origin=self.origin)
+        client.sync_recv()
+        for i in range(50):
+            server.pubsub.send_message({
+                'type': 'message', 'channel': path.encode(),
+                'data': json.dumps({'data': i, 'type': 'CREATE'})})
+        client.sync_send(json.dumps({'function': 'ls'}))
+        results = [json.loads(client.sync_recv()) for i in range(51)]
+        events = [r['data'] for r in results if r['function'] == 'message']
+        # No event is lost and all are send in order.
+        assert events == list(range(50))
+        assert {'function': 'ls', 'paths': [path], 'patterns': []} in results
+
+    def send_messages(self, pubsub, path, data):
+        for i in data:
+            pubsub.send_message({
+                'type': 'message', 'channel': path.encode(),
+                'data': json.dumps({'data': i, 'type': 'CREATE'})})
+
+    def test_batch(self, client, server):
+        path = '/api/batched'
+        other = '/api/other'
+        server = server()
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe', 'path': path,
+                                     'batch': {'size': 3}}))
+        assert json.loads(client.sync_recv()) == {
+            'function': 'subscribe', 'path': path,
+            'batch': {'window': 0.05, 'size': 3}}
+        client.sync_send(json.dumps({'function': 'subscribe',
+                                     'path': other}))
+        client.sync_recv()
+        self.send_messages(server.pubsub, path, range(4))
+        self.send_messages(server.pubsub, other, ['a'])
+        self.send_messages(server.pubsub, path, [4])
+        results = [json.loads(client.sync_recv()) for i in range(4)]
+        # Batches of at most 3 events, an event of a subscription
+        # without batching ends a batch.
+        assert [[event['data'] for event in result]
+                if isinstance(result, list) else result['data']
+                for result in results] == [[0, 1, 2], [3], 'a', [4]]
+        assert results[0][0] == {'function': 'message', 'path': path,
+                                 'data': 0, 'type': 'CREATE'}
+
+    def test_batch_per_subscription(self, client, server):
+        path = '/api/batched'
+        other = '/api/other'
+        server = server()
+        client = client(origin=self.origin)
+        for subscription in (path, other):
+            client.sync_send(json.dumps({'function': 'subscribe',
+                                         'path': subscription,
+                                         'batch': True}))
+            client.sync_recv()
+        self.send_messages(server.pubsub, path, range(2))
+        self.send_messages(server.pubsub, other, ['a', 'b'])
+        self.send_messages(server.pubsub, path, [2])
+        results = [json.loads(client.sync_recv()) for i in range(3)]
+        # An event of another subscription ends a batch.
+        assert [[(event['path'], event['data']) for event in result]
+                for result in results] == [
+            [(path, 0), (path, 1)], [(other, 'a'), (other, 'b')],
+            [(path, 2)]]
+
+    def test_replay(self, client, server):
+        path = '/api/replayed'
+        redis = MockStreamRedis()
+        redis.add(path, 'a', 'b', 'c')
+        server = server(replay=websocket.EventReplay(redis))
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe', 'path': path,
+                                     'lastEventId': '1-0'}))
+        assert json.loads(client.sync_recv()) == {
+            'function': 'subscribe', 'path': path,
+            'replay': {'events': 2, 'complete': True}}
+        results = [json.loads(client.sync_recv()) for i in range(2)]
+        assert [(r['id'], r['data']) for r in results] == \
+            [('2-0', 'b'), ('3-0', 'c')]
+        # Live events follow the replayed events.
+        server.pubsub.send_message({
+            'type': 'message', 'channel': path.encode(),
+            'data': json.dumps({'id': '4-0', 'data': 'd',
+                                'type': 'CREATE'})})
+        assert json.loads(client.sync_recv())['id'] == '4-0'
+
+    def test_replay_batch(self, client, server):
+        path = '/api/replayed'
+        redis = MockStreamRedis()
+        redis.add(path, 'a', 'b', 'c')
+        server = server(replay=websocket.EventReplay(redis))
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe', 'path': path,
+                                     'lastEventId': '0', 'batch': True}))
+        assert json.loads(client.sync_recv())['replay'] == {
+            'events': 3, 'complete': False}
+        assert [event['data'] for event in
+                json.loads(client.sync_recv())] == ['a', 'b', 'c']
+
+    @pytest.mark.parametrize('last_id', ['a-b', 1, '', '1-2-3'])
+    def test_replay_invalid(self, client, server, last_id):
+        server = server(replay=websocket.EventReplay(MockStreamRedis()))
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe',
+                                     'path': '/api/a',
+                                     'lastEventId': last_id}))
+        result = json.loads(client.sync_recv())
+        assert result['error'] == 'Invalid lastEventId: {}'.format(last_id)
+
+    def test_replay_disabled(self, client, server):
+        server = server()
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe',
+                                     'path': '/api/a',
+                                     'lastEventId': '1-0'}))
+        assert json.loads(client.sync_recv())['replay'] == {
+            'events': 0, 'complete': False}
+
+    def test_subscribe_pattern(self, client, server):
+        pattern = '/api/salads/*/ingredients'
+        server = server()
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe',
+                                     'path': pattern, 'batch': True}))
+        assert json.loads(client.sync_recv()) == {
+            'function': 'subscribe', 'path': pattern,
+            'batch': {'window': 0.05, 'size': 50}}
+        client.sync_send(json.dumps({'function': 'ls'}))
+        assert json.loads(client.sync_recv()) == {
+            'function': 'ls', 'paths': [], 'patterns': [pattern]}
+        for path in ('/api/salads/a/ingredients', '/api/salads/a/comments'):
+            server.pubsub.send_message({
+                'type': 'pmessage', 'pattern': b'/api/salads/*/ingredients',
+                'channel': path.encode(),
+                'data': json.dumps({'data': path, 'type': 'CREATE'})})
+        assert json.loads(client.sync_recv()) == [{
+            'function': 'message', 'path': '/api/salads/a/ingredients',
+            'pattern': pattern, 'data': '/api/salads/a/ingredients',
+            'type': 'CREATE'}]
+        client.sync_send(json.dumps({'function': 'unsubscribe',
+                                     'path': pattern}))
+        assert json.loads(client.sync_recv()) == {
+            'function': 'unsubscribe', 'path': pattern}
+        client.sync_send(json.dumps({'function': 'ls'}))
+        assert json.loads(client.sync_recv())['patterns'] == []
+
+    @pytest.mark.parametrize('message, error', [
+        ({'path': '/api/sal*'}, 'Invalid pattern: /api/sal*'),
+        ({'path': '/api/*', 'lastEventId': '1-0'},
+         'Events of patterns can not be replayed.'),
+        ({'path': '/api/*', 'batch': 5}, 'Invalid batch: 5'),
+    ])
+    def test_subscribe_pattern_invalid(self, client, server, message,
+                                       error):
+        server = server()
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps(dict(message, function='subscribe')))
+        assert json.loads(client.sync_recv()) == {'function': 'subscribe',
+                                                  'error': error}
+
+    def test_batch_invalid(self, client, server):
+        server = server()
+        client = client(origin=self.origin)
+        client.sync_send(json.dumps({'function': 'subscribe',
+                                     'path': '/api/a', 'batch': 5}))
+        result = json.loads(client.sync_recv())
+        assert result['error'] == 'Invalid batch: 5'
+        client.sync_send(json.dumps({'function': 'ls'}))
+        assert json.loads(client.sync_recv())['paths'] == []
 
     def test_listen_empty_message(self, client, server):
         server = server()
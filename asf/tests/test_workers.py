@@ -0,0 +1,72 @@
+import functools
+import os
+import signal
+import time
+
+from asf import workers
+
+
+def exit_worker(directory, index):
+    with open(os.path.join(directory, str(os.getpid())), 'w') as f:
+        f.write(str(index))
+
+
+def sleep_worker(index, ignore_term=False):
+    if ignore_term:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(60)
+
+
+def test_restart(tmpdir):
+    supervisor = workers.Supervisor(
+        functools.partial(exit_worker, str(tmpdir)), 2, restart_delay=0.1)
+    supervisor.start()
+    try:
+        deadline = time.monotonic() + 5
+        while len(tmpdir.listdir()) < 6 and time.monotonic() < deadline:
+            supervisor.watch(0.1)
+    finally:
+        supervisor.stop()
+    indexes = [path.read() for path in tmpdir.listdir()]
+    assert indexes.count('0') >= 3
+    assert indexes.count('1') >= 3
+    assert supervisor.workers == {}
+
+
+def test_restart_delay(tmpdir):
+    supervisor = workers.Supervisor(
+        functools.partial(exit_worker, str(tmpdir)), 1, restart_delay=60)
+    supervisor.start()
+    process, _ = supervisor.workers[0]
+    process.join(5)
+    supervisor.watch(0.1)
+    assert supervisor.workers[0][0] is process
+    supervisor.stop()
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_stop():
+    supervisor = workers.Supervisor(sleep_worker, 3)
+    supervisor.start()
+    processes = [process for process, _ in supervisor.workers.values()]
+    assert len(set(process.pid for process in processes)) == 3
+    supervisor.stop()
+    assert [process.exitcode for process in processes] == \
+        [-signal.SIGTERM] * 3
+
+
+def test_stop_kill():
+    supervisor = workers.Supervisor(
+        functools.partial(sleep_worker, ignore_term=True), 1, timeout=0.2)
+    supervisor.start()
+    process, _ = supervisor.workers[0]
+    # Give the worker time to ignore SIGTERM.
+    time.sleep(0.2)
+    supervisor.stop()
+    assert process.exitcode == -signal.SIGKILL
+
+
+def test_signalled():
+    supervisor = workers.Supervisor(sleep_worker, 1)
+    supervisor.signalled(signal.SIGTERM, None)
+    assert supervisor.stopping
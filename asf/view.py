@@ -1,7 +1,14 @@
 import json
 import logging
+import time
+
+import morepath
+
+import transaction
 
 from . import app as app_module
+from .cache import document_key
+from . import metrics
 from . import model
 
 
@@ -18,24 +25,135 @@ def view_json_resource(self, request):
     return self
 
 
+@app_module.RootApp.view(model=metrics.AppMetrics)
+def view_metrics(self, request):
+    return morepath.Response(self.render(), content_type=self.content_type)
+
+
+@app_module.ResourceApp.json(model=model.Document)
+def view_json_document(self, request):
+    """Json view of a document.
+
+    The encoded json is kept in the representation cache of the root
+    app. A document with its children is not cached, as a change of the
+    children does not change the document itself.
+    """
+    key = None
+    if not request.params.get('children'):
+        key = document_key(self, request.application_url)
+    if key is None:
+        return self
+    cache = request.app.root.representation_cache
+    body = cache.get(*key)
+    if body is None:
+        body = json.dumps(self.dump_json(request),
+                          separators=(',', ':')).encode('utf-8')
+        cache.set(*key, body)
+    return morepath.Response(body=body, content_type='application/json')
+
+
+@app_module.ResourceApp.json(model=model.DocumentCollection)
+def view_json_collection(self, request):
+    """Json view of a collection.
+
+    With the stream parameter set, the documents are encoded one at a
+    time while the response is send, instead of all at once.
+    """
+    if request.params.get('stream'):
+        return morepath.Response(
+            app_iter=iter_json_collection(self, request),
+            content_type='application/json'
+        )
+    return self
+
+
+def iter_json_collection(collection, request):
+    """Encode the json of a collection in chunks.
+
+    The result is the same as the json of collection.dump_json.
+    """
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    documents, next_key = collection.get_page(request)
+    yield b'{"itemListElement":['
+    separator = b''
+    for document in documents:
+        yield separator + dumps(collection.dump_json_item(document, request))
+        separator = b','
+    # Add the other attributes to the encoded object.
+    yield b'],' + dumps(collection.dump_json_list(request,
+                                                  next_key=next_key))[1:]
+
+
 @app_module.ResourceApp.json(model=model.DocumentCollection,
                              request_method='POST',
                              body_model=model.Document)
 def create_document(self, request):
-    log = logging.getLogger(__name__)
     resource = self.add(request.body_obj)
+    time_commit(request)
 
     def redis_publish(response):
         # After function which will be save the object file to
         # redis if post was successfull.
-        log.debug('Publishing obj %r to redis', resource)
-        data = {'data': resource.dump_json(request),
-                'type': 'CREATE'}
-        request.app.root.redis.publish(request.path, json.dumps(data))
+        publish(request, [resource])
     request.after(redis_publish)
     return request.view(resource)
 
 
+@app_module.ResourceApp.json(model=model.DocumentCollection,
+                             request_method='POST',
+                             body_model=model.DocumentBatch)
+def create_documents(self, request):
+    """Create all documents of a json list in one transaction."""
+    resources = [self.add(document) for document in request.body_obj]
+    time_commit(request)
+
+    def redis_publish(response):
+        publish(request, resources)
+    request.after(redis_publish)
+    return [resource.dump_json(request) for resource in resources]
+
+
+def publish(request, resources, type_='CREATE'):
+    """Publish events for the resources to redis in one round trip.
+
+    With an event stream, the events are also appended to the stream of
+    the channel, so they can be replayed.
+    """
+    log = logging.getLogger(__name__)
+    log.debug('Publishing objs %r to redis', resources)
+    root = request.app.root
+    pipeline = root.redis.pipeline(transaction=False)
+    for resource in resources:
+        data = {'data': resource.dump_json(request),
+                'type': type_}
+        if root.event_stream is None:
+            pipeline.publish(request.path, json.dumps(data))
+        else:
+            root.event_stream.publish(pipeline, request.path,
+                                      json.dumps(data))
+    with root.metrics.publish_seconds.time():
+        pipeline.execute()
+
+
+def time_commit(request):
+    """Observe the duration of the commit of the request transaction."""
+    histogram = request.app.root.metrics.commit_seconds
+    start = []
+
+    def before_commit():
+        start.append(time.perf_counter())
+
+    def after_commit(status):
+        if status and start:
+            histogram.observe(time.perf_counter() - start[0])
+
+    current = transaction.get()
+    current.addBeforeCommitHook(before_commit)
+    current.addAfterCommitHook(after_commit)
+
+
 # TODO move to path.
 
 @app_module.ResourceApp.defer_links(model=model.Websocket)
@@ -59,9 +177,15 @@ def dump_json(self, request):
 
 @app_module.SaladsApp.load_json()
 def load_json_salad(json, request):
+    if isinstance(json, list):
+        return model.DocumentBatch.load_json(model.SaladDocument, json,
+                                             request)
     return model.SaladDocument.load_json(json, request)
 
 
 @app_module.IngredientsApp.load_json()
 def load_json_ingredient(json, request):
+    if isinstance(json, list):
+        return model.DocumentBatch.load_json(model.IngredientDocument, json,
+                                             request)
     return model.IngredientDocument.load_json(json, request)
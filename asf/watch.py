@@ -0,0 +1,132 @@
+"""Watch directory trees for changes."""
+import logging
+import os
+import threading
+
+from bowerstatic.autoversion import get_latest_filesystem_datetime
+
+try:
+    import inotify_simple
+except ImportError:  # pragma: no cover
+    inotify_simple = None
+
+
+def log():  # pragma: no cover
+    """Logger, is loaded on first use.
+
+    Thus we make sure it is loaded after our config is loaded.
+    """
+    return logging.getLogger(__name__)
+
+
+def latest_mtime(*paths):
+    """The latest modification time of the trees of paths."""
+    return max(get_latest_filesystem_datetime(path).timestamp()
+               for path in paths)
+
+
+class Watcher(object):
+    """Call callback, in a background thread, when paths change.
+
+    Uses inotify if inotify_simple is installed, else the modification
+    times of the trees are polled every interval seconds.
+    """
+
+    if inotify_simple is not None:
+        flags = (inotify_simple.flags.CREATE | inotify_simple.flags.DELETE |
+                 inotify_simple.flags.MODIFY | inotify_simple.flags.ATTRIB |
+                 inotify_simple.flags.MOVED_FROM |
+                 inotify_simple.flags.MOVED_TO |
+                 inotify_simple.flags.CLOSE_WRITE)
+
+    def __init__(self, paths, callback, interval=1.0, use_inotify=True):
+        self.paths = tuple(paths)
+        self.callback = callback
+        self.interval = interval
+        self.use_inotify = use_inotify and inotify_simple is not None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        # Get the initial state before returning, so no change is missed.
+        if self.use_inotify:
+            inotify = inotify_simple.INotify()
+            self._add_watches(inotify)
+            target, args = self._run_inotify, (inotify,)
+        else:
+            target, args = self._run_poll, (latest_mtime(*self.paths),)
+        self._thread = threading.Thread(target=target, args=args,
+                                        daemon=True, name='watcher')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception:
+            log().exception('Watcher callback failed.')
+
+    def _run_poll(self, mtime):
+        while not self._stop.wait(self.interval):
+            current = latest_mtime(*self.paths)
+            if current != mtime:
+                log().debug('Change found in %s.', self.paths)
+                mtime = current
+                self._notify()
+
+    def _add_watches(self, inotify):
+        for path in self.paths:
+            for dirpath, _, _ in os.walk(path):
+                # Adding an existing watch again is a no-op.
+                inotify.add_watch(dirpath, self.flags)
+
+    def _run_inotify(self, inotify):
+        with inotify:
+            while not self._stop.is_set():
+                events = inotify.read(timeout=int(self.interval * 1000))
+                if not events:
+                    continue
+                log().debug('Change found in %s.', self.paths)
+                # Watch new directories too.
+                self._add_watches(inotify)
+                self._notify()
+
+
+class LatestModified(object):
+    """Cache of the latest modification time of a directory tree.
+
+    The value is refreshed by a Watcher, unless it is frozen, then it
+    is only read once.
+    """
+
+    def __init__(self, path, frozen=False, interval=1.0):
+        self.path = path
+        self.frozen = frozen
+        self.value = None
+        self.refresh()
+        self.watcher = None
+        if not frozen:
+            self.watcher = Watcher([path], self.refresh, interval)
+
+    def refresh(self):
+        self.value = latest_mtime(self.path)
+
+    def start(self):
+        if self.watcher is not None:
+            self.watcher.start()
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
@@ -1,7 +1,12 @@
+import argparse
 import asyncio
 from asyncio.futures import CancelledError
+import collections
+from functools import partial
 import json
 import logging
+import re
+import signal
 from urllib import parse
 
 import aredis
@@ -11,25 +16,297 @@ import requests
 
 import websockets
 
+try:
+    from websockets.extensions import permessage_deflate
+except ImportError:  # pragma: no cover
+    # Extensions are supported since websockets 6.
+    permessage_deflate = None
+
 from .config import config, load_config
+from .events import parse_id, stream_key
+from .metrics import serve_metrics, WebsocketMetrics
+from .workers import Supervisor
+
 
+# The opcodes of data frames (RFC 6455), these are compressed.
+OP_CONT, OP_TEXT, OP_BINARY = 0x0, 0x1, 0x2
 
-def handler_factory(pubsub, *, loop=None):
+
+def handler_factory(pubsub, *, validator=None, metrics=None,
+                    queue_size=100, policy='drop-oldest', max_lag=None,
+                    batch=None, replay=None, loop=None):
     """Create a async handler for the websocket server.
 
     This allows for setting the pubsub class (usefull for testing).
+    All websockets share one router, which is the only user of pubsub,
+    one path validator and the metrics.
+    Every websocket gets a SendQueue of queue_size events, with the
+    slow consumer policy and max_lag. batch is the Batch used for
+    subscriptions asking for batched events. replay is the EventReplay
+    used for subscriptions asking for missed events.
     """
     log = logging.getLogger(__name__)
+    router = SubscriptionRouter(pubsub, loop=loop)
+    if validator is None:
+        validator = PathValidator(loop=loop)
+    if metrics is None:
+        metrics = WebsocketMetrics()
 
     async def handler(websocket, path):
         """Async websocket handler."""
         log.debug('Creating new websocket.')
-        with WebSocketHandler(websocket, path, pubsub, loop=loop) as self:
+        queue = SendQueue(queue_size, policy, max_lag, metrics=metrics,
+                          loop=loop)
+        with WebSocketHandler(websocket, path, router, validator,
+                              queue=queue, metrics=metrics, batch=batch,
+                              replay=replay, loop=loop) as self:
             await self.handle()
 
     return handler
 
 
+class SubscriptionRouter(object):
+    """Route redis messages to the websocket handlers.
+
+    One router is used per process. It subscribes to each redis channel
+    and pattern only once, and keeps track of the handlers subscribed to
+    it. Every message is delivered to all the handlers subscribed to its
+    channel, or to a pattern matching it.
+    A channel or pattern is only subscribed to again once the
+    confirmation of its unsubscribe is received, else the late
+    confirmation would undo the new subscription in pubsub.
+    The listener polls pubsub every timeout seconds, as it returns
+    immediately when it has no subscriptions.
+    """
+
+    def __init__(self, pubsub, *, timeout=1.0, loop=None):
+        self.log = logging.getLogger(__name__)
+        self._loop = loop or asyncio.get_event_loop()
+        self.pubsub = pubsub
+        self.timeout = timeout
+        # Map of channel to the set of handlers subscribed to it.
+        self.channels = {}
+        # Map of Pattern to the set of handlers subscribed to it.
+        self.patterns = {}
+        # Map of redis pattern to the set of Patterns using it.
+        self.globs = {}
+        # Map of (unsubscribe type, channel or redis pattern) to the
+        # future of the confirmation of the unsubscribe.
+        self.unsubscribing = {}
+        # The tasks unsubscribing the channels of removed handlers.
+        self.tasks = set()
+        self._listener = None
+
+    async def subscribe(self, path, handler):
+        if path in self.channels:
+            self.channels[path].add(handler)
+            return
+        self.channels[path] = {handler}
+        await self._unsubscribed('unsubscribe', path)
+        if path not in self.channels:
+            # Removed while waiting.
+            return
+        self.log.debug('Subscribing to channel: %s', path)
+        await self.pubsub.subscribe(path)
+        self._listen()
+
+    async def psubscribe(self, pattern, handler):
+        if pattern in self.patterns:
+            self.patterns[pattern].add(handler)
+            return
+        self.patterns[pattern] = {handler}
+        patterns = self.globs.setdefault(pattern.glob, set())
+        patterns.add(pattern)
+        if len(patterns) > 1:
+            # Another pattern uses the same redis pattern.
+            return
+        await self._unsubscribed('punsubscribe', pattern.glob)
+        if pattern.glob not in self.globs:
+            # Removed while waiting.
+            return
+        self.log.debug('Subscribing to pattern: %s', pattern.glob)
+        await self.pubsub.psubscribe(pattern.glob)
+        self._listen()
+
+    def _listen(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.ensure_future(self.listen(),
+                                                   loop=self._loop)
+
+    async def _unsubscribed(self, type_, name):
+        """Wait for the confirmation of a running unsubscribe of name."""
+        future = self.unsubscribing.get((type_, name))
+        if future is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(future, loop=self._loop),
+                                   self.timeout * 5, loop=self._loop)
+        except asyncio.TimeoutError:
+            self.log.warning('No confirmation of %s %s.', type_, name)
+            self._confirm(type_, name)
+
+    def _confirm(self, type_, name):
+        future = self.unsubscribing.pop((type_, name), None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _unsubscribe(self, type_, names):
+        """Unsubscribe from names, type_ is unsubscribe or punsubscribe.
+
+        The unsubscribe is marked as running right away, the returned
+        coroutine sends it.
+        """
+        for name in names:
+            self.unsubscribing.setdefault((type_, name),
+                                          self._loop.create_future())
+        return self._send_unsubscribe(type_, names)
+
+    async def _send_unsubscribe(self, type_, names):
+        try:
+            await getattr(self.pubsub, type_)(*names)
+        except Exception:
+            # No confirmation will come.
+            for name in names:
+                self._confirm(type_, name)
+            raise
+        self._listen()
+
+    async def unsubscribe(self, path, handler):
+        paths = self._discard(handler, [path])
+        if paths:
+            await self._unsubscribe('unsubscribe', paths)
+
+    async def punsubscribe(self, pattern, handler):
+        globs = self._discard_patterns(handler, [pattern])
+        if globs:
+            await self._unsubscribe('punsubscribe', globs)
+
+    def remove(self, handler):
+        """Remove handler from all its channels and patterns.
+
+        Unsubscribes, in a task, from the channels and patterns no
+        handler is subscribed to anymore. Returns the task or None.
+        """
+        paths = self._discard(handler, list(self.channels))
+        globs = self._discard_patterns(handler, list(self.patterns))
+        coroutines = []
+        if paths:
+            coroutines.append(self._unsubscribe('unsubscribe', paths))
+        if globs:
+            coroutines.append(self._unsubscribe('punsubscribe', globs))
+        if not coroutines:
+            return None
+        task = asyncio.gather(*coroutines, loop=self._loop)
+        self.tasks.add(task)
+        task.add_done_callback(self._removed)
+        return task
+
+    def _removed(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error('Unsubscribing failed: %s', task.exception())
+
+    def _discard(self, handler, paths):
+        """Remove handler from paths, return the paths without handlers."""
+        empty = []
+        for path in paths:
+            handlers = self.channels.get(path)
+            if handlers is None:
+                continue
+            handlers.discard(handler)
+            if not handlers:
+                del self.channels[path]
+                empty.append(path)
+        if empty:
+            self.log.debug('Unsubscribing from channels: %s', empty)
+        return empty
+
+    def _discard_patterns(self, handler, patterns):
+        """Remove handler from patterns.
+
+        Returns the redis patterns that are not used anymore.
+        """
+        empty = []
+        for pattern in patterns:
+            handlers = self.patterns.get(pattern)
+            if handlers is None:
+                continue
+            handlers.discard(handler)
+            if handlers:
+                continue
+            del self.patterns[pattern]
+            used = self.globs[pattern.glob]
+            used.discard(pattern)
+            if not used:
+                del self.globs[pattern.glob]
+                empty.append(pattern.glob)
+        if empty:
+            self.log.debug('Unsubscribing from patterns: %s', empty)
+        return empty
+
+    async def listen(self):
+        """Listen to the redis server till no subscriptions are left.
+
+        Also till all unsubscribes are confirmed.
+        """
+        while self.channels or self.patterns or self.unsubscribing:
+            message = await self.pubsub.get_message(timeout=self.timeout)
+            self.log.debug('Message from redis server: %r', message)
+            if not message:
+                continue
+            try:
+                self.route(message)
+            except Exception:
+                # Keep listening for the other messages.
+                self.log.exception('Routing message %r failed.', message)
+
+    def route(self, message):
+        type_ = decode(message['type'])
+        if type_ == 'pmessage':
+            self.route_pattern(message)
+            return
+        if type_ in ('unsubscribe', 'punsubscribe'):
+            self._confirm(type_, decode(message['channel']))
+            return
+        if type_ != 'message':
+            # Ignore the subscribe confirmations.
+            return
+        path = message['channel']
+        if isinstance(path, bytes):
+            path = path.decode('utf-8')
+        handlers = self.channels.get(path)
+        if not handlers:
+            return
+        try:
+            # Encode once, all handlers send the same frame.
+            event = encode_message(message)
+        except (ValueError, KeyError) as e:
+            self.log.warning('Invalid message on channel %s: %s', path, e)
+            return
+        for handler in handlers:
+            handler.deliver(event)
+
+    def route_pattern(self, message):
+        """Deliver a message to the handlers of the patterns matching it.
+
+        Redis patterns match any characters, the Patterns only whole
+        segments of the path. So the message is only delivered to the
+        Patterns of the redis pattern that match its path.
+        """
+        path = decode(message['channel'])
+        for pattern in self.globs.get(decode(message['pattern']), ()):
+            if not pattern.match(path):
+                continue
+            try:
+                event = encode_message(message, pattern=pattern.text)
+            except (ValueError, KeyError) as e:
+                self.log.warning('Invalid message on channel %s: %s',
+                                 path, e)
+                return
+            for handler in self.patterns[pattern]:
+                handler.deliver(event)
+
+
 class WebSocketHandler(object):
     """WebSocket handler.
 
@@ -38,7 +315,8 @@ class WebSocketHandler(object):
 
     functions = ('ls', 'subscribe', 'unsubscribe')
 
-    def __init__(self, websocket, path, pubsub, *, loop=None):
+    def __init__(self, websocket, path, router, validator, *, queue=None,
+                 metrics=None, batch=None, replay=None, loop=None):
         self.log = logging.getLogger(__name__)
         self.log.debug('init')
         self._loop = loop
@@ -49,46 +327,47 @@ class WebSocketHandler(object):
         self.origin = self.websocket.request_headers['origin'] or ''
         self.log.debug('Origin: %r', self.origin)
         self.subscriptions = set()
-        # A lock wich will lock till for ever. Used to have the producer
-        # in waiting state if no message was recieved from redis server.
-        self._lock = self._loop.create_future()
+        # Map of the text of the pattern subscriptions to their Pattern.
+        self.patterns = {}
+        # The default and maximum batching of subscriptions.
+        self.batch = batch or Batch()
+        # Map of path to the Batch of subscriptions with batched events.
+        self.batches = {}
+        self.replay = replay
+        # Map of path to the live events delivered while replaying the
+        # missed events of the path.
+        self.replaying = {}
+        if metrics is None:
+            metrics = WebsocketMetrics()
+        self.metrics = metrics
+        # Events delivered by the router, waiting to be send.
+        if queue is None:
+            queue = SendQueue(metrics=metrics, loop=loop)
+        self.queue = queue
         self.tasks = []
-        # Redis connect, make sure we have a pool.
-        self.pubsub = pubsub
+        self._closing = None
+        self.router = router
+        self.validator = validator
         path = path.rstrip('/')
         if path.endswith('/ws'):
             path = path[:-3]
-        if not is_valid_app_path(path):
-            # If path is invalid, close connection.
-            self.log.debug('Invalid path closing connection.')
-            asyncio.ensure_future(websocket.close(4004, 'Invalid path'),
-                                  loop=self._loop)
-            return
-        # Don't try to subscribe to the main '/api' url.
-        if path != '/api':
-            asyncio.ensure_future(
-                self.subscribe({'path': path}),
-                loop=self._loop
-            )
+        self.path = path
         self.log.debug('init done')
 
     def __enter__(self):
+        self.metrics.connections.inc()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # Clean-up.
         try:
-            # Close lock.
-            self._lock.set_result(None)
             # Cancel all tasks.
             [t.cancel() for t in self.tasks]
             # Unsubscribe to all subscriptions.
-            asyncio.wait_for(
-                asyncio.ensure_future(
-                    self.pubsub.unsubscribe(), loop=self._loop
-                ),
-                None, loop=self._loop
-            )
+            self.router.remove(self)
+            self.queue.clear()
+            self.metrics.connections.dec()
+            self.observe_compression()
         except Exception as e:  # pragma: no cover
             self.log.exception('Clean-up failed: %s', e)
         if exc_type:
@@ -102,36 +381,48 @@ class WebSocketHandler(object):
                 self.log.exception('Websocket handling failed: %s', exc_type,
                                    exc_info=(exc_type, exc_val, exc_tb))
 
+    def observe_compression(self):
+        """Observe the compression ratio of the closed connection."""
+        for extension in getattr(self.websocket, 'extensions', ()):
+            if isinstance(extension, CompressionStats) and \
+                    extension.payload_bytes:
+                self.log.debug('Compressed %s bytes to %s bytes.',
+                               extension.payload_bytes,
+                               extension.compressed_bytes)
+                self.metrics.compression_ratio.observe(extension.ratio)
+
     async def handle(self):
         self.log.debug('handlingen')
-        while True:
-            self.tasks.append(asyncio.ensure_future(self.consumer(),
-                                                    loop=self._loop))
-            self.tasks.append(asyncio.ensure_future(self.producer(),
-                                                    loop=self._loop))
-            # Wait for any of the tasks to be done.
-            done, pending = await asyncio.wait(
-                self.tasks,
-                loop=self._loop,
-                return_when=asyncio.FIRST_COMPLETED)
-            self.log.debug('Done tasks: %s.', done)
-            self.log.debug('Pending tasks: %s.', pending)
-            for task in done:
-                try:
-                    func, message = task.result()
-                except CancelledError:
-                    continue
-                self.log.debug('running function %s on message %s',
-                               func, message)
-                await func(message)
-            for task in pending:
-                task.cancel()
-            self.tasks = []
+        if not await self.validator.is_valid(self.path):
+            # If path is invalid, close connection.
+            self.log.debug('Invalid path closing connection.')
+            await self.websocket.close(4004, 'Invalid path')
+            return
+        # Don't try to subscribe to the main '/api' url.
+        if self.path != '/api':
+            await self.subscribe({'path': self.path})
+        # One task receives the client messages, the other sends the
+        # events of the router. They run till the connection is closed.
+        self.tasks = [
+            asyncio.ensure_future(self.consumer(), loop=self._loop),
+            asyncio.ensure_future(self.producer(), loop=self._loop),
+        ]
+        done, pending = await asyncio.wait(
+            self.tasks,
+            loop=self._loop,
+            return_when=asyncio.FIRST_COMPLETED)
+        self.log.debug('Done tasks: %s.', done)
+        for task in done:
+            # Raise the error that stopped the task, the pending task is
+            # cancelled on exit.
+            task.result()
 
     async def consumer(self):
-        message = await self.websocket.recv()
-        self.log.debug('Got message from client: %s', message)
-        return self._consumer, message
+        """Handle the messages of the client."""
+        while True:
+            message = await self.websocket.recv()
+            self.log.debug('Got message from client: %s', message)
+            await self._consumer(message)
 
     async def _consumer(self, message):
         self.log.debug('Running consumer on message %s', message)
@@ -165,15 +456,37 @@ class WebSocketHandler(object):
 
     async def ls(self, message):
         message = {'function': 'ls',
-                   'paths': sorted(self.subscriptions)}
+                   'paths': sorted(self.subscriptions),
+                   'patterns': sorted(self.patterns)}
         await self.websocket.send(json.dumps(message))
 
     async def subscribe(self, message):
         # redis subscribe
         path = message['path']
         path = parse_path(path, self.origin)
+        if '*' in path:
+            await self.subscribe_pattern(path, message)
+            return
         if path not in self.subscriptions:
-            if not is_valid_app_path(path):
+            try:
+                batch = self.batch.parse(message.get('batch'))
+            except (AttributeError, TypeError, ValueError):
+                await self.websocket.send(json.dumps(
+                    {'function': 'subscribe',
+                     'error': 'Invalid batch: {}'.format(message['batch'])}
+                ))
+                return
+            last_id = message.get('lastEventId')
+            if last_id is not None:
+                try:
+                    parse_id(last_id)
+                except (AttributeError, ValueError):
+                    await self.websocket.send(json.dumps(
+                        {'function': 'subscribe',
+                         'error': 'Invalid lastEventId: {}'.format(last_id)}
+                    ))
+                    return
+            if not await self.validator.is_valid(path):
                 # If path is not valid, send en error message and
                 # do not subscribe to it.
                 await self.websocket.send(json.dumps(
@@ -181,56 +494,546 @@ class WebSocketHandler(object):
                 ))
                 return
             self.log.debug('Subscribing to path: %s', path)
-            await self.pubsub.subscribe(path)
-            self.subscriptions.add(path)
-            # self._subscriber.set_result(None)
+            if last_id is not None:
+                # Hold the live events till the missed ones are send.
+                self.replaying[path] = []
+            try:
+                await self.router.subscribe(path, self)
+                self.subscriptions.add(path)
+                response = {'function': 'subscribe', 'path': path}
+                if batch is not None:
+                    self.batches[path] = batch
+                    response['batch'] = batch._asdict()
+                if last_id is None:
+                    await self.websocket.send(json.dumps(response))
+                else:
+                    await self.replay_events(path, last_id, batch, response)
+            finally:
+                held = self.replaying.pop(path, [])
+            for event in held:
+                self.deliver(event)
         else:
             await self.websocket.send(json.dumps(
                 {'function': 'subscribe',
                  'error': 'Already subscribed to path: {}'.format(path)}
             ))
 
+    async def subscribe_pattern(self, text, message):
+        """Subscribe to the paths matching the pattern text.
+
+        The path before the first wildcard must be valid.
+        """
+        try:
+            pattern = Pattern(text)
+        except ValueError:
+            await self.websocket.send(json.dumps(
+                {'function': 'subscribe',
+                 'error': 'Invalid pattern: {}'.format(text)}
+            ))
+            return
+        if text in self.patterns:
+            await self.websocket.send(json.dumps(
+                {'function': 'subscribe',
+                 'error': 'Already subscribed to path: {}'.format(text)}
+            ))
+            return
+        if message.get('lastEventId') is not None:
+            await self.websocket.send(json.dumps(
+                {'function': 'subscribe',
+                 'error': 'Events of patterns can not be replayed.'}
+            ))
+            return
+        try:
+            batch = self.batch.parse(message.get('batch'))
+        except (AttributeError, TypeError, ValueError):
+            await self.websocket.send(json.dumps(
+                {'function': 'subscribe',
+                 'error': 'Invalid batch: {}'.format(message['batch'])}
+            ))
+            return
+        if not await self.validator.is_valid(pattern.prefix):
+            await self.websocket.send(json.dumps(
+                {'error': 'Invalid path: {}'.format(text)}
+            ))
+            return
+        self.log.debug('Subscribing to pattern: %s', text)
+        await self.router.psubscribe(pattern, self)
+        self.patterns[text] = pattern
+        response = {'function': 'subscribe', 'path': text}
+        if batch is not None:
+            self.batches[text] = batch
+            response['batch'] = batch._asdict()
+        await self.websocket.send(json.dumps(response))
+
+    async def replay_events(self, path, last_id, batch, response):
+        """Send the events of path after last_id, with response.
+
+        The response tells how many events are replayed and whether they
+        are complete. The live events held meanwhile that were replayed
+        are removed.
+        """
+        if self.replay is None:
+            events, complete = [], False
+        else:
+            events, complete = await self.replay.events(path, last_id)
+        response['replay'] = {'events': len(events), 'complete': complete}
+        await self.websocket.send(json.dumps(response))
+        if batch is None:
+            for event in events:
+                await self._producer(event)
+        else:
+            for i in range(0, len(events), batch.size):
+                await self._send_batch(events[i:i + batch.size])
+        self.metrics.sent_events.inc(len(events))
+        if events:
+            last_id = events[-1].id
+        last = parse_id(last_id)
+        self.replaying[path] = [event for event in self.replaying[path]
+                                if event.id is None or
+                                parse_id(event.id) > last]
+
     async def unsubscribe(self, message):
         path = message['path']
         path = parse_path(path, self.origin)
-        if path in self.subscriptions:
-            await self.pubsub.unsubscribe(path)
+        if path in self.patterns:
+            pattern = self.patterns.pop(path)
+            self.batches.pop(path, None)
+            await self.router.punsubscribe(pattern, self)
+            await self.websocket.send(json.dumps(
+                {'function': 'unsubscribe', 'path': path}
+            ))
+        elif path in self.subscriptions:
             self.subscriptions.remove(path)
+            self.batches.pop(path, None)
+            await self.router.unsubscribe(path, self)
+            await self.websocket.send(json.dumps(
+                {'function': 'unsubscribe', 'path': path}
+            ))
         else:
             await self.websocket.send(json.dumps(
                 {'function': 'unsubscribe',
                  'error': 'Not subscribed to path: {}'.format(path)}
             ))
 
+    def deliver(self, event):
+        """Deliver an event from the router to this websocket.
+
+        Closes the websocket if it can not keep up with the events.
+        """
+        if self._closing is not None:
+            return
+        held = self.replaying.get(event.subscription)
+        if held is not None:
+            held.append(event)
+            return
+        if not self.queue.put(event):
+            self.log.info('Closing websocket, it is too slow.')
+            self.metrics.disconnects.inc()
+            self.queue.clear()
+            self._closing = asyncio.ensure_future(
+                self.websocket.close(4008, 'Too slow'), loop=self._loop)
+
     async def producer(self):
-        message = await self.pubsub.listen()
-        if not message:
-            # Not subscribed yet, just lock till a task is done.
-            await self._lock
-        self.log.debug('Message from redis server: %r', message)
-        return self._producer, message
-
-    async def _producer(self, message):
-        r_message = message
-        self.log.debug('Running producer on message %s', message)
-        function = r_message['type']
-        if isinstance(function, bytes):
-            function = function.decode('utf-8')
-        path = r_message['channel']
-        if isinstance(path, bytes):
-            path = path.decode('utf-8')
-        w_message = {'function': function,
-                     'path': path}
-        if function == 'message':
-            data = r_message['data']
-            if isinstance(data, bytes):
-                data = data.decode('utf-8')
-            data = json.loads(data)
-            w_message.update({'data': data['data'],
-                             'type': data['type']})
-        self.log.debug('Message send over websocket: %s',
-                       w_message)
-        await self.websocket.send(json.dumps(w_message))
+        """Send the events delivered by the router.
+
+        The events of subscriptions with batching are collected during
+        the window of the batch and send as one frame. A frame only has
+        the events of one subscription.
+        """
+        while True:
+            event = await self.queue.get()
+            self.log.debug('Event from router: %r', event)
+            batch = self.batches.get(event.subscription)
+            if batch is None:
+                await self._producer(event)
+                self.metrics.sent_events.inc()
+                continue
+            events = [event]
+            deadline = self._loop.time() + batch.window
+            while len(events) < batch.size:
+                if not self.queue:
+                    timeout = deadline - self._loop.time()
+                    if timeout <= 0:
+                        break
+                    await self.queue.wait(timeout)
+                elif self.queue.peek().subscription == event.subscription:
+                    events.append(self.queue.get_nowait())
+                else:
+                    # Keep the order of the events.
+                    break
+            await self._send_batch(events)
+            self.metrics.sent_events.inc(len(events))
+
+    async def _send_batch(self, events):
+        self.log.debug('Sending batch of %s events.', len(events))
+        # The frames are json, so join them into a json array.
+        await self.websocket.send(
+            '[{}]'.format(','.join(event.frame for event in events)))
+
+    async def _producer(self, event):
+        self.log.debug('Event send over websocket: %s', event.frame)
+        await self.websocket.send(event.frame)
+
+
+class SendQueue(object):
+    """The bounded queue of the events to send over a websocket.
+
+    If a websocket does not keep up, its queue fills up and the policy
+    decides what is done with a new event:
+
+    drop-oldest
+        The oldest event is dropped.
+    coalesce
+        The oldest event with the same path and subscription is
+        dropped, so only the latest events of a path are kept. If there
+        is none, the oldest event is dropped.
+    disconnect
+        The event is not queued and the websocket must be closed. This
+        is also done if the oldest event waited more than max_lag
+        seconds.
+    """
+
+    policies = ('drop-oldest', 'coalesce', 'disconnect')
+
+    def __init__(self, maxsize=100, policy='drop-oldest', max_lag=None, *,
+                 metrics=None, loop=None):
+        if policy not in self.policies:
+            raise ValueError('Policy must be one of: {}.'.format(
+                ', '.join(self.policies)))
+        self._loop = loop or asyncio.get_event_loop()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_lag = max_lag
+        if metrics is None:
+            metrics = WebsocketMetrics()
+        self.metrics = metrics
+        # (time queued, event) pairs.
+        self._queue = collections.deque()
+        self._getter = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def lag(self):
+        """Seconds the oldest event is waiting."""
+        if not self._queue:
+            return 0
+        return self._loop.time() - self._queue[0][0]
+
+    def put(self, event):
+        """Queue event, return False if the websocket must be closed."""
+        if self.policy == 'disconnect':
+            if len(self._queue) >= self.maxsize or (
+                    self.max_lag is not None and self.lag() > self.max_lag):
+                return False
+        elif len(self._queue) >= self.maxsize:
+            self._drop(event)
+        self._queue.append((self._loop.time(), event))
+        self.metrics.queued_events.inc()
+        if self._getter is not None:
+            self._wake(self._getter)
+        return True
+
+    @staticmethod
+    def _wake(getter):
+        if not getter.done():
+            getter.set_result(None)
+
+    def _drop(self, event):
+        index = 0
+        if self.policy == 'coalesce':
+            for i, (_, queued) in enumerate(self._queue):
+                if queued.path == event.path and \
+                        queued.pattern == event.pattern:
+                    index = i
+                    break
+        del self._queue[index]
+        self.metrics.queued_events.dec()
+        self.metrics.dropped_events.inc(policy=self.policy)
+
+    async def get(self):
+        """Get the oldest event, waiting for one if the queue is empty."""
+        while not self._queue:
+            await self.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        """Get the oldest event, the queue must not be empty."""
+        self.metrics.queued_events.dec()
+        return self._queue.popleft()[1]
+
+    def peek(self):
+        """The oldest event, the queue must not be empty."""
+        return self._queue[0][1]
+
+    async def wait(self, timeout=None):
+        """Wait till an event is put in the queue, or timeout seconds."""
+        self._getter = getter = self._loop.create_future()
+        if timeout is not None:
+            timer = self._loop.call_later(timeout, self._wake, getter)
+        try:
+            await getter
+        finally:
+            if timeout is not None:
+                timer.cancel()
+
+    def clear(self):
+        self.metrics.queued_events.dec(len(self._queue))
+        self._queue.clear()
+
+
+class Batch(collections.namedtuple('Batch', ['window', 'size'])):
+    """Batching of events, send as one frame.
+
+    The events arriving within window seconds of the first one, up to
+    size events, are send together.
+    """
+
+    def __new__(cls, window=0.05, size=50):
+        return super().__new__(cls, window, size)
+
+    def parse(self, value):
+        """Get the batching a client asks for, limited by this batch.
+
+        value is true for this batch or a dict with the window and or
+        size. If value is None or false there is no batching, None is
+        returned.
+        """
+        if value is None or value is False:
+            return None
+        if value is True:
+            return self
+        window = float(value.get('window', self.window))
+        size = int(value.get('size', self.size))
+        if window < 0 or size < 1:
+            raise ValueError('Invalid batch.')
+        return Batch(min(window, self.window), min(size, self.size))
+
+
+class DeflateFactory(object):
+    """Factory of the permessage-deflate extension, with statistics.
+
+    Wraps the extension factory of websockets, so every connection
+    using compression gets a CompressionStats extension.
+    """
+
+    def __init__(self, factory, min_size=0, metrics=None):
+        self.factory = factory
+        self.name = factory.name
+        self.min_size = min_size
+        self.metrics = metrics
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = self.factory.process_request_params(
+            params, accepted_extensions)
+        return response_params, CompressionStats(extension, self.min_size,
+                                                 self.metrics)
+
+
+class CompressionStats(object):
+    """The permessage-deflate extension of a connection, with statistics.
+
+    Messages smaller than min_size bytes are not compressed, the
+    extension allows sending any message uncompressed.
+    """
+
+    data_opcodes = (OP_CONT, OP_TEXT, OP_BINARY)
+
+    def __init__(self, extension, min_size=0, metrics=None):
+        self.extension = extension
+        self.name = extension.name
+        self.min_size = min_size
+        self.metrics = metrics
+        self.payload_bytes = 0
+        self.compressed_bytes = 0
+
+    @property
+    def ratio(self):
+        """The compressed size as fraction of the size of the payload."""
+        if not self.payload_bytes:
+            return 1.0
+        return self.compressed_bytes / self.payload_bytes
+
+    def decode(self, frame, **kw):
+        return self.extension.decode(frame, **kw)
+
+    def encode(self, frame):
+        if frame.opcode not in self.data_opcodes:
+            return self.extension.encode(frame)
+        if frame.opcode != OP_CONT and frame.fin and \
+                len(frame.data) < self.min_size:
+            # A message of a single frame, too small to compress.
+            encoded = frame
+        else:
+            encoded = self.extension.encode(frame)
+        self.payload_bytes += len(frame.data)
+        self.compressed_bytes += len(encoded.data)
+        if self.metrics is not None:
+            self.metrics.payload_bytes.inc(len(frame.data))
+            self.metrics.compressed_bytes.inc(len(encoded.data))
+        return encoded
+
+
+def deflate_factory(window_bits=15, mem_level=8, min_size=0, metrics=None):
+    """Create the DeflateFactory for the websocket server.
+
+    window_bits and mem_level are the zlib settings of the compression
+    of the messages send. Returns None if websockets does not support
+    extensions.
+    """
+    if permessage_deflate is None:
+        return None
+    factory = permessage_deflate.ServerPerMessageDeflateFactory(
+        server_max_window_bits=window_bits,
+        compress_settings={'memLevel': mem_level})
+    return DeflateFactory(factory, min_size, metrics)
+
+
+class EventReplay(object):
+    """Read the missed events of a path from its redis stream.
+
+    At most count events are replayed.
+    """
+
+    def __init__(self, redis, *, count=1000):
+        self.log = logging.getLogger(__name__)
+        self.redis = redis
+        self.count = count
+
+    async def events(self, path, last_id):
+        """Get the events of path after the event with id last_id.
+
+        Returns the events and whether they are complete. They are not if
+        last_id is not in the stream anymore, or there are more than
+        count events after it.
+        """
+        try:
+            # The range includes last_id, so get one more.
+            entries = await self.redis.xrange(stream_key(path),
+                                              start=last_id,
+                                              count=self.count + 1)
+        except aredis.RedisError as e:
+            self.log.warning('Could not replay events of %s: %s', path, e)
+            return [], False
+        entries = [(decode(entry_id), fields) for entry_id, fields in entries]
+        complete = bool(entries) and \
+            parse_id(entries[0][0]) == parse_id(last_id)
+        if complete:
+            entries = entries[1:]
+            complete = len(entries) < self.count
+        events = []
+        for entry_id, fields in entries[:self.count]:
+            message = {'type': 'message', 'channel': path,
+                       'data': fields.get(b'event', fields.get('event'))}
+            try:
+                events.append(encode_message(message, entry_id))
+            except (ValueError, KeyError, TypeError) as e:
+                self.log.warning('Invalid event %s of %s: %s',
+                                 entry_id, path, e)
+        return events, complete
+
+
+class Event(collections.namedtuple('Event',
+                                   ['path', 'frame', 'id', 'pattern'])):
+    """A redis message, encoded as websocket frame.
+
+    The same event is send to all websockets subscribed to its path, or
+    to its pattern if it was published to a pattern. The id is the id of
+    the event in the stream of the path, if it has one.
+    """
+
+    def __new__(cls, path, frame, id=None, pattern=None):
+        return super().__new__(cls, path, frame, id, pattern)
+
+    @property
+    def subscription(self):
+        """The path or pattern the event was published to."""
+        return self.pattern or self.path
+
+
+class Pattern(object):
+    """A pattern of paths, to subscribe to all matching paths.
+
+    A segment of the pattern is either a literal, or "*" to match any one
+    segment. The last segment may also be "**", to match one or more
+    segments. For example "/api/salads/*/ingredients" matches the
+    ingredients of every salad and "/api/salads/**" everything within
+    the salads.
+    """
+
+    def __init__(self, text):
+        segments = text.split('/')
+        for i, segment in enumerate(segments):
+            if '*' in segment and segment not in ('*', '**') or \
+                    segment == '**' and i != len(segments) - 1:
+                raise ValueError('Invalid segment: {}'.format(segment))
+        if '*' not in segments and '**' not in segments:
+            raise ValueError('Pattern without wildcard.')
+        self.text = text
+        # The paths that must exist for a matching path.
+        wildcard = min(segments.index(w) for w in ('*', '**')
+                       if w in segments)
+        self.prefix = '/'.join(segments[:wildcard])
+        # The redis pattern, matching a superset of the paths.
+        self.glob = '/'.join('*' if segment in ('*', '**')
+                             else re.sub(r'([?*\[\]\\])', r'\\\1', segment)
+                             for segment in segments)
+        self.regex = re.compile('/'.join(
+            '[^/]+' if segment == '*' else '.+' if segment == '**'
+            else re.escape(segment) for segment in segments) + '$')
+
+    def match(self, path):
+        return self.regex.match(path) is not None
+
+    def __eq__(self, other):
+        return isinstance(other, Pattern) and self.text == other.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return 'Pattern({!r})'.format(self.text)
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def encode_message(message, event_id=None, pattern=None):
+    """Create the Event for a redis message.
+
+    The id of the event is the id published with the message, or
+    event_id. pattern is the text of the Pattern for a message published
+    to a pattern.
+    Raises a ValueError if the data of the message is not a json object.
+    """
+    function = message['type']
+    if isinstance(function, bytes):
+        function = function.decode('utf-8')
+    if function == 'pmessage':
+        function = 'message'
+    path = message['channel']
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    w_message = {'function': function,
+                 'path': path}
+    if pattern is not None:
+        w_message['pattern'] = pattern
+    if function == 'message':
+        data = message['data']
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        data = json.loads(data)
+        if not isinstance(data, dict):
+            raise ValueError('Message data is not a json object.')
+        event_id = data.get('id', event_id)
+        w_message.update({'data': data['data'],
+                          'type': data['type']})
+        if event_id is not None:
+            w_message['id'] = event_id
+    return Event(path, json.dumps(w_message), event_id, pattern)
 
 
 def parse_path(path, origin):
@@ -260,11 +1063,14 @@ def parse_path(path, origin):
     return path
 
 
-def is_valid_app_path(path):
+def is_valid_app_path(path, session=None, timeout=None):
     """Check that the path is a existing app path.
 
     App paths shoud always start with "api" and should not return an
     http error status.
+    This does a blocking http request, use a PathValidator inside the
+    event loop. The request raises a requests.Timeout if the app server
+    does not respond within timeout seconds.
     """
     # Path must start with 'api'.
     log = logging.getLogger(__name__)
@@ -273,8 +1079,10 @@ def is_valid_app_path(path):
         url = 'http://{host}:{port}/{path}'.format(host=config['host'].get(),
                                                    port=config['port'].get(),
                                                    path=path.lstrip('/'))
+        if session is None:
+            session = requests
         # Use a local connection to try and connect to this url.
-        response = requests.get(url)
+        response = session.get(url, timeout=timeout)
         # If connection is succesful (status code lower than 400 or higher
         # than 599 return True.
         return not 400 <= response.status_code < 600
@@ -283,20 +1091,124 @@ def is_valid_app_path(path):
     return False
 
 
-def setup(loop):
+class PathValidator(object):
+    """Check app paths without blocking the event loop.
+
+    The http requests are done in the default executor, using one
+    session so the connections to the app server are reused. Valid
+    paths are kept in a least recently used cache of at most `size`
+    paths for `ttl` seconds. Invalid paths are not cached, as a document
+    may be created at the path any moment. Concurrent checks of the same
+    path share one request. A request taking more than `timeout` seconds
+    fails, the path is then invalid but not cached.
+    """
+
+    def __init__(self, *, size=1024, ttl=60, timeout=5.0, loop=None):
+        self.log = logging.getLogger(__name__)
+        self._loop = loop or asyncio.get_event_loop()
+        self.size = size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Map of valid path to its expire time.
+        self._cache = collections.OrderedDict()
+        # Map of path to the future of the running request.
+        self._pending = {}
+
+    async def is_valid(self, path):
+        now = self._loop.time()
+        expires = self._cache.get(path)
+        if expires is not None:
+            if expires > now:
+                self._cache.move_to_end(path)
+                return True
+            del self._cache[path]
+        future = self._pending.get(path)
+        if future is None:
+            future = self._loop.run_in_executor(None, is_valid_app_path,
+                                                path, self.session,
+                                                self.timeout)
+            future.add_done_callback(partial(self._done, path))
+            self._pending[path] = future
+        try:
+            # Shield the request, other checks may be waiting for it.
+            return await asyncio.shield(future, loop=self._loop)
+        except requests.RequestException as e:
+            self.log.warning('Could not validate path %s: %s', path, e)
+            return False
+
+    def _done(self, path, future):
+        del self._pending[path]
+        if future.cancelled() or future.exception() is not None:
+            # Do not cache failed requests.
+            return
+        if not future.result():
+            return
+        self._cache[path] = self._loop.time() + self.ttl
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+
+def setup(loop, *, worker=0, reuse_port=False):
+    """Start the websocket server in loop.
+
+    worker is the index of the worker process running it. With
+    reuse_port, the workers share the port of the server.
+    """
     log = logging.getLogger(__name__)
-    load_config()
     host = config['websocket']['host'].get()
     port = config['websocket']['port'].get()
     # Create redis client
     redis_client = aredis.StrictRedis.from_url(config['redis_uri'].get())
     # Test that we can connect to redis.
     redis_test = asyncio.ensure_future(redis_client.ping(), loop=loop)
-    handler = handler_factory(redis_client.pubsub(), loop=loop)
-    server = websockets.serve(handler, host=host, port=port, loop=loop)
+    validator = PathValidator(
+        size=config['websocket']['path_cache']['size'].get(int),
+        ttl=config['websocket']['path_cache']['ttl'].get(float),
+        timeout=config['websocket']['path_cache']['timeout'].get(float),
+        loop=loop
+    )
+    metrics = WebsocketMetrics()
+    max_len = config['event_stream']['max_len'].get(int)
+    replay = EventReplay(redis_client, count=max_len) if max_len else None
+    send_queue = config['websocket']['send_queue']
+    handler = handler_factory(
+        redis_client.pubsub(), validator=validator, metrics=metrics,
+        queue_size=send_queue['size'].get(int),
+        policy=send_queue['policy'].get(str),
+        max_lag=send_queue['max_lag'].get(float) or None,
+        batch=Batch(config['websocket']['batch']['window'].get(float),
+                    config['websocket']['batch']['size'].get(int)),
+        replay=replay, loop=loop)
+    kwargs = {}
+    if reuse_port:
+        kwargs.update(reuse_port=True)
+    compression = config['websocket']['compression']
+    if compression['enabled'].get(bool):
+        factory = deflate_factory(
+            window_bits=compression['window_bits'].get(int),
+            mem_level=compression['mem_level'].get(int),
+            min_size=compression['min_size'].get(int),
+            metrics=metrics)
+        if factory is None:
+            log.warning('Compression of websockets needs websockets 6 or '
+                        'newer, sending uncompressed messages.')
+        else:
+            kwargs.update(extensions=[factory], compression=None)
+    elif permessage_deflate is not None:
+        # Newer websockets compress by default.
+        kwargs.update(compression=None)
+    server = websockets.serve(handler, host=host, port=port, loop=loop,
+                              **kwargs)
+    servers = [server]
+    metrics_port = config['websocket']['metrics_port'].get(int)
+    if metrics_port:
+        # Every worker has its own metrics.
+        servers.append(serve_metrics(metrics, host, metrics_port + worker,
+                                     loop=loop))
 
     futures = asyncio.wait(
-        [server, redis_test],
+        servers + [redis_test],
         loop=loop,
         timeout=1
     )
@@ -314,7 +1226,16 @@ def setup(loop):
 
 
 def run():  # pragma: no cover
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', '-w', type=int,
+                        help='Number of worker processes.')
+    args = load_config(parser)
     log = logging.getLogger(__name__)
+    workers = args.workers or config['websocket']['workers'].get(int)
+    if workers > 1:
+        log.debug('Starting %s websocket workers', workers)
+        Supervisor(run_worker, workers).run()
+        return
     log.debug('Getting default event loop')
     loop = asyncio.get_event_loop()
     setup(loop)
@@ -323,5 +1244,18 @@ def run():  # pragma: no cover
     loop.stop()
 
 
+def run_worker(index):  # pragma: no cover
+    """Run the websocket server in worker process index."""
+    log = logging.getLogger(__name__)
+    # Do not use the loop of the supervisor.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    setup(loop, worker=index, reuse_port=True)
+    log.debug('Running websocket worker %s', index)
+    loop.run_forever()
+    loop.close()
+
+
 if __name__ == '__main__':  # pragma: no cover
     run()
@@ -0,0 +1,116 @@
+"""Run a server in worker processes, restarting the ones that exit."""
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import signal
+import time
+
+
+def log():  # pragma: no cover
+    """Logger, is loaded on first use.
+
+    Thus we make sure it is loaded after our config is loaded.
+    """
+    return logging.getLogger(__name__)
+
+
+class Supervisor(object):
+    """Run target(index) in count forked worker processes.
+
+    A worker that exits is started again, but not within restart_delay
+    seconds of its previous start, so a failing worker does not keep
+    the supervisor busy. The workers are terminated on SIGTERM or
+    SIGINT, and killed if they did not exit within timeout seconds.
+    """
+
+    def __init__(self, target, count, *, restart_delay=1.0, timeout=5.0):
+        self.target = target
+        self.count = count
+        self.restart_delay = restart_delay
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('fork')
+        # Map of worker index to (process, start time).
+        self.workers = {}
+        self.stopping = False
+
+    def run(self):
+        """Start the workers and supervise them till signalled to stop."""
+        signal.signal(signal.SIGTERM, self.signalled)
+        signal.signal(signal.SIGINT, self.signalled)
+        self.start()
+        try:
+            while not self.stopping:
+                self.watch(1.0)
+        finally:
+            self.stop()
+
+    def signalled(self, signum, frame):
+        log().info('Stopping workers on signal %s.', signum)
+        self.stopping = True
+
+    def start(self):
+        for index in range(self.count):
+            if index not in self.workers:
+                self.start_worker(index)
+
+    def start_worker(self, index):
+        process = self.context.Process(target=self._run_worker,
+                                       args=(index,),
+                                       name='worker-{}'.format(index))
+        process.start()
+        self.workers[index] = (process, time.monotonic())
+        log().debug('Started worker %s with pid %s.', index, process.pid)
+
+    def _run_worker(self, index):
+        # The supervisor stops the workers, also on a keyboard interrupt
+        # which is send to the whole process group.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.target(index)
+
+    def watch(self, timeout=None):
+        """Wait for workers to exit, for at most timeout seconds.
+
+        The workers that exited are started again, once their restart
+        delay has passed.
+        """
+        sentinels = []
+        for process, started in self.workers.values():
+            if process.exitcode is None:
+                sentinels.append(process.sentinel)
+            else:
+                # Wake up when the worker can be started again.
+                delay = max(started + self.restart_delay - time.monotonic(),
+                            0)
+                timeout = delay if timeout is None else min(timeout, delay)
+        if sentinels:
+            wait(sentinels, timeout)
+        elif timeout:
+            time.sleep(timeout)
+        now = time.monotonic()
+        for index, (process, started) in list(self.workers.items()):
+            if self.stopping or process.exitcode is None:
+                continue
+            if now - started < self.restart_delay:
+                # Check again after the delay.
+                continue
+            log().warning('Worker %s exited with code %s, restarting it.',
+                          index, process.exitcode)
+            self.start_worker(index)
+
+    def stop(self):
+        """Terminate the workers and wait for them to exit."""
+        self.stopping = True
+        processes = [process for process, _ in self.workers.values()]
+        for process in processes:
+            if process.exitcode is None:
+                process.terminate()
+        deadline = time.monotonic() + self.timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.exitcode is None:
+                log().warning('Killing worker %s.', process.name)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        self.workers.clear()